@@ -1,187 +1,2441 @@
 import cv2
+import numpy as np
+import os
+import math
 import time
 import threading
 import json
+import queue
 import asyncio
 import websockets
+from collections import OrderedDict, deque
+from dataclasses import dataclass
 from pupil_apriltags import Detector
+from detection_pool import DetectionPool
+from detection_worker import TagDetection
+import tag_protocol
+import journal as journal_mod
+import recording
+import metrics
 from flask import Flask, Response, render_template_string, request, jsonify
 
+try:
+    # websocket dos navegadores no modo Flask (opcional; o async_server não precisa)
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
+
 # === CONFIGURAÇÃO DO STREAM DO RASPBERRY ===
 UDP_URL = "udp://0.0.0.0:5000?overrun_nonfatal=1&fifo_size=50000"
 WIDTH = 1280
 HEIGHT = 720
 
-# === CONFIGURAÇÃO DO WEBSOCKET PARA O RASPBERRY ===
-RASPBERRY_WS_URL = "ws://192.168.14.223:6789"  
+# === CONFIGURAÇÃO DO WEBSOCKET PARA O RASPBERRY ===
+RASPBERRY_WS_URL = "ws://192.168.14.223:6789"  
+
+app = Flask(__name__)
+sock = Sock(app) if Sock is not None else None
+
+# Websocket dos navegadores: eventos empurrados para a interface
+UI_TAGS_MAX_HZ = 10        # no máximo N atualizações de tags por segundo
+UI_LATENCY_PUSH_S = 1.0    # latência dos comandos no /ui/ws, no máximo 1 vez por segundo
+UI_ALIGN_STATS_PUSH_S = 1.0  # medidas da malha de alinhamento no /ui/ws enquanto ela roda
+UI_CLIENT_QUEUE_MAX = 64   # eventos pendentes por navegador antes de descartar
+
+# "opencv": cv2.VideoCapture (padrão) | "pyav": decodificação de baixa latência com PyAV
+# | "replay": lê a gravação em REPLAY_PATH no lugar do stream (ver recording.py)
+CAPTURE_BACKEND = "opencv"
+PYAV_DECODER_THREADS = 0  # 0 = automático (threads por slice, sem atraso extra)
+
+# gravação do stream que chega (só no backend pyav) e ritmo da reprodução
+RECORD_PATH = None        # ex.: "recordings/2026-10-17-turno1"
+REPLAY_PATH = None
+REPLAY_REALTIME = True    # False = o mais rápido possível
+REPLAY_LOOP = False
+
+# buffers de frame pré-alocados (captura -> MJPEG/detecção)
+FRAME_POOL_SIZE = 8
+
+# MJPEG: degraus de resolução, do maior para o menor; cada cliente escolhe
+# um com /video?rung=<nome> ou deixa o servidor escolher (auto)
+MJPEG_RUNGS = {
+    "high": dict(width=1280, height=720, quality=80, max_fps=30),
+    "medium": dict(width=640, height=360, quality=70, max_fps=15),
+    "low": dict(width=320, height=180, quality=60, max_fps=10),
+}
+MJPEG_DEFAULT_RUNG = "auto"
+MJPEG_AUTO_START_RUNG = "medium"
+MJPEG_AUTO_DOWN_BUSY = 0.8    # envio ocupando mais que isso do intervalo entre frames -> desce
+MJPEG_AUTO_UP_BUSY = 0.3      # abaixo disso por MJPEG_AUTO_UP_FRAMES frames seguidos -> sobe
+MJPEG_AUTO_UP_FRAMES = 30
+
+# Reconfiguração do rpicam-vid pela carga deste lado: do melhor para o mais
+# leve. Melhor 15 fps lisos em 960x540 que 30 fps em 720p travando.
+VIDEO_CONTROL_ENABLED = True
+VIDEO_LADDER = (
+    dict(width=1280, height=720, fps=30, bitrate=4000000, intra=30),
+    dict(width=1280, height=720, fps=20, bitrate=3000000, intra=20),
+    dict(width=960, height=540, fps=15, bitrate=1500000, intra=15),
+    dict(width=640, height=360, fps=15, bitrate=800000, intra=15),
+)
+VIDEO_CONTROL_INTERVAL_S = 2.0
+VIDEO_CONTROL_COOLDOWN_S = 6.0   # depois de uma troca (o stream reinicia e as medidas zeram)
+VIDEO_DOWN_SAMPLES = 2           # amostras ruins seguidas para descer um degrau
+VIDEO_UP_SAMPLES = 15            # amostras folgadas seguidas para subir um
+VIDEO_LAG_HIGH_S = 0.15          # atraso de buffer que conta como ruim
+VIDEO_LAG_LOW_S = 0.05           # ... e o que conta como folga
+VIDEO_DELIVERY_LOW = 0.8         # frames decodificados / fps configurado
+VIDEO_DELIVERY_OK = 0.95
+VIDEO_STALL_GAP_S = 0.25         # intervalo entre frames que conta como travada
+
+# diário em disco (ações, comandos, detecções); a interface só mostra as últimas
+JOURNAL_ENABLED = True
+JOURNAL_DIR = "journal"
+JOURNAL_SEGMENT_BYTES = 16 * 1024 * 1024
+JOURNAL_FLUSH_INTERVAL_S = 0.5
+JOURNAL_MAX_BYTES = 1024 * 1024 * 1024   # retenção: apaga os segmentos mais antigos
+JOURNAL_MAX_AGE_S = 7 * 24 * 3600
+JOURNAL_QUERY_LIMIT = 10000
+ACTIONS_LOG_SIZE = 10
+
+cap = None
+capture_thread = None
+vision_stop = threading.Event()   # encerra a captura (stop_vision)
+journal = journal_mod.Journal(JOURNAL_DIR, JOURNAL_SEGMENT_BYTES, JOURNAL_FLUSH_INTERVAL_S,
+                              max_bytes=JOURNAL_MAX_BYTES, max_age_s=JOURNAL_MAX_AGE_S)
+
+# APRILTAG: detector global
+AT_DETECTOR_PARAMS = dict(
+    families="tag36h11",
+    nthreads=2,
+    quad_decimate=2.0,
+    quad_sigma=0.0,
+    refine_edges=1,
+    decode_sharpening=0.25,
+    debug=0,
+)
+at_detector = Detector(**AT_DETECTOR_PARAMS)
+
+# "thread": um detector numa thread (padrão)
+# "process": DETECTION_WORKERS processos lendo de um anel em memória compartilhada
+DETECTION_MODE = "thread"
+DETECTION_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+detection_pool = None
+
+# Rastreamento por ROI (só no modo "thread"): entre varreduras completas,
+# procura as tags apenas em volta dos cantos da última detecção.
+TRACKING_ENABLED = False
+TRACKING_FULL_SCAN_PERIOD = 15   # frames entre varreduras completas
+TRACKING_ROI_PADDING = 0.75      # margem, em fração do tamanho da tag
+TRACKING_ROI_MIN_SIZE = 48       # lado mínimo da ROI em pixels
+
+# Escalonador adaptativo da detecção: ajusta quad_decimate, pulo de frames
+# e número de threads para caber no orçamento de latência.
+DETECTION_LATENCY_BUDGET_S = 0.08  # tempo máximo desejado por detect()
+DETECTION_DECIMATE_LEVELS = (1.0, 1.5, 2.0, 3.0, 4.0)
+DETECTION_MAX_SKIP = 6             # detecta no mínimo 1 a cada N frames
+DETECTION_MAX_THREADS = max(1, os.cpu_count() or 2)
+TAG_FAST_SPEED_PX_S = 150.0        # acima disso a tag está "andando rápido"
+TAG_SEND_INTERVAL_S = (0.05, 0.5)  # intervalo de envio com tag rápida / parada
+
+# Protocolo das AprilTags: o lote de cada frame vai numa mensagem só
+# (binária se o Raspberry aceitar) e tags que quase não mexeram são omitidas.
+TAG_CHANGE_THRESHOLD_PX = 2.0  # deslocamento mínimo de um canto para reenviar
+TAG_KEYFRAME_INTERVAL_S = 1.0  # reenvia todas as tags pelo menos nesse intervalo
+WS_HELLO_TIMEOUT_S = 1.0
+
+# Fila de comandos para o Raspberry: limitada, com prioridade e validade.
+# Comandos vencidos são descartados em vez de executados atrasados.
+PRIO_STOP = 0
+PRIO_MOTION = 1
+PRIO_FORK = 2
+PRIO_TELEMETRY = 3
+COMMAND_TTL_S = {
+    PRIO_STOP: 5.0,
+    PRIO_MOTION: 0.5,
+    PRIO_FORK: 2.0,
+    PRIO_TELEMETRY: 0.3,
+}
+COMMAND_QUEUE_MAX = 32
+
+# Modo contínuo: o navegador informa (linear, angular) e o servidor repassa
+# o setpoint ao Raspberry em ritmo fixo pela conexão websocket já aberta.
+DRIVE_STREAM_HZ = 20
+DRIVE_CLIENT_TIMEOUT_S = 0.5  # navegador sem atualizar o setpoint -> zera
+
+# Auto-alinhamento: o operador escolhe uma tag e uma malha fechada aqui no
+# servidor manda setpoints de "drive" até o garfo ficar centrado na distância
+# de encaixe. O watchdog do Raspberry (0,3 s) para tudo se os setpoints sumirem.
+AUTO_ALIGN_HZ = 20
+AUTO_ALIGN_TARGET_X = 0.5           # onde o centro da tag deve ficar (fração da largura)
+AUTO_ALIGN_TARGET_SIZE_PX = 220.0   # lado aparente da tag na distância de encaixe
+AUTO_ALIGN_TOLERANCE_X = 0.03       # erro horizontal aceito (fração da meia largura)
+AUTO_ALIGN_TOLERANCE_SIZE = 0.05    # erro de tamanho aceito (fração do alvo)
+AUTO_ALIGN_SETTLE_SAMPLES = 5       # detecções seguidas dentro da tolerância para terminar
+AUTO_ALIGN_KP_LINEAR = 1.0
+AUTO_ALIGN_KP_ANGULAR = 0.8
+AUTO_ALIGN_MAX_LINEAR = 0.35
+AUTO_ALIGN_MAX_ANGULAR = 0.4
+AUTO_ALIGN_MIN_SPEED = 0.08         # o DRIVE_DEADBAND do Raspberry zera o que for menor
+AUTO_ALIGN_HEADING_GATE = 0.3       # erro horizontal acima disso: só gira, sem avançar
+AUTO_ALIGN_LATENCY_REF_S = 0.1      # detecção mais velha que isso: ganhos caem na proporção
+AUTO_ALIGN_STALE_S = 0.5            # última detecção da tag mais velha que isso: para e espera
+AUTO_ALIGN_LOST_S = 2.0             # ... e nesse tempo: desiste
+AUTO_ALIGN_TIMEOUT_S = 30.0
+AUTO_ALIGN_MAX_SIZE_RATIO = 1.5     # tag maior que isso x o alvo: perto demais, desiste
+
+# Rastreamento dos comandos: cada comando leva id e horário de envio, e o
+# Raspberry devolve acks (received/started/finished) com o relógio dele.
+COMMAND_ACK_TIMEOUT_S = 10.0  # sem "finished" nesse tempo -> desiste do comando
+COMMAND_LATENCY_WINDOW = 500  # amostras guardadas para os percentis
+DRIVE_ACK_SAMPLE_S = 1.0      # setpoint repetido do modo contínuo: só um com ack por segundo
+CLOCK_OFFSET_WINDOW = 64      # amostras de offset (usa a de menor ida e volta)
+
+# === WEBSOCKET: fila, loop e thread ===
+# modo frota: o processo de um robô não tem websocket e entrega os
+# comandos da visão ao processo principal por esta função
+command_sink = None
+
+async def negotiate_protocol(websocket) -> int:
+    """
+    Oferece as versões do protocolo e espera a escolha do Raspberry.
+    Um raspberry_control.py antigo não responde, então fica no JSON.
+    """
+    await websocket.send(json.dumps(tag_protocol.hello_message()))
+    try:
+        resp = await asyncio.wait_for(websocket.recv(), WS_HELLO_TIMEOUT_S)
+        data = json.loads(resp)
+    except (asyncio.TimeoutError, ValueError, TypeError):
+        return tag_protocol.PROTOCOL_JSON
+    if not isinstance(data, dict) or data.get("type") != "hello":
+        return tag_protocol.PROTOCOL_JSON
+    return tag_protocol.choose_protocol([data.get("protocol")])
+
+
+def encode_command(cmd: dict, protocol: int = tag_protocol.PROTOCOL_JSON):
+    """Serializa um comando da fila conforme o protocolo negociado."""
+    if cmd.get("type") == "apriltag_batch":
+        if protocol == tag_protocol.PROTOCOL_BINARY:
+            return [tag_protocol.encode_batch(cmd["frame_id"], cmd["timestamp"], cmd["tags"])]
+        family = AT_DETECTOR_PARAMS["families"]
+        return [json.dumps(m) for m in tag_protocol.batch_to_json_messages(cmd, family)]
+    return [json.dumps(cmd)]
+
+
+def command_priority(cmd: dict) -> int:
+    if cmd.get("type") == "button":
+        subtype = cmd.get("subtype")
+        if subtype == "move" and str(cmd.get("dir", "")).upper() in ("STOP", "PARAR"):
+            return PRIO_STOP
+        if subtype in ("move", "rotate"):
+            return PRIO_MOTION
+        if subtype == "fork":
+            return PRIO_FORK
+    if cmd.get("type") == "drive":
+        return PRIO_MOTION
+    if cmd.get("type") == "video_config":
+        # raro e pedido justamente quando a rede aperta: não pode vencer em 0,3 s
+        return PRIO_FORK
+    return PRIO_TELEMETRY
+
+
+def coalesce_key(cmd: dict):
+    """Telemetria e setpoints repetidos só valem pelo valor mais novo."""
+    if cmd.get("type") == "drive":
+        return "drive"
+    if cmd.get("type") == "apriltag_batch":
+        return "apriltag_batch"
+    if cmd.get("type") == "video_config":
+        return "video_config"
+    if cmd.get("type") == "apriltag":
+        return ("apriltag", cmd.get("id"))
+    return None
+
+
+class CommandScheduler:
+    """
+    Substitui o asyncio.Queue do RobotLink (só usar dentro do loop dele).
+
+    - get() sempre entrega a classe de maior prioridade primeiro
+      (STOP > movimento manual > garfo > telemetria);
+    - cada classe tem validade (COMMAND_TTL_S): o que venceu esperando,
+      por exemplo durante uma reconexão, é descartado;
+    - telemetria (e setpoints do modo contínuo) com a mesma chave é
+      fundida, ficando só o valor mais novo;
+    - um STOP descarta movimentos e garfo que ainda estavam na fila;
+    - com a fila cheia, sai o comando mais velho da classe menos importante.
+    """
+
+    def __init__(self, maxsize: int, ttls: dict):
+        self.maxsize = maxsize
+        self.ttls = dict(ttls)
+        self._queues = {prio: deque() for prio in sorted(self.ttls)}
+        self._event = asyncio.Event()
+        self.enqueued = 0
+        self.delivered = 0
+        self.dropped = {"expired": 0, "overflow": 0, "coalesced": 0, "preempted": 0}
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def put_nowait(self, cmd: dict):
+        prio = command_priority(cmd)
+        now = time.monotonic()
+        self.enqueued += 1
+
+        if prio == PRIO_STOP:
+            for p in (PRIO_MOTION, PRIO_FORK):
+                self.dropped["preempted"] += len(self._queues[p])
+                self._queues[p].clear()
+
+        key = coalesce_key(cmd)
+        if key is not None:
+            q = self._queues[prio]
+            for entry in list(q):
+                if coalesce_key(entry[1]) == key:
+                    q.remove(entry)
+                    self.dropped["coalesced"] += 1
+
+        if self.depth() >= self.maxsize and not self._evict(prio):
+            self.dropped["overflow"] += 1
+            return
+
+        self._queues[prio].append((now, cmd))
+        self._event.set()
+
+    def _evict(self, prio: int) -> bool:
+        """Abre espaço tirando o mais velho de uma classe igual ou menos importante."""
+        for p in sorted(self._queues, reverse=True):
+            if p < prio:
+                break
+            if self._queues[p]:
+                self._queues[p].popleft()
+                self.dropped["overflow"] += 1
+                return True
+        return False
+
+    async def get(self) -> dict:
+        while True:
+            now = time.monotonic()
+            for prio, q in self._queues.items():
+                while q:
+                    t, cmd = q.popleft()
+                    if now - t > self.ttls[prio]:
+                        self.dropped["expired"] += 1
+                        continue
+                    self.delivered += 1
+                    return cmd
+            self._event.clear()
+            await self._event.wait()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "depth_by_class": {str(p): len(q) for p, q in self._queues.items()},
+            "enqueued": self.enqueued,
+            "delivered": self.delivered,
+            "dropped": dict(self.dropped),
+            "dropped_total": sum(self.dropped.values()),
+        }
+
+
+class CommandLatencyTracker:
+    """
+    Casa os acks do Raspberry com os comandos enviados.
+
+    O ack "received" traz t2 (chegada no Raspberry) e tx = t3 (saída do
+    ack); com t1 (envio) e t4 (chegada do ack) daqui, como no NTP:
+      offset = ((t2 - t1) + (t3 - t4)) / 2,  ida e volta = (t4 - t1) - (t3 - t2)
+    O offset usado é o da amostra recente com menor ida e volta, que é a
+    menos afetada por fila na rede. Com ele sai a latência de ida; início
+    e execução (started/finished) são medidos só no relógio do Raspberry.
+    Comandos com capture_ts (relógio daqui) medem também da captura do
+    frame até o atuador começar ("actuation"), usando o offset.
+
+    O modo contínuo repete o mesmo setpoint a DRIVE_STREAM_HZ; esses
+    repetidos vão sem id (e o Raspberry não manda ack), a não ser um por
+    DRIVE_ACK_SAMPLE_S para a medida continuar viva.
+    """
+
+    PHASES = ("one_way", "rtt", "start", "exec", "actuation")
+
+    def __init__(self, window: int = COMMAND_LATENCY_WINDOW,
+                 offset_window: int = CLOCK_OFFSET_WINDOW,
+                 ack_timeout: float = COMMAND_ACK_TIMEOUT_S, histograms: dict = None):
+        self.ack_timeout = ack_timeout
+        self.histograms = histograms   # fase -> Histogram; None = command_latency
+        self._lock = threading.Lock()
+        self._next_id = 0
+        # id -> {"type", "t1", "received", "started"}, em ordem de envio
+        self._pending = OrderedDict()
+        self._last_drive = None   # (v, w, t1) do último drive com id
+        self._offsets = deque(maxlen=offset_window)   # (ida e volta, offset)
+        self._samples = {phase: deque(maxlen=window) for phase in self.PHASES}
+        self.sent = 0
+        self.unsampled = 0
+        self.acked = 0
+        self.unacked = 0
+        self.status = {}
+
+    def on_sent(self, cmd: dict) -> dict:
+        """Devolve uma cópia do comando com id e sent_at (chamar logo antes do envio)."""
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if cmd.get("type") == "drive" and cmd.get("capture_ts") is None:
+                last = self._last_drive
+                if (last is not None and last[:2] == (cmd.get("v"), cmd.get("w"))
+                        and now - last[2] < DRIVE_ACK_SAMPLE_S):
+                    self.unsampled += 1
+                    return dict(cmd, sent_at=now)
+                self._last_drive = (cmd.get("v"), cmd.get("w"), now)
+            self._next_id += 1
+            cmd_id = self._next_id
+            self._pending[cmd_id] = {"type": cmd.get("type"), "t1": now,
+                                     "capture": cmd.get("capture_ts")}
+            self.sent += 1
+        return dict(cmd, id=cmd_id, sent_at=now)
+
+    def _expire(self, now: float):
+        # os mais antigos estão no começo: para no primeiro que ainda vale
+        while self._pending:
+            cmd_id, entry = next(iter(self._pending.items()))
+            if now - entry["t1"] <= self.ack_timeout:
+                break
+            self._pending.popitem(last=False)
+            if "received" not in entry:
+                self.unacked += 1
+
+    @property
+    def offset(self):
+        """Relógio do Raspberry menos o daqui (s), ou None sem amostras."""
+        if not self._offsets:
+            return None
+        return min(self._offsets)[1]
+
+    def on_ack(self, ack: dict, t4: float):
+        with self._lock:
+            entry = self._pending.get(ack.get("id"))
+            if entry is None:
+                return
+            stage, t = ack.get("stage"), float(ack.get("t", 0.0))
+
+            if stage == "received":
+                t1, t3 = entry["t1"], float(ack.get("tx", t))
+                rtt = (t4 - t1) - (t3 - t)
+                self._offsets.append((rtt, ((t - t1) + (t3 - t4)) / 2))
+                entry["received"] = t
+                self.acked += 1
+                self._observe("rtt", t4 - t1)
+                self._observe("one_way", max(0.0, t - self.offset - t1))
+            elif stage == "started":
+                entry["started"] = t
+                if "received" in entry:
+                    self._observe("start", t - entry["received"])
+                if entry["capture"] is not None and self.offset is not None:
+                    self._observe("actuation", t - self.offset - entry["capture"])
+            elif stage == "finished":
+                self._pending.pop(ack.get("id"), None)
+                status = ack.get("status", "done")
+                self.status[status] = self.status.get(status, 0) + 1
+                if "started" in entry:
+                    self._observe("exec", t - entry["started"])
+
+    def _observe(self, phase: str, value: float):
+        self._samples[phase].append(value)
+        (self.histograms or command_latency)[phase].observe(value)
+
+    def stats(self) -> dict:
+        with self._lock:
+            samples = {phase: list(v) for phase, v in self._samples.items()}
+            offset = self.offset
+            best = min(self._offsets)[0] if self._offsets else None
+            data = {
+                "sent": self.sent,
+                "unsampled": self.unsampled,
+                "acked": self.acked,
+                "unacked": self.unacked,
+                "pending": len(self._pending),
+                "status": dict(self.status),
+            }
+        data["clock_offset_ms"] = offset * 1000 if offset is not None else None
+        data["offset_rtt_ms"] = best * 1000 if best is not None else None
+        for phase, values in samples.items():
+            values.sort()
+            data[phase + "_ms"] = {
+                "count": len(values),
+                **{f"p{p}": (1000 * values[min(len(values) - 1, int(p / 100 * len(values)))]
+                             if values else None) for p in (50, 90, 95, 99)},
+            }
+        return data
+
+
+def start_ws_thread():
+    """
+    Sobe uma thread com um event loop asyncio dedicado ao websocket.
+    """
+    async def main():
+        await asyncio.gather(link.run(RASPBERRY_WS_URL), link.drive_streamer())
+
+    t = threading.Thread(target=asyncio.run, args=(main(),), daemon=True)
+    t.start()
+
+
+def send_ws_command(cmd: dict):
+    """
+    Interface thread-safe para colocar um comando na fila do websocket.
+    Exemplo de cmd:
+      {"type": "button", "action": "UP"}
+      {"type": "apriltag_batch", "frame_id": 42, "timestamp": ..., "tags": [...]}
+    """
+    if command_sink is not None:
+        command_sink(cmd)
+        return
+    link.send(cmd)
+
+
+# === INTERFACE: eventos empurrados para os navegadores ===
+class UiEventBus:
+    """
+    Distribui eventos (log, conexão com o Raspberry, tags detectadas) para
+    todos os navegadores conectados no websocket /ui/ws. Cada conexão
+    assina com uma função push(evento) que não pode bloquear.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._last_tags_push = 0.0
+        self._last_latency_push = 0.0
+
+    def subscribe(self, push):
+        with self._lock:
+            self._subscribers.add(push)
+
+    def unsubscribe(self, push):
+        with self._lock:
+            self._subscribers.discard(push)
+
+    @property
+    def clients(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: dict):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for push in subscribers:
+            push(event)
+
+    def publish_tags(self, result):
+        """Tags detectadas para o overlay, limitadas a UI_TAGS_MAX_HZ."""
+        if not self._subscribers:
+            return
+        now = time.monotonic()
+        if now - self._last_tags_push < 1.0 / UI_TAGS_MAX_HZ:
+            return
+        self._last_tags_push = now
+        self.publish(tags_event(result))
+
+    def publish_latency(self, tracker):
+        """Latência dos comandos (chamado a cada ack), limitada a UI_LATENCY_PUSH_S."""
+        if not self._subscribers:
+            return
+        now = time.monotonic()
+        if now - self._last_latency_push < UI_LATENCY_PUSH_S:
+            return
+        self._last_latency_push = now
+        self.publish(latency_event(tracker))
+
+
+ui_events = UiEventBus()
+
+
+def latency_event(tracker: CommandLatencyTracker) -> dict:
+    return dict(tracker.stats(), type="latency")
+
+
+def tags_event(result) -> dict:
+    if result is None:
+        return {"type": "tags", "tags": []}
+    return {
+        "type": "tags",
+        "frame_id": result.frame_seq,
+        "age_ms": round(1000 * (time.monotonic() - result.capture_time)),
+        "width": WIDTH,
+        "height": HEIGHT,
+        "tags": [
+            {
+                "id": int(r.tag_id),
+                "center": [round(float(c), 1) for c in r.center],
+                "corners": [[round(float(x), 1) for x in pt] for pt in r.corners],
+            }
+            for r in result.tags
+        ],
+    }
+
+
+class RobotLink:
+    """
+    O websocket com um Raspberry e tudo o que vai junto: fila de comandos,
+    acks, setpoint do modo contínuo, log das ações, diário e eventos da
+    interface. O app_server tem um (link); o fleet.py, um por robô.
+
+    run() e drive_streamer() rodam no event loop do websocket; send(),
+    handle_action() e set_drive_setpoint() podem vir de qualquer thread.
+    Os ganchos ligam o link ao resto do processo:
+      cancel_align(motivo, stop)  comando manual ou Raspberry desconectado
+      on_align(tag_id)            alinhamento pedido pela interface
+      on_video_config(resposta)   resposta do Raspberry ao video_config
+    """
+
+    def __init__(self, journal, events: UiEventBus, label: str = "[WS]",
+                 cancel_align=None, on_align=None, on_video_config=None,
+                 latency_histograms: dict = None, send_histogram=None):
+        self.journal = journal
+        self.events = events
+        self.label = label
+        self.cancel_align = cancel_align
+        self.on_align = on_align
+        self.on_video_config = on_video_config
+        self.send_histogram = send_histogram   # None = stage_seconds["ws_send"]
+
+        self.commands = CommandScheduler(COMMAND_QUEUE_MAX, COMMAND_TTL_S)
+        self.tracker = CommandLatencyTracker(histograms=latency_histograms)
+        # buffer circular das últimas ações (o histórico completo fica no diário)
+        self.actions_log = deque(maxlen=ACTIONS_LOG_SIZE)
+        self.protocol = tag_protocol.PROTOCOL_JSON
+        self.connected = False
+        self.reconnects = 0
+        self.drive_setpoint = None   # (linear, angular, instante) ou None
+        self.loop = None
+
+    # --- websocket ---
+    async def run(self, url: str):
+        """Mantém a conexão com o Raspberry e envia o que entrar na fila."""
+        self.loop = asyncio.get_running_loop()
+        while True:
+            try:
+                print(f"{self.label} Conectando ao Raspberry em {url}", flush=True)
+                async with websockets.connect(url) as websocket:
+                    self.protocol = await negotiate_protocol(websocket)
+                    print(f"{self.label} Conectado! (protocolo v{self.protocol})", flush=True)
+                    self._set_connected(True)
+                    if VIDEO_CONTROL_ENABLED:
+                        # sem campos é só consulta: o controle parte do que o Pi está usando
+                        self.commands.put_nowait({"type": "video_config"})
+                    # as respostas (acks) chegam em paralelo, sem travar os envios
+                    receiver = asyncio.create_task(self._receive(websocket))
+                    try:
+                        await self._send_loop(websocket)
+                    finally:
+                        receiver.cancel()
+            except Exception as e:
+                print(f"{self.label} Erro na conexão:", e, flush=True)
+
+            self._set_connected(False)
+            self.reconnects += 1
+            print(f"{self.label} Tentando reconectar em 2s...", flush=True)
+            await asyncio.sleep(2)
+
+    async def _send_loop(self, websocket):
+        while True:
+            cmd = await self.commands.get()
+            if cmd.get("type") != "apriltag_batch":
+                cmd = self.tracker.on_sent(cmd)
+            try:
+                t0 = time.monotonic()
+                for msg in encode_command(cmd, self.protocol):
+                    await websocket.send(msg)
+                (self.send_histogram or stage_seconds["ws_send"]).observe(time.monotonic() - t0)
+                if JOURNAL_ENABLED and cmd.get("type") != "apriltag_batch":
+                    # os lotes de tags já entram no diário como detecção
+                    self.journal.append(journal_mod.KIND_COMMAND, json.dumps(cmd).encode())
+            except Exception as e:
+                print(f"{self.label} Erro ao enviar comando:", e, flush=True)
+                return  # o run() reconecta
+
+    async def _receive(self, websocket):
+        """Lê o que o Raspberry manda de volta (acks e respostas do video_config)."""
+        async for message in websocket:
+            t4 = time.time()
+            if isinstance(message, bytes):
+                continue
+            try:
+                data = json.loads(message)
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            if data.get("type") == "ack":
+                self.tracker.on_ack(data, t4)
+                self.events.publish_latency(self.tracker)
+            elif data.get("type") == "video_config" and self.on_video_config is not None:
+                self.on_video_config(data)
+
+    def _set_connected(self, connected: bool):
+        if self.connected != connected:
+            self.connected = connected
+            self.events.publish(self.pi_event())
+        if not connected:
+            self._cancel_align("Raspberry desconectado", stop=False)
+
+    def _cancel_align(self, reason: str, stop: bool = True):
+        if self.cancel_align is not None:
+            self.cancel_align(reason, stop=stop)
+
+    def send(self, cmd: dict):
+        """Coloca um comando na fila (thread-safe). Antes do run() o comando é perdido."""
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.commands.put_nowait, cmd)
+
+    # --- modo contínuo ---
+    def set_drive_setpoint(self, linear: float, angular: float):
+        """Chamado pelas rotas (qualquer thread); o drive_streamer faz o envio."""
+        self._cancel_align("comando manual", stop=False)
+        self.drive_setpoint = (linear, angular, time.monotonic())
+
+    async def drive_streamer(self):
+        """
+        Enquanto houver setpoint, manda {"type": "drive"} a DRIVE_STREAM_HZ.
+        Se o navegador parar de atualizar, manda zero uma vez e para; do lado
+        do Raspberry o watchdog para os motores se as mensagens sumirem.
+        """
+        seq = 0
+        period = 1.0 / DRIVE_STREAM_HZ
+        while True:
+            await asyncio.sleep(period)
+            sp = self.drive_setpoint
+            if sp is None:
+                continue
+
+            linear, angular, t = sp
+            if time.monotonic() - t > DRIVE_CLIENT_TIMEOUT_S:
+                linear = angular = 0.0
+            if linear == 0.0 and angular == 0.0 and self.drive_setpoint is sp:
+                self.drive_setpoint = None
+
+            seq += 1
+            self.commands.put_nowait({"type": "drive", "v": linear, "w": angular, "seq": seq})
+
+    # --- ações e interface ---
+    def handle_action(self, action):
+        """Registra a ação no log, manda o comando ao Raspberry e devolve o log invertido."""
+        if action:
+            self.actions_log.append(action)
+            if JOURNAL_ENABLED:
+                self.journal.append(journal_mod.KIND_ACTION, json.dumps({"action": action}).encode())
+
+            if action == "STOP":
+                self.drive_setpoint = None
+            cmd = action_command(action)
+            if cmd is not None:
+                self._cancel_align("comando manual", stop=False)
+                self.send(cmd)
+
+            self.events.publish(self.log_event())
+
+        return list(reversed(self.actions_log))
+
+    def clear_log(self):
+        # só limpa a visão da interface; o diário não é apagado
+        self.actions_log.clear()
+        self.events.publish(self.log_event())
+
+    def log_event(self) -> dict:
+        return {"type": "log", "log": list(reversed(self.actions_log))}
+
+    def pi_event(self) -> dict:
+        return {"type": "pi", "connected": self.connected, "protocol": self.protocol}
+
+    def ui_snapshot(self) -> list:
+        """Parte do estado inicial de um navegador que vem do link."""
+        return [self.log_event(), self.pi_event(), latency_event(self.tracker)]
+
+    def handle_ui_message(self, data: dict):
+        """
+        Mensagens do navegador pelo websocket:
+          {"type": "action", "action": "UP"}
+          {"type": "drive", "v": 0.5, "w": 0.0}
+          {"type": "clear_log"}
+          {"type": "align", "tag_id": 3}  (tag_id null cancela)
+        Devolve um evento de resposta só para quem mandou (ou None).
+        """
+        kind = data.get("type")
+        if kind == "action":
+            self.handle_action(data.get("action"))
+        elif kind == "drive":
+            try:
+                self.set_drive_setpoint(*parse_drive_setpoint(data))
+            except ValueError as e:
+                return {"type": "error", "error": str(e)}
+        elif kind == "clear_log":
+            self.clear_log()
+        elif kind == "align" and self.on_align is not None:
+            try:
+                self.on_align(parse_align_request(data))
+            except ValueError as e:
+                return {"type": "error", "error": str(e)}
+        else:
+            return {"type": "error", "error": f"tipo desconhecido: {kind}"}
+        return None
+
+
+link = RobotLink(
+    journal, ui_events,
+    cancel_align=lambda reason, stop=True: auto_aligner.cancel(reason, stop=stop),
+    on_align=lambda tag_id: handle_align(tag_id),
+    on_video_config=lambda data: handle_video_config_reply(data),
+)
+command_tracker = link.tracker
+actions_log = link.actions_log
+
+
+def ui_snapshot():
+    """Estado inicial mandado a um navegador que acabou de conectar."""
+    return link.ui_snapshot() + [tags_event(latest_detection), auto_aligner.event(),
+                                 align_stats_event()]
+
+
+# === CAPTURA: backends plugáveis ===
+@dataclass
+class FrameInfo:
+    pts: float           # timestamp do stream em segundos (None se desconhecido)
+    arrival_time: float  # time.monotonic() quando o pacote/frame chegou
+
+
+class CaptureStats:
+    """
+    Contadores da captura e estimativa de atraso.
+
+    O atraso de buffer é (chegada - pts) menos o menor valor já visto:
+    o menor valor corresponde ao frame que chegou "na hora", então o
+    excedente é o quanto os frames estão se acumulando no caminho.
+    """
+
+    EWMA_ALPHA = 0.1
+
+    def __init__(self):
+        self.frames_decoded = 0
+        self.frames_delivered = 0
+        self.frames_dropped = 0
+        self.buffer_lag = 0.0      # EWMA do atraso acumulado (s)
+        self.buffer_lag_max = 0.0
+        self.read_lag = 0.0        # EWMA de chegada -> entrega ao consumidor (s)
+        self.frames_corrupt = 0    # decodificados com erro (pacote UDP perdido)
+        self.stalls = 0            # intervalos entre frames acima de stall_gap
+        self.stall_gap = VIDEO_STALL_GAP_S
+        self._min_offset = None
+        self._last_arrival = None
+
+    def reset_clock(self):
+        """Chamado quando o stream é reaberto/reconfigurado e os PTS recomeçam."""
+        self._min_offset = None
+        self._last_arrival = None
+        self.buffer_lag = 0.0
+
+    def on_decoded(self, info: FrameInfo):
+        self.frames_decoded += 1
+        if self._last_arrival is not None and info.arrival_time - self._last_arrival > self.stall_gap:
+            self.stalls += 1
+        self._last_arrival = info.arrival_time
+        if info.pts is None:
+            return
+        offset = info.arrival_time - info.pts
+        if self._min_offset is None or offset < self._min_offset:
+            self._min_offset = offset
+        lag = offset - self._min_offset
+        self.buffer_lag += self.EWMA_ALPHA * (lag - self.buffer_lag)
+        self.buffer_lag_max = max(self.buffer_lag_max, lag)
+
+    def on_delivered(self, info: FrameInfo):
+        self.frames_delivered += 1
+        lag = time.monotonic() - info.arrival_time
+        self.read_lag += self.EWMA_ALPHA * (lag - self.read_lag)
+
+    def as_dict(self) -> dict:
+        return {
+            "frames_decoded": self.frames_decoded,
+            "frames_delivered": self.frames_delivered,
+            "frames_dropped": self.frames_dropped,
+            "buffer_lag_s": self.buffer_lag,
+            "buffer_lag_max_s": self.buffer_lag_max,
+            "read_lag_s": self.read_lag,
+            "frames_corrupt": self.frames_corrupt,
+            "stalls": self.stalls,
+        }
+
+
+class OpenCVCapture:
+    """Backend padrão: cv2.VideoCapture com buffer de 1 frame."""
+
+    name = "opencv"
+
+    def __init__(self, url: str):
+        self.url = url
+        self.stats = CaptureStats()
+        self._cap = cv2.VideoCapture(url)
+        self._cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def read(self, out=None):
+        """
+        Devolve (ret, frame, FrameInfo). Se out tiver o tamanho do stream,
+        o OpenCV decodifica direto nele e frame é o próprio out.
+        """
+        ret, frame = self._cap.read(out)
+        if not ret:
+            return False, None, None
+        pos_ms = self._cap.get(cv2.CAP_PROP_POS_MSEC)
+        info = FrameInfo(pts=pos_ms / 1000.0 if pos_ms > 0 else None,
+                         arrival_time=time.monotonic())
+        self.stats.on_decoded(info)
+        self.stats.on_delivered(info)
+        return True, frame, info
+
+    def on_stream_restart(self, fps: int):
+        """O Raspberry reiniciou o rpicam-vid com outra configuração."""
+        self.stats.reset_clock()
+
+    def release(self):
+        self._cap.release()
+
+
+class PyAVCapture:
+    """
+    Decodifica o H.264 do rpicam-vid com PyAV numa thread própria.
+
+    O decoder roda com low_delay e threads por slice (threads por frame
+    atrasariam um frame por thread). Cada frame decodificado substitui o
+    anterior se ninguém o leu ainda, então read() sempre entrega o mais
+    novo; a conversão para BGR só acontece para o frame que é entregue.
+    """
+
+    name = "pyav"
+
+    FORMAT_OPTIONS = {
+        "flags": "low_delay",
+        "probesize": "32768",
+        "analyzeduration": "0",
+    }
+    CODEC_OPTIONS = {
+        "flags": "+low_delay",
+        "flags2": "+fast",
+    }
+
+    def __init__(self, url: str, threads: int = 0, record_path: str = None):
+        import av  # dependência opcional, só para este backend
+
+        self._av = av
+        self.url = url
+        self.threads = threads
+        self.stats = CaptureStats()
+        self._recorder = recording.Recorder(record_path) if record_path else None
+        self._cond = threading.Condition()
+        self._latest = None  # (av.VideoFrame, FrameInfo)
+        self._new_rate = None  # fps novo depois de uma reconfiguração do Pi
+        self._running = True
+        self._thread = threading.Thread(target=self._decode_loop, daemon=True)
+        self._thread.start()
+
+    def _open(self):
+        options = dict(self.FORMAT_OPTIONS)
+        if self.url.startswith(("udp://", "tcp://", "rtp://")):
+            # sem buffer de probe: num arquivo isso perderia o SPS/PPS inicial,
+            # mas o rpicam-vid --inline repete os cabeçalhos a cada keyframe
+            options["fflags"] = "nobuffer"
+        container = self._av.open(self.url, options=options, timeout=5.0)
+        stream = container.streams.video[0]
+        ctx = stream.codec_context
+        ctx.options = dict(self.CODEC_OPTIONS)
+        ctx.thread_type = "SLICE"
+        ctx.thread_count = self.threads
+        return container, stream
+
+    def _decode_loop(self):
+        while self._running:
+            try:
+                container, stream = self._open()
+            except Exception as e:
+                print("[CAPTURA] PyAV: erro ao abrir stream:", e, flush=True)
+                time.sleep(1)
+                continue
+
+            # H.264 cru pela UDP costuma vir sem PTS: usa o número do frame
+            # dividido pela taxa nominal como relógio do stream
+            rate = float(stream.average_rate or stream.guessed_rate or 30)
+            count = 0
+            self.stats.reset_clock()
+            try:
+                for packet in container.demux(stream):
+                    if not self._running:
+                        break
+                    arrival = time.monotonic()
+                    if self._recorder is not None and packet.size:
+                        self._recorder.write(bytes(packet), arrival)
+                    for frame in packet.decode():
+                        if self._new_rate is not None:
+                            # o rpicam-vid recomeçou: novo relógio a partir daqui
+                            rate, count, self._new_rate = self._new_rate, 0, None
+                            self.stats.reset_clock()
+                        if frame.is_corrupt:
+                            self.stats.frames_corrupt += 1
+                        if frame.pts is not None and frame.time_base is not None:
+                            pts = float(frame.pts * frame.time_base)
+                        else:
+                            pts = count / rate
+                        count += 1
+                        info = FrameInfo(pts=pts, arrival_time=arrival)
+                        self.stats.on_decoded(info)
+                        with self._cond:
+                            if self._latest is not None:
+                                self.stats.frames_dropped += 1
+                            self._latest = (frame, info)
+                            self._cond.notify()
+            except Exception as e:
+                print("[CAPTURA] PyAV: erro na decodificação:", e, flush=True)
+            finally:
+                container.close()
+
+            if self._running:
+                time.sleep(0.5)
+
+    def read(self, out=None, timeout: float = 1.0):
+        """
+        Devolve (ret, frame, FrameInfo) com o frame decodificado mais novo.
+        Se out tiver o mesmo tamanho, a imagem é copiada para ele.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._latest is not None, timeout):
+                return False, None, None
+            frame, info = self._latest
+            self._latest = None
+
+        image = frame.to_ndarray(format="bgr24")
+        if out is not None and out.shape == image.shape:
+            np.copyto(out, image)
+            image = out
+        self.stats.on_delivered(info)
+        return True, image, info
+
+    def on_stream_restart(self, fps: int):
+        """O Raspberry reiniciou o rpicam-vid com outra configuração."""
+        self._new_rate = float(fps)
+
+    def release(self):
+        self._running = False
+        self._thread.join(timeout=2)
+        if self._recorder is not None:
+            self._recorder.close()
+
+
+class ReplayCapture:
+    """
+    Reproduz uma gravação do recording.Recorder como se fosse o stream.
+
+    Decodifica na própria chamada de read(), um frame por vez e sem
+    descartar nenhum, então a sequência de frames é sempre a mesma.
+    Com realtime=True espera o instante de chegada gravado de cada pacote;
+    senão entrega tão rápido quanto o consumidor pedir.
+    """
+
+    name = "replay"
+
+    def __init__(self, path: str, realtime: bool = True, loop: bool = False):
+        import av  # dependência opcional, só para este backend
+
+        self._av = av
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.stats = CaptureStats()
+        self._packets = None
+        self._codec = None
+        self._pending = []   # frames decodificados ainda não entregues
+        self._t0 = None
+        self._rewind()
+
+    def _rewind(self):
+        self._packets = recording.iter_packets(self.path)
+        self._codec = self._av.CodecContext.create("h264", "r")
+        self._codec.thread_type = "SLICE"
+        self._pending = []
+        self._t0 = time.monotonic()
+        self.stats.reset_clock()
+
+    def _next_frames(self):
+        """Decodifica pacotes até sair ao menos um frame. False no fim da gravação."""
+        for arrival, data in self._packets:
+            try:
+                frames = self._codec.decode(self._av.Packet(data))
+            except self._av.error.FFmpegError:
+                # gravação começou no meio de um GOP: espera o próximo keyframe
+                continue
+            if frames:
+                self._pending = [(f, arrival) for f in frames]
+                return True
+        try:
+            self._pending = [(f, None) for f in self._codec.decode(None)]
+        except self._av.error.FFmpegError:
+            self._pending = []
+        return bool(self._pending)
+
+    def read(self, out=None):
+        if not self._pending and not self._next_frames():
+            if not self.loop:
+                return False, None, None
+            self._rewind()
+            if not self._next_frames():
+                return False, None, None
+
+        frame, arrival = self._pending.pop(0)
+        if arrival is None:
+            arrival = time.monotonic() - self._t0
+        if self.realtime:
+            delay = self._t0 + arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        # pts = chegada gravada: o atraso de buffer mostra o jitter original
+        info = FrameInfo(pts=arrival, arrival_time=time.monotonic())
+        image = frame.to_ndarray(format="bgr24")
+        if out is not None and out.shape == image.shape:
+            np.copyto(out, image)
+            image = out
+        self.stats.on_decoded(info)
+        self.stats.on_delivered(info)
+        return True, image, info
+
+    def release(self):
+        self._packets = None
+        self._codec = None
+
+
+def open_capture(backend: str, url: str):
+    if backend == "pyav":
+        return PyAVCapture(url, threads=PYAV_DECODER_THREADS, record_path=RECORD_PATH)
+    if backend == "replay":
+        return ReplayCapture(url, realtime=REPLAY_REALTIME, loop=REPLAY_LOOP)
+    if backend == "opencv":
+        return OpenCVCapture(url)
+    raise ValueError(f"Backend de captura desconhecido: {backend}")
+
+
+# === VÍDEO: configuração do rpicam-vid ajustada pela carga deste lado ===
+class VideoController:
+    """
+    Escolhe o degrau de VIDEO_LADDER que o Raspberry deve usar.
+
+    A cada amostra olha a captura e a detecção. Conta como ruim: atraso de
+    buffer acima de lag_high, menos frames decodificados que o fps
+    configurado (pacote perdido ou encoder engasgando), travadas, frames
+    corrompidos ou detect() acima do orçamento (se o degrau de baixo tiver
+    menos fps). down_samples amostras ruins
+    seguidas descem um degrau; up_samples folgadas seguidas sobem um. Depois
+    de uma troca espera cooldown_s: o stream reinicia e as medidas zeram.
+    """
+
+    def __init__(self, ladder, cooldown_s: float, down_samples: int, up_samples: int,
+                 lag_high: float, lag_low: float, delivery_low: float, delivery_ok: float):
+        self.ladder = [dict(rung) for rung in ladder]
+        self.cooldown_s = cooldown_s
+        self.down_samples = down_samples
+        self.up_samples = up_samples
+        self.lag_high = lag_high
+        self.lag_low = lag_low
+        self.delivery_low = delivery_low
+        self.delivery_ok = delivery_ok
+
+        self.level = None     # degrau mais próximo do que o Raspberry confirmou
+        self.config = None    # configuração que o Raspberry confirmou
+        self.pending = None   # (degrau pedido, instante) esperando resposta
+        self.reconfigurations = 0
+        self.last_sample = {}
+        self.last_reason = "esperando a configuração do Raspberry"
+        self.changes = deque(maxlen=20)
+
+        self._lock = threading.Lock()
+        self._bad = 0
+        self._good = 0
+        self._last_change = 0.0
+        self._last = None   # (instante, frames_decoded, stalls, frames_corrupt)
+
+    def nearest_level(self, config: dict) -> int:
+        """Degrau com resolução x fps mais parecidos com config."""
+        load = config["width"] * config["height"] * config["fps"]
+        return min(range(len(self.ladder)),
+                   key=lambda i: abs(self.ladder[i]["width"] * self.ladder[i]["height"]
+                                     * self.ladder[i]["fps"] - load))
+
+    def step(self, stats: CaptureStats, detection: dict, now: float = None):
+        """Uma amostra. Devolve o comando video_config a mandar, ou None."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            snap = (now, stats.frames_decoded, stats.stalls, stats.frames_corrupt)
+            last, self._last = self._last, snap
+            if self.config is None or last is None or now <= last[0]:
+                return None
+            if self.pending is not None:
+                if now - self.pending[1] < self.cooldown_s:
+                    return None
+                self.last_reason = "sem resposta do Raspberry; tentando de novo"
+                self.pending = None
+            if now - self._last_change < self.cooldown_s:
+                self._bad = self._good = 0
+                return None
+
+            dt = now - last[0]
+            delivery = (snap[1] - last[1]) / dt / self.config["fps"]
+            stalls, corrupt = snap[2] - last[2], snap[3] - last[3]
+            detect_time, budget = detection.get("detect_time_s"), detection.get("budget_s")
+            detect_over = detect_time is not None and budget is not None and detect_time > budget
+            self.last_sample = {
+                "buffer_lag_s": stats.buffer_lag,
+                "delivery": delivery,
+                "stalls": stalls,
+                "frames_corrupt": corrupt,
+                "detect_over_budget": detect_over,
+            }
+
+            problems = []
+            if stats.buffer_lag > self.lag_high:
+                problems.append(f"atraso {stats.buffer_lag * 1000:.0f} ms")
+            if delivery < self.delivery_low:
+                problems.append(f"{delivery:.0%} dos frames")
+            if stalls:
+                problems.append(f"{stalls} travadas")
+            if corrupt:
+                problems.append(f"{corrupt} frames corrompidos")
+            # os frames são redimensionados para WIDTH x HEIGHT antes do detect():
+            # só baixar o fps alivia a detecção, então só conta se o próximo baixa
+            below = self.ladder[min(self.level + 1, len(self.ladder) - 1)]
+            if detect_over and below["fps"] < self.config["fps"]:
+                problems.append("detect() acima do orçamento")
+            calm = (not problems and not detect_over and stats.buffer_lag < self.lag_low
+                    and delivery >= self.delivery_ok)
+
+            self._bad = self._bad + 1 if problems else 0
+            self._good = self._good + 1 if calm else 0
+            if self._bad >= self.down_samples and self.level < len(self.ladder) - 1:
+                return self._request(self.level + 1, ", ".join(problems), now)
+            if self._good >= self.up_samples and self.level > 0:
+                return self._request(self.level - 1, "folga na captura e na detecção", now)
+            return None
+
+    def _request(self, level: int, reason: str, now: float) -> dict:
+        self._bad = self._good = 0
+        self.pending = (level, now)
+        rung = self.ladder[level]
+        self.last_reason = f"{self.describe(self.config)} -> {self.describe(rung)} ({reason})"
+        self.changes.append({"time": time.time(), "change": self.last_reason})
+        print("[VIDEO] Reconfigurando:", self.last_reason, flush=True)
+        return dict(rung, type="video_config")
+
+    def on_reply(self, data: dict, now: float = None) -> bool:
+        """Resposta do Raspberry; True se o stream foi reiniciado."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self.pending = None
+            config = data.get("config")
+            if not data.get("ok", True):
+                self.last_reason = f"Raspberry recusou: {data.get('error')}"
+                self.changes.append({"time": time.time(), "change": self.last_reason})
+            if not isinstance(config, dict) or not all(k in config for k in ("width", "height", "fps")):
+                return False
+            self.config = config
+            self.level = self.nearest_level(config)
+            if not data.get("restarted"):
+                return False
+            self.reconfigurations += 1
+            self._last_change = now
+            self._bad = self._good = 0
+            return True
+
+    @staticmethod
+    def describe(config) -> str:
+        if not config:
+            return "?"
+        return f"{config['width']}x{config['height']}@{config['fps']}"
+
+    def state(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": VIDEO_CONTROL_ENABLED,
+                "config": self.config,
+                "level": self.level,
+                "ladder": self.ladder,
+                "pending": self.ladder[self.pending[0]] if self.pending else None,
+                "reconfigurations": self.reconfigurations,
+                "bad_samples": self._bad,
+                "good_samples": self._good,
+                "last_sample": self.last_sample,
+                "last_reason": self.last_reason,
+                "changes": list(self.changes),
+            }
+
+
+video_controller = VideoController(
+    ladder=VIDEO_LADDER,
+    cooldown_s=VIDEO_CONTROL_COOLDOWN_S,
+    down_samples=VIDEO_DOWN_SAMPLES,
+    up_samples=VIDEO_UP_SAMPLES,
+    lag_high=VIDEO_LAG_HIGH_S,
+    lag_low=VIDEO_LAG_LOW_S,
+    delivery_low=VIDEO_DELIVERY_LOW,
+    delivery_ok=VIDEO_DELIVERY_OK,
+)
+
+
+def handle_video_config_reply(data: dict):
+    """Resposta do {"type": "video_config"}: avisa a captura se o stream reiniciou."""
+    if video_controller.on_reply(data):
+        print("[VIDEO] Raspberry aplicou", VideoController.describe(data["config"]),
+              f"(rpicam-vid trocado em {data.get('respawn_ms')} ms)", flush=True)
+        if cap is not None and hasattr(cap, "on_stream_restart"):
+            cap.on_stream_restart(data["config"]["fps"])
+
+
+def video_control_loop():
+    """Thread do controle: uma amostra a cada VIDEO_CONTROL_INTERVAL_S."""
+    while True:
+        time.sleep(VIDEO_CONTROL_INTERVAL_S)
+        # gravação não tem rpicam-vid do outro lado para reconfigurar
+        if cap is None or not hasattr(cap, "on_stream_restart"):
+            continue
+        cmd = video_controller.step(cap.stats, detection_scheduler.state())
+        if cmd is not None:
+            send_ws_command(cmd)
+
+
+# === FRAMES: pool de buffers pré-alocados com contagem de referências ===
+class PooledFrame:
+    """Um buffer do FramePool. Volta para o pool quando a última referência é solta."""
+
+    __slots__ = ("pool", "array", "refs")
+
+    def __init__(self, pool, array):
+        self.pool = pool
+        self.array = array
+        self.refs = 0
+
+    def retain(self):
+        with self.pool._lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        self.pool._release(self)
+
+
+class FramePool:
+    """
+    Buffers de frame do mesmo tamanho, reaproveitados entre captura,
+    MJPEG e detecção em vez de alocar um array novo por frame.
+    Se todos estiverem em uso, aloca mais um (e conta em "grown").
+    """
+
+    def __init__(self, shape, size: int, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self._all = [PooledFrame(self, np.empty(self.shape, dtype)) for _ in range(size)]
+        self._free = list(self._all)
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.grown = 0
+
+    def acquire(self) -> PooledFrame:
+        """Pega um buffer livre já com uma referência (de quem chamou)."""
+        with self._lock:
+            if self._free:
+                buf = self._free.pop()
+            else:
+                buf = PooledFrame(self, np.empty(self.shape, self.dtype))
+                self._all.append(buf)
+                self.grown += 1
+            buf.refs = 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            return buf
+
+    def _release(self, buf: PooledFrame):
+        with self._lock:
+            buf.refs -= 1
+            if buf.refs == 0:
+                self.in_use -= 1
+                self._free.append(buf)
+
+    def stats(self) -> dict:
+        with self._lock:
+            buf_bytes = int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+            return {
+                "buffers": len(self._all),
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "grown": self.grown,
+                "buffer_bytes": buf_bytes,
+                "allocated_bytes": buf_bytes * len(self._all),
+                "peak_in_use_bytes": buf_bytes * self.peak_in_use,
+            }
+
+
+frame_pool = FramePool((HEIGHT, WIDTH, 3), FRAME_POOL_SIZE)
+
+
+# === APRILTAG: worker de detecção separado da captura ===
+
+@dataclass
+class CapturedFrame:
+    seq: int
+    buffer: PooledFrame  # referência no pool; quem consome faz release()
+    capture_time: float  # time.monotonic() no momento do cap.read()
+
+
+@dataclass
+class DetectionResult:
+    frame_seq: int
+    capture_time: float
+    tags: list
+    detect_time: float  # segundos gastos no detect()
+    frame_age: float    # idade do frame quando o resultado ficou pronto
+
+
+class LatestFrameMailbox:
+    """
+    Caixa de correio de uma posição só: quem produz sempre sobrescreve,
+    quem consome sempre pega o frame mais novo. Frames velhos são
+    descartados em vez de enfileirados, então a captura nunca espera a visão.
+    """
+
+    def __init__(self, on_drop=None):
+        self._cond = threading.Condition()
+        self._item = None
+        self._on_drop = on_drop
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            old, self._item = self._item, item
+            self._cond.notify()
+        if old is not None:
+            self.dropped += 1
+            if self._on_drop is not None:
+                self._on_drop(old)
+
+    def take(self, timeout=None):
+        """Espera um item novo; devolve None em caso de timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._item is not None, timeout):
+                return None
+            item, self._item = self._item, None
+            return item
+
+
+class RoiTracker:
+    """
+    Detecta só dentro de ROIs (com margem) em volta das tags já conhecidas.
+    Faz uma varredura completa (com o quad_decimate do detector global)
+    a cada full_scan_period frames, quando não há nada sendo rastreado,
+    ou quando alguma tag some da sua ROI.
+    """
+
+    def __init__(self, full_detector, roi_detector, full_scan_period: int,
+                 padding: float, min_size: int):
+        self.full_detector = full_detector
+        self.roi_detector = roi_detector
+        self.full_scan_period = full_scan_period
+        self.padding = padding
+        self.min_size = min_size
+
+        self.tracks = {}  # tag_id -> cantos (4x2) na última detecção
+        self.frames_since_full = 0
+        self.full_scans = 0
+        self.roi_scans = 0
+        self.tracks_lost = 0
+
+    def detect(self, gray):
+        if not self.tracks or self.frames_since_full >= self.full_scan_period:
+            return self._full_scan(gray)
+
+        self.frames_since_full += 1
+        self.roi_scans += 1
+        found = {}
+        for x0, y0, x1, y1 in self._rois(gray.shape):
+            crop = np.ascontiguousarray(gray[y0:y1, x0:x1])
+            offset = np.array([x0, y0], dtype=np.float64)
+            for r in self.roi_detector.detect(crop, estimate_tag_pose=False):
+                found[int(r.tag_id)] = TagDetection(
+                    int(r.tag_id),
+                    getattr(r, "tag_family", "unknown"),
+                    r.center + offset,
+                    r.corners + offset,
+                )
+
+        if any(tag_id not in found for tag_id in self.tracks):
+            # perdeu alguma tag: refaz a busca no frame inteiro agora mesmo
+            self.tracks_lost += 1
+            return self._full_scan(gray)
+
+        self.tracks = {tag_id: t.corners for tag_id, t in found.items()}
+        return list(found.values())
+
+    def _full_scan(self, gray):
+        self.frames_since_full = 0
+        self.full_scans += 1
+        results = self.full_detector.detect(gray, estimate_tag_pose=False)
+        self.tracks = {int(r.tag_id): r.corners for r in results}
+        return results
+
+    def _rois(self, shape):
+        """Caixas com margem em volta de cada tag, juntando as que se sobrepõem."""
+        h, w = shape[:2]
+        boxes = []
+        for corners in self.tracks.values():
+            (xmin, ymin), (xmax, ymax) = corners.min(axis=0), corners.max(axis=0)
+            pad = max(xmax - xmin, ymax - ymin) * self.padding
+            half_min = self.min_size / 2
+            cx, cy = (xmin + xmax) / 2, (ymin + ymax) / 2
+            x0 = min(xmin - pad, cx - half_min)
+            y0 = min(ymin - pad, cy - half_min)
+            x1 = max(xmax + pad, cx + half_min)
+            y1 = max(ymax + pad, cy + half_min)
+            boxes.append([max(0, int(x0)), max(0, int(y0)),
+                          min(w, int(x1) + 1), min(h, int(y1) + 1)])
+
+        merged = []
+        for box in sorted(boxes):
+            for m in merged:
+                if box[0] < m[2] and m[0] < box[2] and box[1] < m[3] and m[1] < box[3]:
+                    m[0], m[1] = min(m[0], box[0]), min(m[1], box[1])
+                    m[2], m[3] = max(m[2], box[2]), max(m[3], box[3])
+                    break
+            else:
+                merged.append(box)
+        return merged
+
+    def stats(self) -> dict:
+        return {
+            "tracks": sorted(self.tracks),
+            "full_scans": self.full_scans,
+            "roi_scans": self.roi_scans,
+            "tracks_lost": self.tracks_lost,
+        }
+
+
+class DetectionScheduler:
+    """
+    Decide a cada resultado quanto a detecção pode gastar.
+
+    Mede o tempo do detect() e a velocidade das tags (px/s entre
+    detecções). Se o detect() estoura o orçamento, primeiro usa mais
+    threads, depois aumenta o quad_decimate e por último pula mais frames;
+    com folga desfaz na ordem inversa. Tags rápidas pedem detecção em todo
+    frame e envio frequente; tags paradas deixam pular frames e enviar menos.
+    """
+
+    EWMA_ALPHA = 0.2
+    COOLDOWN = 5  # resultados entre duas mudanças
+
+    def __init__(self, base_params: dict, budget_s: float, decimate_levels,
+                 max_skip: int, max_threads: int, fast_speed: float,
+                 send_intervals, adapt_detector: bool = True, detector=None):
+        self.base_params = dict(base_params)
+        self.budget_s = budget_s
+        self.decimate_levels = list(decimate_levels)
+        self.max_skip = max_skip
+        self.max_threads = max_threads
+        self.fast_speed = fast_speed
+        self.send_fast, self.send_slow = send_intervals
+        # no modo "process" cada processo tem seu detector: só o pulo é adaptado
+        self.adapt_detector = adapt_detector
+
+        start = float(base_params.get("quad_decimate", 2.0))
+        self.decimate_idx = min(range(len(self.decimate_levels)),
+                                key=lambda i: abs(self.decimate_levels[i] - start))
+        self.nthreads = int(base_params.get("nthreads", 1))
+        self.skip = 1
+
+        self.detect_time = None
+        self.tag_speed = 0.0
+        self.send_interval = self.send_slow
+        self.last_send = 0.0
+        self.last_reason = "inicial"
+        self.changes = deque(maxlen=20)
+
+        self._lock = threading.Lock()
+        self._detectors = {}
+        if detector is not None:
+            self._detectors[(self.quad_decimate, self.nthreads)] = detector
+        self._last_centers = {}
+        self._last_time = None
+        self._since_change = 0
+
+    @property
+    def quad_decimate(self) -> float:
+        return self.decimate_levels[self.decimate_idx]
+
+    def detector(self):
+        """Detector com os parâmetros atuais (um por combinação, reaproveitado)."""
+        key = (self.quad_decimate, self.nthreads)
+        det = self._detectors.get(key)
+        if det is None:
+            det = Detector(**dict(self.base_params, quad_decimate=key[0], nthreads=key[1]))
+            self._detectors[key] = det
+        return det
+
+    def should_detect(self, frame_idx: int) -> bool:
+        return frame_idx % self.skip == 0
+
+    def should_send(self, now: float) -> bool:
+        if now - self.last_send < self.send_interval:
+            return False
+        self.last_send = now
+        return True
+
+    def observe(self, result):
+        with self._lock:
+            a = self.EWMA_ALPHA
+            if self.detect_time is None:
+                self.detect_time = result.detect_time
+            else:
+                self.detect_time += a * (result.detect_time - self.detect_time)
+            self._observe_motion(result)
+            self._since_change += 1
+            if self._since_change >= self.COOLDOWN:
+                self._adapt()
+
+    def _observe_motion(self, result):
+        centers = {int(r.tag_id): (float(r.center[0]), float(r.center[1])) for r in result.tags}
+        speed = 0.0
+        if self._last_time is not None and result.capture_time > self._last_time:
+            dt = result.capture_time - self._last_time
+            for tag_id, (x, y) in centers.items():
+                prev = self._last_centers.get(tag_id)
+                if prev is not None:
+                    speed = max(speed, ((x - prev[0]) ** 2 + (y - prev[1]) ** 2) ** 0.5 / dt)
+        self._last_centers = centers
+        self._last_time = result.capture_time
+        self.tag_speed += self.EWMA_ALPHA * (speed - self.tag_speed)
+        fast = self.tag_speed >= self.fast_speed
+        self.send_interval = self.send_fast if fast else self.send_slow
+
+    def _adapt(self):
+        fast = self.tag_speed >= self.fast_speed
+        still = self.tag_speed < 0.1 * self.fast_speed
+        over = self.detect_time > self.budget_s
+        slack = self.detect_time < 0.5 * self.budget_s
+        top_decimate = len(self.decimate_levels) - 1
+
+        if over:
+            # caro demais: mais threads, depois mais decimação, depois pular frames
+            if self.adapt_detector and self.nthreads < self.max_threads:
+                self._change("nthreads", self.nthreads + 1, "detect() acima do orçamento")
+            elif self.adapt_detector and self.decimate_idx < top_decimate:
+                self._change("decimate_idx", self.decimate_idx + 1, "detect() acima do orçamento")
+            elif self.skip < self.max_skip:
+                self._change("skip", self.skip + 1, "detect() acima do orçamento")
+        elif fast and self.skip > 1:
+            self._change("skip", 1, "tags rápidas: detectar todo frame")
+        elif still and self.skip < self.max_skip:
+            self._change("skip", self.skip + 1, "tags paradas: economizando CPU")
+        elif not fast and not still and self.skip > 1:
+            self._change("skip", self.skip - 1, "tags se movendo")
+        elif slack:
+            # sobra tempo: melhora a resolução e devolve threads
+            if self.adapt_detector and self.decimate_idx > 0:
+                self._change("decimate_idx", self.decimate_idx - 1, "folga no orçamento")
+            elif self.adapt_detector and self.nthreads > 1:
+                self._change("nthreads", self.nthreads - 1, "folga no orçamento")
+
+    def _change(self, attr: str, value, reason: str):
+        old = getattr(self, attr)
+        setattr(self, attr, value)
+        self._since_change = 0
+        name = "quad_decimate" if attr == "decimate_idx" else attr
+        if attr == "decimate_idx":
+            old, value = self.decimate_levels[old], self.decimate_levels[value]
+        self.last_reason = f"{name}: {old} -> {value} ({reason})"
+        self.changes.append({"time": time.time(), "change": self.last_reason})
+
+    def state(self) -> dict:
+        with self._lock:
+            return {
+                "quad_decimate": self.quad_decimate,
+                "nthreads": self.nthreads,
+                "skip": self.skip,
+                "send_interval_s": self.send_interval,
+                "budget_s": self.budget_s,
+                "detect_time_s": self.detect_time,
+                "tag_speed_px_s": self.tag_speed,
+                "adapt_detector": self.adapt_detector,
+                "last_reason": self.last_reason,
+                "changes": list(self.changes),
+            }
+
+
+def make_detection_scheduler(adapt_detector: bool = True):
+    return DetectionScheduler(
+        base_params=AT_DETECTOR_PARAMS,
+        budget_s=DETECTION_LATENCY_BUDGET_S,
+        decimate_levels=DETECTION_DECIMATE_LEVELS,
+        max_skip=DETECTION_MAX_SKIP,
+        max_threads=DETECTION_MAX_THREADS,
+        fast_speed=TAG_FAST_SPEED_PX_S,
+        send_intervals=TAG_SEND_INTERVAL_S,
+        adapt_detector=adapt_detector,
+        detector=at_detector,
+    )
+
+
+def make_roi_tracker():
+    # nas ROIs as tags ocupam poucos pixels, então detecta sem decimação
+    roi_detector = Detector(**dict(AT_DETECTOR_PARAMS, quad_decimate=1.0))
+    return RoiTracker(
+        full_detector=at_detector,
+        roi_detector=roi_detector,
+        full_scan_period=TRACKING_FULL_SCAN_PERIOD,
+        padding=TRACKING_ROI_PADDING,
+        min_size=TRACKING_ROI_MIN_SIZE,
+    )
+
+
+detection_mailbox = LatestFrameMailbox(on_drop=lambda item: item.buffer.release())
+detection_scheduler = make_detection_scheduler()
+latest_detection = None
+roi_tracker = None
+
+
+class TagChangeFilter:
+    """
+    Deixa passar só as tags cujo canto mais deslocado andou pelo menos
+    threshold_px desde o último envio, ou que não são enviadas há mais
+    de keyframe_interval segundos.
+    """
+
+    def __init__(self, threshold_px: float, keyframe_interval: float):
+        self.threshold_px = threshold_px
+        self.keyframe_interval = keyframe_interval
+        self._sent = {}  # tag_id -> (cantos, instante do envio)
+        self.suppressed = 0
+
+    def filter(self, tags, now: float):
+        changed = []
+        for r in tags:
+            tag_id = int(r.tag_id)
+            prev = self._sent.get(tag_id)
+            if prev is not None and now - prev[1] < self.keyframe_interval:
+                if np.abs(r.corners - prev[0]).max() < self.threshold_px:
+                    self.suppressed += 1
+                    continue
+            self._sent[tag_id] = (np.array(r.corners, dtype=np.float64), now)
+            changed.append(r)
+        return changed
+
+
+tag_change_filter = TagChangeFilter(TAG_CHANGE_THRESHOLD_PX, TAG_KEYFRAME_INTERVAL_S)
+
+
+def send_apriltag_results(result: DetectionResult):
+    """
+    Manda as tags de um frame para o Raspberry num lote só, no ritmo pedido
+    pelo escalonador e sem as tags que não se mexeram.
+    """
+    if not result.tags:
+        return
+
+    now = time.monotonic()
+    if not detection_scheduler.should_send(now):
+        return
+
+    changed = tag_change_filter.filter(result.tags, now)
+    if not changed:
+        return
+
+    send_ws_command({
+        "type": "apriltag_batch",
+        "frame_id": result.frame_seq,
+        # relógio de parede do instante da captura, comparável entre máquinas
+        "timestamp": time.time() - (now - result.capture_time),
+        "tags": [(int(r.tag_id), r.center, r.corners) for r in changed],
+    })
+
 
-app = Flask(__name__)
+def journal_detection(result: DetectionResult):
+    """Grava o frame no diário no formato binário v2 (timestamp = instante da captura)."""
+    captured = time.time() - (time.monotonic() - result.capture_time)
+    payload = tag_protocol.encode_batch(
+        result.frame_seq, captured,
+        [(int(r.tag_id), r.center, r.corners) for r in result.tags])
+    journal.append(journal_mod.KIND_DETECTION, payload)
 
-cap = cv2.VideoCapture(UDP_URL)
-cap.set(cv2.CAP_PROP_BUFFERSIZE, 1) 
-latest_frame = None
-lock = threading.Lock()
-actions_log = []
 
-# APRILTAG: detector global
-at_detector = Detector(
-    families="tag36h11",
-    nthreads=2,
-    quad_decimate=2.0,
-    quad_sigma=0.0,
-    refine_edges=1,
-    decode_sharpening=0.25,
-    debug=0,
-)
+def publish_detection(result: DetectionResult):
+    """Ponto único de saída dos resultados, venham da thread ou do pool."""
+    global latest_detection
+    latest_detection = result
+    detection_scheduler.observe(result)
+    # vale para a thread e para o pool (o tempo vem medido no processo)
+    stage_seconds["detect"].observe(result.detect_time)
+    tags_detected.inc(len(result.tags))
+    if JOURNAL_ENABLED:
+        journal_detection(result)
+    send_apriltag_results(result)
+    ui_events.publish_tags(result)
 
-last_tag_send_time = 0.0 
 
-# === WEBSOCKET: fila, loop e thread ===
-ws_loop = None
-ws_command_queue = None
+def on_pool_result(frame_seq, capture_time, tags, detect_time):
+    """Callback do DetectionPool; já chega na ordem dos frames."""
+    publish_detection(DetectionResult(
+        frame_seq=frame_seq,
+        capture_time=capture_time,
+        tags=tags,
+        detect_time=detect_time,
+        frame_age=time.monotonic() - capture_time,
+    ))
 
-async def ws_sender():
-    """
-    Mantém uma conexão WebSocket com o Raspberry e envia comandos
-    colocados na fila ws_command_queue.
-    """
-    global ws_command_queue
 
-    ws_command_queue = asyncio.Queue()
+def start_detection_pool():
+    """Sobe o pool de processos de detecção."""
+    global detection_pool, detection_scheduler
+    detection_scheduler = make_detection_scheduler(adapt_detector=False)
+    params = dict(AT_DETECTOR_PARAMS, nthreads=1)
+    detection_pool = DetectionPool(
+        workers=DETECTION_WORKERS,
+        frame_shape=(HEIGHT, WIDTH, 3),
+        on_result=on_pool_result,
+        detector_kwargs=params,
+    )
+    detection_pool.start()
+
 
+def detection_loop():
+    """Consome o frame mais novo da caixa de correio e roda o detector."""
+    gray = np.empty((HEIGHT, WIDTH), dtype=np.uint8)
     while True:
+        item = detection_mailbox.take()
+        if item is None:
+            continue
+
         try:
-            print("[WS] Conectando ao Raspberry em", RASPBERRY_WS_URL, flush=True)
-            async with websockets.connect(RASPBERRY_WS_URL) as websocket:
-                print("[WS] Conectado!", flush=True)
-                while True:
-                    cmd = await ws_command_queue.get()
-                    try:
-                        await websocket.send(json.dumps(cmd))
-                        # resp = await websocket.recv()
-                        # print("[WS] Resposta:", resp)
-                    except Exception as e:
-                        print("[WS] Erro ao enviar comando:", e, flush=True)
-                        break  # sai pro while externo reconectar
+            t0 = time.monotonic()
+            try:
+                cv2.cvtColor(item.buffer.array, cv2.COLOR_BGR2GRAY, dst=gray)
+            finally:
+                item.buffer.release()
+            stage_seconds["grayscale"].observe(time.monotonic() - t0)
+            t0 = time.monotonic()
+            detector = detection_scheduler.detector()
+            if roi_tracker is not None:
+                roi_tracker.full_detector = detector
+                results = roi_tracker.detect(gray)
+            else:
+                results = detector.detect(
+                    gray,
+                    estimate_tag_pose=False
+                )
+            done = time.monotonic()
+
+            publish_detection(DetectionResult(
+                frame_seq=item.seq,
+                capture_time=item.capture_time,
+                tags=results,
+                detect_time=done - t0,
+                frame_age=done - item.capture_time,
+            ))
         except Exception as e:
-            print("[WS] Erro na conexão:", e, flush=True)
+            print("Erro na detecção de AprilTags:", e, flush=True)
+
 
-        print("[WS] Tentando reconectar em 2s...", flush=True)
-        await asyncio.sleep(2)
+def capture_loop():
+    frame_idx = 0
+    # se o stream já vem em WIDTH x HEIGHT, decodifica direto no buffer do
+    # pool; senão decodifica num buffer de rascunho e redimensiona para o pool
+    scratch = None
+    same_size = True
+    while not vision_stop.is_set():
+        buf = frame_pool.acquire()
+        t0 = time.monotonic()
+        ret, frame, info = cap.read(buf.array if same_size else scratch)
+        if not ret:
+            buf.release()
+            time.sleep(0.01)
+            continue
+        capture_time = info.arrival_time
+        stage_seconds["capture_read"].observe(time.monotonic() - t0)
+        frames_captured.inc()
 
+        if frame is not buf.array:
+            same_size = frame.shape == buf.array.shape
+            if same_size:
+                np.copyto(buf.array, frame)
+            else:
+                scratch = frame
+                t0 = time.monotonic()
+                cv2.resize(frame, (WIDTH, HEIGHT), dst=buf.array)
+                stage_seconds["resize"].observe(time.monotonic() - t0)
 
-def start_ws_thread():
+        # 1) primeiro publica para o MJPEG não atrasar
+        mjpeg_broadcaster.publish(buf)
+
+        # 2) depois entrega para a visão, sem esperar a detecção terminar
+        frame_idx += 1
+        # alinhando, a malha precisa de toda detecção possível
+        if auto_aligner.active or detection_scheduler.should_detect(frame_idx):
+            if detection_pool is not None:
+                detection_pool.submit(frame_idx, buf.array, capture_time)
+            else:
+                detection_mailbox.put(CapturedFrame(frame_idx, buf.retain(), capture_time))
+        else:
+            frames_skipped.inc()
+
+        buf.release()
+
+
+# === AUTO-ALINHAMENTO: malha fechada até a tag do palete ===
+class AutoAligner:
     """
-    Sobe uma thread com um event loop asyncio dedicado ao websocket.
+    Leva o garfo até a tag escolhida usando as detecções como sensor.
+
+    O erro horizontal (centro da tag em relação a target_x) vira velocidade
+    angular e o erro de tamanho aparente (lado da tag em relação a
+    target_size, que marca a distância de encaixe) vira velocidade linear;
+    com a tag muito fora do centro só gira. Cada detecção nova recalcula o
+    setpoint, com ganhos reduzidos quando a detecção chega velha (malha com
+    atraso oscila); entre detecções o setpoint é repetido no ritmo fixo da
+    malha, para o watchdog do Raspberry. Termina com settle_samples
+    detecções seguidas dentro da tolerância, e para por segurança com tag
+    sumida, perto demais ou tempo esgotado.
     """
-    global ws_loop
 
-    def runner():
-        global ws_loop
-        ws_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(ws_loop)
-        ws_loop.run_until_complete(ws_sender())
+    ACTIVE = ("aligning", "waiting")
+    EWMA_ALPHA = 0.1
 
-    t = threading.Thread(target=runner, daemon=True)
-    t.start()
+    def __init__(self, rate_hz: float, target_x: float, target_size: float,
+                 tolerance_x: float, tolerance_size: float, settle_samples: int,
+                 kp_linear: float, kp_angular: float, max_linear: float, max_angular: float,
+                 min_speed: float, heading_gate: float, latency_ref: float, stale_s: float, lost_s: float,
+                 timeout_s: float, max_size_ratio: float):
+        self.rate_hz = rate_hz
+        self.target_x = target_x
+        self.target_size = target_size
+        self.tolerance_x = tolerance_x
+        self.tolerance_size = tolerance_size
+        self.settle_samples = settle_samples
+        self.kp_linear = kp_linear
+        self.kp_angular = kp_angular
+        self.max_linear = max_linear
+        self.max_angular = max_angular
+        self.min_speed = min_speed
+        self.heading_gate = heading_gate
+        self.latency_ref = latency_ref
+        self.stale_s = stale_s
+        self.lost_s = lost_s
+        self.timeout_s = timeout_s
+        self.max_size_ratio = max_size_ratio
 
+        self.status = "idle"
+        self.reason = ""
+        self.tag_id = None
+        self.setpoint = (0.0, 0.0)
+        self.error = None         # (horizontal, tamanho) da última detecção usada
+        self.runs = 0
+        self.results = {}         # status final -> vezes
 
-def send_ws_command(cmd: dict):
+        # medidas da malha
+        self.ticks = 0
+        self.loop_hz = None
+        self.tick_late_max = 0.0
+        self.updates = 0          # detecções novas que viraram setpoint
+        self.detection_age = None # EWMA da idade da detecção ao virar setpoint (s)
+
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._started_at = 0.0
+        self._last_seen = 0.0     # capture_time da última detecção com a tag
+        self._capture_ts = None   # relógio de parede da captura por trás do setpoint
+        self._last_seq = None
+        self._settled = 0
+        self._last_tick = None
+        self._events = []         # eventos da interface gerados com o lock
+
+    def start(self, tag_id: int):
+        with self._lock:
+            self.status = "aligning"
+            self.reason = ""
+            self.tag_id = tag_id
+            self.setpoint = (0.0, 0.0)
+            self.error = None
+            self.runs += 1
+            self._started_at = self._last_seen = time.monotonic()
+            self._capture_ts = None
+            self._last_seq = None
+            self._settled = 0
+            self._last_tick = None
+            self._active.set()
+            event = self.event()
+        print(f"[ALINHAR] Alinhando com a tag {tag_id}", flush=True)
+        ui_events.publish(event)
+
+    def cancel(self, reason: str = "cancelado pelo operador", stop: bool = True):
+        """Interrompe (qualquer thread). stop=False quando um comando manual já vem atrás."""
+        with self._lock:
+            if self.status not in self.ACTIVE:
+                return
+            self._finish("cancelled", reason)
+            events, self._events = self._events, []
+        self._publish(events)
+        if stop:
+            send_ws_command(action_command("STOP"))
+
+    def _finish(self, status: str, reason: str):
+        # chamar com o lock
+        self.status = status
+        self.reason = reason
+        self.setpoint = (0.0, 0.0)
+        self.results[status] = self.results.get(status, 0) + 1
+        self._active.clear()
+        print(f"[ALINHAR] {status}: {reason}", flush=True)
+        self._events.append(self.event())
+
+    @staticmethod
+    def _publish(events):
+        # fora do lock: um assinante lento não segura a malha nem o state()
+        for event in events:
+            ui_events.publish(event)
+
+    @property
+    def active(self) -> bool:
+        return self._active.is_set()
+
+    def wait_active(self, timeout: float = None) -> bool:
+        return self._active.wait(timeout)
+
+    @staticmethod
+    def tag_size(tag) -> float:
+        """Lado aparente da tag em pixels (média dos quatro lados)."""
+        corners = np.asarray(tag.corners, dtype=np.float64)
+        return float(np.mean(np.linalg.norm(corners - np.roll(corners, 1, axis=0), axis=1)))
+
+    def tick(self, result, now: float, late: float = 0.0):
+        """
+        Um ciclo da malha com a detecção mais nova (late: atraso do ciclo em
+        relação ao prazo). Devolve o comando drive a mandar ou None; num fim
+        por segurança devolve o STOP.
+        """
+        with self._lock:
+            cmd = self._tick(result, now, late)
+            events, self._events = self._events, []
+        self._publish(events)
+        return cmd
+
+    def _tick(self, result, now: float, late: float):
+        # com o lock
+        if self.status not in self.ACTIVE:
+            return None
+        self.tick_late_max = max(self.tick_late_max, late)
+        if self._last_tick is not None:
+            dt = now - self._last_tick
+            if dt > 0:
+                hz = 1.0 / dt
+                self.loop_hz = hz if self.loop_hz is None else \
+                    self.loop_hz + self.EWMA_ALPHA * (hz - self.loop_hz)
+        self._last_tick = now
+        self.ticks += 1
+
+        if now - self._started_at > self.timeout_s:
+            self._finish("aborted", f"tempo esgotado ({self.timeout_s:.0f} s)")
+            return action_command("STOP")
+
+        if result is not None and result.frame_seq != self._last_seq:
+            self._last_seq = result.frame_seq
+            tag = next((t for t in result.tags if int(t.tag_id) == self.tag_id), None)
+            if tag is not None:
+                done = self._update(tag, result.capture_time, now)
+                if done is not None:
+                    return done
+
+        if now - self._last_seen > self.lost_s:
+            self._finish("aborted", f"tag {self.tag_id} sumiu por {self.lost_s:.1f} s")
+            return action_command("STOP")
+        if now - self._last_seen > self.stale_s:
+            # sem medida recente (tag fora de vista ou pipeline atrasado): parado
+            if self.status != "waiting":
+                self.status = "waiting"
+                self.reason = f"última detecção da tag há {(now - self._last_seen) * 1000:.0f} ms"
+                self._events.append(self.event())
+            self.setpoint = (0.0, 0.0)
+
+        cmd = {"type": "drive", "v": self.setpoint[0], "w": self.setpoint[1],
+               "source": "align"}
+        if self._capture_ts is not None:
+            # só no primeiro envio do setpoint novo: mede captura -> atuador,
+            # não o tempo que o setpoint ficou repetido
+            cmd["capture_ts"], self._capture_ts = self._capture_ts, None
+        return cmd
+
+    def _update(self, tag, capture_time: float, now: float):
+        """Recalcula o setpoint com uma detecção nova da tag (com o lock)."""
+        age = max(0.0, now - capture_time)
+        self._last_seen = capture_time
+        self.updates += 1
+        self.detection_age = age if self.detection_age is None else \
+            self.detection_age + self.EWMA_ALPHA * (age - self.detection_age)
+        if age > self.stale_s:
+            return None  # velha demais para guiar; o tick() segura parado
+        if self.status == "waiting":
+            self.status = "aligning"
+            self.reason = ""
+            self._events.append(self.event())
+
+        size = self.tag_size(tag)
+        # > 0: tag à direita do alvo / ainda longe
+        err_x = (float(tag.center[0]) - self.target_x * WIDTH) / (WIDTH / 2)
+        err_size = 1.0 - size / self.target_size
+        self.error = (err_x, err_size)
+
+        if size > self.max_size_ratio * self.target_size:
+            self._finish("aborted", f"tag perto demais ({size:.0f} px)")
+            return action_command("STOP")
+
+        within_x = abs(err_x) <= self.tolerance_x
+        within_size = abs(err_size) <= self.tolerance_size
+        self._settled = self._settled + 1 if within_x and within_size else 0
+        if self._settled >= self.settle_samples:
+            self._finish("aligned", f"erro {err_x:+.3f} / {err_size:+.3f}")
+            return {"type": "drive", "v": 0.0, "w": 0.0, "source": "align"}
+
+        gain = min(1.0, self.latency_ref / age) if age > 0 else 1.0
+        angular = 0.0 if within_x else -self.kp_angular * gain * err_x   # angular > 0 gira anti-horário
+        linear = 0.0 if within_size else self.kp_linear * gain * err_size
+        if abs(err_x) > self.heading_gate:
+            linear = 0.0
+        self.setpoint = (self._limit(linear, self.max_linear), self._limit(angular, self.max_angular))
+        self._capture_ts = time.time() - (now - capture_time)
+        return None
+
+    def _limit(self, value: float, maximum: float) -> float:
+        # fora da tolerância o comando precisa mover o robô: nem zerado pela
+        # zona morta do Raspberry, nem acima do máximo
+        if value == 0.0:
+            return 0.0
+        return math.copysign(min(maximum, max(self.min_speed, abs(value))), value)
+
+    def event(self) -> dict:
+        return {"type": "align", "status": self.status, "tag_id": self.tag_id,
+                "reason": self.reason}
+
+    def state(self) -> dict:
+        with self._lock:
+            return {
+                "status": self.status,
+                "reason": self.reason,
+                "tag_id": self.tag_id,
+                "setpoint": {"v": self.setpoint[0], "w": self.setpoint[1]},
+                "error": {"x": self.error[0], "size": self.error[1]} if self.error else None,
+                "runs": self.runs,
+                "results": dict(self.results),
+                "rate_hz": self.rate_hz,
+                "loop_hz": self.loop_hz,
+                "tick_late_max_ms": self.tick_late_max * 1000,
+                "ticks": self.ticks,
+                "updates": self.updates,
+                "detection_age_ms": self.detection_age * 1000 if self.detection_age is not None else None,
+            }
+
+
+auto_aligner = AutoAligner(
+    rate_hz=AUTO_ALIGN_HZ,
+    target_x=AUTO_ALIGN_TARGET_X,
+    target_size=AUTO_ALIGN_TARGET_SIZE_PX,
+    tolerance_x=AUTO_ALIGN_TOLERANCE_X,
+    tolerance_size=AUTO_ALIGN_TOLERANCE_SIZE,
+    settle_samples=AUTO_ALIGN_SETTLE_SAMPLES,
+    kp_linear=AUTO_ALIGN_KP_LINEAR,
+    kp_angular=AUTO_ALIGN_KP_ANGULAR,
+    max_linear=AUTO_ALIGN_MAX_LINEAR,
+    max_angular=AUTO_ALIGN_MAX_ANGULAR,
+    min_speed=AUTO_ALIGN_MIN_SPEED,
+    heading_gate=AUTO_ALIGN_HEADING_GATE,
+    latency_ref=AUTO_ALIGN_LATENCY_REF_S,
+    stale_s=AUTO_ALIGN_STALE_S,
+    lost_s=AUTO_ALIGN_LOST_S,
+    timeout_s=AUTO_ALIGN_TIMEOUT_S,
+    max_size_ratio=AUTO_ALIGN_MAX_SIZE_RATIO,
+)
+
+
+def auto_align_loop():
+    """Thread da malha: dorme até um alinhamento começar e então roda a AUTO_ALIGN_HZ."""
+    period = 1.0 / auto_aligner.rate_hz
+    while True:
+        auto_aligner.wait_active()
+        next_tick = last_push = time.monotonic()
+        while True:
+            now = time.monotonic()
+            cmd = auto_aligner.tick(latest_detection, now, late=now - next_tick)
+            if cmd is None:
+                break
+            send_ws_command(cmd)
+            if auto_aligner.status not in AutoAligner.ACTIVE:
+                break
+            if ui_events.clients and now - last_push >= UI_ALIGN_STATS_PUSH_S:
+                last_push = now
+                ui_events.publish(align_stats_event())
+            # prazo fixo: um ciclo atrasado não empurra os seguintes
+            next_tick += period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.monotonic()
+        # as medidas finais, com o resultado
+        ui_events.publish(align_stats_event())
+
+
+def auto_align_state() -> dict:
+    return dict(auto_aligner.state(), actuation_ms=command_tracker.stats()["actuation_ms"])
+
+
+def align_stats_event() -> dict:
+    """auto_align_state() para o /ui/ws: o navegador não precisa consultar o GET /align."""
+    return dict(auto_align_state(), type="align_stats")
+
+
+def parse_align_request(data: dict):
+    """{"tag_id": 3} começa, {"tag_id": null} cancela; ValueError se inválido."""
+    tag_id = data.get("tag_id")
+    if tag_id is None:
+        return None
+    try:
+        tag_id = int(tag_id)
+    except (TypeError, ValueError):
+        raise ValueError("tag_id precisa ser um número inteiro")
+    if tag_id < 0:
+        raise ValueError("tag_id precisa ser >= 0")
+    return tag_id
+
+
+def handle_align(tag_id):
+    if tag_id is None:
+        auto_aligner.cancel()
+    else:
+        auto_aligner.start(tag_id)
+
+
+# === MJPEG: codifica uma vez por degrau e distribui para todos os clientes ===
+class MjpegBroadcaster:
     """
-    Interface thread-safe para colocar um comando na fila do websocket.
-    Exemplo de cmd:
-      {"type": "button", "action": "UP"}
-      {"type": "apriltag", "id": 3, "center": [...], "corners": [...]}
+    Guarda o último frame capturado e, por degrau de resolução, o JPEG
+    correspondente. Cada degrau codifica um frame no máximo uma vez (e só se
+    algum cliente daquele degrau pedir), e os clientes dormem numa Condition
+    até existir um frame mais novo do que o último que receberam.
     """
-    global ws_loop, ws_command_queue
-    if ws_loop is None or ws_command_queue is None:
-        # ainda não inicializado / não conectado
-        return
 
-    def _put():
-        ws_command_queue.put_nowait(cmd)
+    def __init__(self, rungs: dict = MJPEG_RUNGS):
+        self.rungs = {name: dict(params) for name, params in rungs.items()}
+        self._cond = threading.Condition()
+        self._frame = None
+        self._seq = 0
+        self._listeners = []
+        self._rung_state = {
+            name: {"lock": threading.Lock(), "seq": 0, "part": None, "encoded_at": 0.0,
+                   "encoded": 0, "viewers": 0, "resized": None}
+            for name in self.rungs
+        }
 
-    # agendar dentro do loop asyncio
-    ws_loop.call_soon_threadsafe(_put)
+    @property
+    def viewers(self) -> int:
+        return sum(state["viewers"] for state in self._rung_state.values())
 
+    @property
+    def frames_encoded(self) -> int:
+        return sum(state["encoded"] for state in self._rung_state.values())
 
-def capture_loop():
-    global cap, latest_frame, last_tag_send_time
-    frame_idx = 0
-    while True:
-        ...
-        ret, frame = cap.read()
-        if not ret:
-            time.sleep(0.01)
-            continue
+    def rung_stats(self) -> dict:
+        return {name: {"viewers": state["viewers"], "encoded": state["encoded"], **self.rungs[name]}
+                for name, state in self._rung_state.items()}
 
-        frame = cv2.resize(frame, (WIDTH, HEIGHT))
+    def add_listener(self, callback):
+        """callback() é chamado (na thread da captura) a cada frame novo."""
+        self._listeners.append(callback)
 
-        # 1) primeiro guarda para o MJPEG não atrasar
-        with lock:
-            latest_frame = frame
+    def publish(self, buf: PooledFrame):
+        """Chamado pela captura: troca o frame atual e acorda os clientes."""
+        buf.retain()
+        with self._cond:
+            old, self._frame = self._frame, buf
+            self._seq += 1
+            self._cond.notify_all()
+        if old is not None:
+            old.release()
+        for callback in self._listeners:
+            callback()
+
+    def add_viewer(self, rung: str):
+        with self._cond:
+            self._rung_state[rung]["viewers"] += 1
+
+    def remove_viewer(self, rung: str):
+        with self._cond:
+            self._rung_state[rung]["viewers"] -= 1
+
+    def wait_jpeg(self, last_seq: int, timeout: float = 1.0, rung: str = None):
+        """
+        Bloqueia até haver um frame com seq > last_seq e devolve (seq, parte)
+        no degrau pedido (padrão: o maior), onde parte é o JPEG já embrulhado
+        no cabeçalho multipart. Em caso de timeout devolve (last_seq, None).
+        """
+        if rung is None:
+            rung = next(iter(self.rungs))
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > last_seq, timeout):
+                return last_seq, None
+            buf, seq = self._frame.retain(), self._seq
 
-        # 2) depois faz visão computacional, sem travar a captura
         try:
-            frame_idx += 1
-            if frame_idx % 3 != 0:
-                continue
+            return self._encode(buf.array, seq, rung, last_seq)
+        finally:
+            buf.release()
 
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            results = at_detector.detect(
-                gray,
-                estimate_tag_pose=False
-            )
-
-            if results:
-                now = time.time()
-                if now - last_tag_send_time > 0.5:
-                    last_tag_send_time = now
-                    for r in results:
-                        cmd = {
-                            "type": "apriltag",
-                            "id": int(r.tag_id),
-                            "center": [float(c) for c in r.center],
-                            "corners": [[float(x) for x in pt] for pt in r.corners],
-                            "family": getattr(r, "tag_family", "unknown"),
-                        }
-                        send_ws_command(cmd)
-        except Exception as e:
-            print("Erro na detecção de AprilTags:", e, flush=True)
+    def _encode(self, frame, seq: int, rung: str, last_seq: int):
+        # o primeiro cliente do degrau que chega codifica; os outros
+        # reaproveitam. Guarda a parte multipart inteira, então cada cliente
+        # só envia o mesmo objeto bytes, sem concatenar nem copiar nada.
+        params, state = self.rungs[rung], self._rung_state[rung]
+        with state["lock"]:
+            t0 = time.monotonic()
+            # clientes fora de fase não passam do max_fps do degrau: quem
+            # chega logo depois de um encode leva esse JPEG, se for novo para ele
+            recent = (state["seq"] > last_seq
+                      and t0 - state["encoded_at"] < 1.0 / params["max_fps"])
+            if state["seq"] < seq and not recent:
+                size = (params["width"], params["height"])
+                if (frame.shape[1], frame.shape[0]) != size:
+                    if state["resized"] is None:
+                        state["resized"] = np.empty((size[1], size[0], 3), dtype=np.uint8)
+                    cv2.resize(frame, size, dst=state["resized"], interpolation=cv2.INTER_AREA)
+                    frame = state["resized"]
+                ret, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, params["quality"]])
+                stage_seconds["jpeg_encode"].observe(time.monotonic() - t0)
+                if ret:
+                    state["part"] = (
+                        b"--frame\r\n"
+                        b"Content-Type: image/jpeg\r\n\r\n" + buffer.tobytes() + b"\r\n"
+                    )
+                    state["seq"] = seq
+                    state["encoded_at"] = t0
+                    state["encoded"] += 1
+            return state["seq"], state["part"]
+
+
+class RungSelector:
+    """
+    Escolha automática do degrau de um cliente pelo tempo que ele leva para
+    escoar cada frame: se o envio ocupa quase todo o intervalo entre frames
+    do degrau, o socket não está dando conta e desce; com folga por um tempo,
+    sobe de novo. Cada descida dobra a folga exigida para a próxima subida
+    (até 8x), para não ficar oscilando num link que só aguenta o degrau de baixo.
+    """
 
-        time.sleep(0.001)
+    EWMA_ALPHA = 0.2
+    MAX_BACKOFF = 8
 
+    def __init__(self, rungs, start: str = MJPEG_AUTO_START_RUNG,
+                 down_busy: float = MJPEG_AUTO_DOWN_BUSY, up_busy: float = MJPEG_AUTO_UP_BUSY,
+                 up_frames: int = MJPEG_AUTO_UP_FRAMES):
+        self.rungs = list(rungs)
+        self.index = self.rungs.index(start) if start in self.rungs else len(self.rungs) // 2
+        self.down_busy = down_busy
+        self.up_busy = up_busy
+        self.up_frames = up_frames
+        self.busy = None
+        self._calm = 0
+        self._backoff = 1
 
+    @property
+    def rung(self) -> str:
+        return self.rungs[self.index]
 
-def mjpeg_generator():
-    """Gera um stream MJPEG a partir do último frame capturado."""
-    while True:
-        frame = None
-        with lock:
-            if latest_frame is not None:
-                frame = latest_frame.copy()
+    def observe(self, send_time: float, interval: float) -> str:
+        """Registra o tempo de envio de um frame e devolve o degrau a usar."""
+        busy = send_time / interval
+        self.busy = busy if self.busy is None else (
+            self.EWMA_ALPHA * busy + (1 - self.EWMA_ALPHA) * self.busy)
 
-        if frame is None:
-            time.sleep(0.05)
-            continue
+        if self.busy > self.down_busy and self.index < len(self.rungs) - 1:
+            self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+            self._change(+1)
+        elif self.busy < self.up_busy:
+            self._calm += 1
+            if self._calm >= self.up_frames * self._backoff and self.index > 0:
+                self._change(-1)
+        else:
+            self._calm = 0
+        return self.rung
 
-        ret, buffer = cv2.imencode(".jpg", frame)
-        if not ret:
-            continue
+    def _change(self, step: int):
+        self.index += step
+        self.busy = None
+        self._calm = 0
+
+
+def parse_rung(value) -> str:
+    """Degrau pedido no ?rung= (padrão MJPEG_DEFAULT_RUNG); ValueError se não existir."""
+    rung = value or MJPEG_DEFAULT_RUNG
+    if rung != "auto" and rung not in MJPEG_RUNGS:
+        raise ValueError(f"degrau desconhecido: {rung} (use auto, {', '.join(MJPEG_RUNGS)})")
+    return rung
 
-        frame_bytes = buffer.tobytes()
 
-        yield (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + frame_bytes + b"\r\n"
-        )
-        time.sleep(0.01)
+mjpeg_broadcaster = MjpegBroadcaster()
+
+
+def mjpeg_generator(rung: str = MJPEG_DEFAULT_RUNG):
+    """Gera um stream MJPEG no degrau pedido (ou no escolhido pelo RungSelector)."""
+    selector = RungSelector(MJPEG_RUNGS) if rung == "auto" else None
+    if selector is not None:
+        rung = selector.rung
+    last_seq = 0
+    due = time.monotonic()
+    mjpeg_broadcaster.add_viewer(rung)
+    try:
+        while True:
+            # limita ao max_fps do degrau, sem acumular atraso
+            interval = 1.0 / MJPEG_RUNGS[rung]["max_fps"]
+            now = time.monotonic()
+            if due > now:
+                time.sleep(due - now)
+            due = max(due + interval, now - interval)
+
+            seq, part = mjpeg_broadcaster.wait_jpeg(last_seq, rung=rung)
+            if part is None:
+                continue
+            last_seq = seq
+
+            # o servidor só volta ao gerador depois de escrever a parte no socket
+            t0 = time.monotonic()
+            yield part
+            if selector is not None:
+                new_rung = selector.observe(time.monotonic() - t0, interval)
+                if new_rung != rung:
+                    mjpeg_broadcaster.remove_viewer(rung)
+                    mjpeg_broadcaster.add_viewer(new_rung)
+                    rung = new_rung
+    finally:
+        # o Flask fecha o gerador quando o navegador desconecta
+        mjpeg_broadcaster.remove_viewer(rung)
 
 
 @app.route("/video")
 def video():
+    """Stream MJPEG; ?rung=high|medium|low escolhe a resolução, auto (padrão) adapta à rede."""
+    try:
+        rung = parse_rung(request.args.get("rung"))
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
     return Response(
-        mjpeg_generator(),
+        mjpeg_generator(rung),
         mimetype="multipart/x-mixed-replace; boundary=frame"
     )
 
@@ -214,11 +2468,29 @@ INDEX_HTML = """
         margin-bottom: 20px;
       }
       .video-wrapper img {
-        max-width: 100%;
+        /* degraus menores são esticados para o mesmo tamanho na tela */
+        width: 100%;
         height: auto;
         border-radius: 8px;
         border: 2px solid #1e3a5f;
       }
+      .video-box {
+        position: relative;
+        display: block;
+      }
+      .video-box canvas {
+        position: absolute;
+        left: 0;
+        top: 0;
+        width: 100%;
+        height: 100%;
+        pointer-events: none;
+      }
+      .status {
+        text-align: center;
+        font-size: 14px;
+        margin-bottom: 10px;
+      }
       .controls {
         display: flex;
         gap: 20px;
@@ -226,7 +2498,7 @@ INDEX_HTML = """
         justify-content: center;
         margin-bottom: 20px;
       }
-      .dpad, .fork {
+      .dpad, .fork, .align {
         background: #102b46;
         padding: 15px;
         border-radius: 10px;
@@ -255,6 +2527,11 @@ INDEX_HTML = """
         box-shadow: 0 1px 0 #111;
         transform: translateY(3px);
       }
+      .stream-toggle {
+        display: block;
+        margin-top: 10px;
+        font-size: 14px;
+      }
       .fork button {
         width: 160px;
         height: 50px;
@@ -296,8 +2573,24 @@ INDEX_HTML = """
     <div class="container">
       <h1>Forklift Controller Interface</h1>
 
+      <div class="status">
+        Raspberry: <span id="pi-status">?</span> · Interface: <span id="ui-status">HTTP</span>
+        · Tags: <span id="tag-status">-</span>
+        <br>Comandos: <span id="cmd-latency">-</span>
+        · Vídeo:
+        <select id="video-rung" onchange="setVideoRung(this.value)">
+          <option value="auto">automático</option>
+          {% for rung in rungs %}
+          <option value="{{ rung }}">{{ rung }}</option>
+          {% endfor %}
+        </select>
+      </div>
+
       <div class="video-wrapper">
-        <img src="/video" alt="Video stream">
+        <div class="video-box">
+          <img id="video" src="video" alt="Video stream">
+          <canvas id="overlay"></canvas>
+        </div>
       </div>
 
       <div class="controls">
@@ -305,25 +2598,28 @@ INDEX_HTML = """
           <div class="dpad-grid">
               <!-- Linha acima: espaço, ROT_CCW, UP, ROT_CW, espaço -->
               <div></div>
-              <button class="ctrl-btn" onclick="sendAction('ROT_CCW')">⟲</button>
-              <button class="ctrl-btn" onclick="sendAction('UP')">⬆️</button>
-              <button class="ctrl-btn" onclick="sendAction('ROT_CW')">⟳</button>
+              <button class="ctrl-btn" data-drive="ROT_CCW" onclick="sendAction('ROT_CCW')">⟲</button>
+              <button class="ctrl-btn" data-drive="UP" onclick="sendAction('UP')">⬆️</button>
+              <button class="ctrl-btn" data-drive="ROT_CW" onclick="sendAction('ROT_CW')">⟳</button>
               <div></div>
 
               <!-- Linha do meio -->
               <div></div>
-              <button class="ctrl-btn" onclick="sendAction('LEFT')">⬅️</button>
-              <div></div>
-              <button class="ctrl-btn" onclick="sendAction('RIGHT')">➡️</button>
+              <button class="ctrl-btn" data-drive="LEFT" onclick="sendAction('LEFT')">⬅️</button>
+              <button class="ctrl-btn" onclick="sendAction('STOP')">⏹</button>
+              <button class="ctrl-btn" data-drive="RIGHT" onclick="sendAction('RIGHT')">➡️</button>
               <div></div>
 
               <!-- Linha de baixo -->
               <div></div>
               <div></div>
-              <button class="ctrl-btn" onclick="sendAction('DOWN')">⬇️</button>
+              <button class="ctrl-btn" data-drive="DOWN" onclick="sendAction('DOWN')">⬇️</button>
               <div></div>
               <div></div>
             </div>
+            <label class="stream-toggle">
+              <input type="checkbox" id="stream-mode"> Modo contínuo (segurar para andar)
+            </label>
 
         </div>
 
@@ -331,6 +2627,15 @@ INDEX_HTML = """
           <button class="ctrl-btn" style="width:160px;height:50px;" onclick="sendAction('FORK_UP')">FORK UP</button><br>
           <button class="ctrl-btn" style="width:160px;height:50px;" onclick="sendAction('FORK_DOWN')">FORK DOWN</button>
         </div>
+
+        <div class="align">
+          <div class="log-title">🎯 Alinhar com a tag</div>
+          <input type="number" id="align-tag" min="0" value="0" style="width:70px;">
+          <button class="clear-btn" onclick="sendAlign(document.getElementById('align-tag').value)">Alinhar</button>
+          <button class="clear-btn" onclick="sendAlign(null)">Cancelar</button>
+          <div class="stream-toggle">Estado: <span id="align-status">-</span></div>
+          <div class="stream-toggle" id="align-stats"></div>
+        </div>
       </div>
 
       <div class="log-box">
@@ -349,9 +2654,207 @@ INDEX_HTML = """
     </div>
 
     <script>
+      // modo contínuo: (linear, angular) de cada botão do d-pad
+      const DRIVE_VECTORS = {
+        UP: [1, 0], DOWN: [-1, 0],
+        LEFT: [0.6, 0.6], RIGHT: [0.6, -0.6],
+        ROT_CCW: [0, 1], ROT_CW: [0, -1],
+      };
+      const DRIVE_REFRESH_MS = 150;     // pelo HTTP
+      const DRIVE_REFRESH_WS_MS = 50;   // pelo websocket (20 Hz)
+      let driveTimer = null;
+
+      // websocket persistente: comandos sobem, log/estado/tags descem.
+      // Se cair (ou o servidor não tiver /ui/ws), os botões voltam para o fetch.
+      let uiWs = null;
+
+      function wsReady() {
+        return uiWs !== null && uiWs.readyState === WebSocket.OPEN;
+      }
+
+      function wsSend(msg) {
+        if (!wsReady()) return false;
+        uiWs.send(JSON.stringify(msg));
+        return true;
+      }
+
+      function connectUi() {
+        // URLs relativas: a mesma página serve / e /robots/<id>/ do modo frota
+        const url = new URL("ui/ws", location.href);
+        url.protocol = location.protocol === "https:" ? "wss:" : "ws:";
+        const ws = new WebSocket(url);
+        let opened = false;
+        ws.onopen = () => {
+          opened = true;
+          uiWs = ws;
+          document.getElementById("ui-status").textContent = "websocket";
+        };
+        ws.onmessage = (ev) => {
+          const msg = JSON.parse(ev.data);
+          if (msg.type === "log") updateLog(msg.log);
+          else if (msg.type === "pi") updatePi(msg);
+          else if (msg.type === "tags") drawTags(msg);
+          else if (msg.type === "align") updateAlign(msg);
+          else if (msg.type === "align_stats") showAlignStats(msg);
+          else if (msg.type === "latency") showLatency(msg);
+          else if (msg.type === "error") console.error("Servidor:", msg.error);
+        };
+        ws.onclose = async () => {
+          if (uiWs === ws) uiWs = null;
+          document.getElementById("ui-status").textContent = "HTTP";
+          if (!opened) {
+            // servidor sem /ui/ws (flask_sock não instalado): fica no HTTP
+            try {
+              if ((await fetch(new URL("ui/ws", location.href))).status === 404) return;
+            } catch (e) {
+              // servidor fora do ar: tenta de novo
+            }
+          }
+          setTimeout(connectUi, 2000);
+        };
+      }
+
+      // latência dos comandos medida pelos acks do Raspberry: chega pelo
+      // websocket; sem ele, lê pelo HTTP
+      function showLatency(data) {
+        const fmt = (p) => p === null ? "-" : p.toFixed(1);
+        document.getElementById("cmd-latency").textContent = data.one_way_ms.count
+          ? "ida p50 " + fmt(data.one_way_ms.p50) + " / p95 " + fmt(data.one_way_ms.p95) + " ms"
+            + " · ida e volta p50 " + fmt(data.rtt_ms.p50) + " ms"
+            + " · execução p50 " + fmt(data.exec_ms.p50) + " ms"
+          : "sem acks do Raspberry";
+      }
+
+      async function updateLatency() {
+        if (wsReady()) return;
+        try {
+          showLatency(await (await fetch("commands/latency")).json());
+        } catch (e) {
+          console.error("Erro ao ler latência:", e);
+        }
+      }
+      setInterval(updateLatency, 2000);
+
+      function updatePi(msg) {
+        document.getElementById("pi-status").textContent =
+          msg.connected ? "conectado (v" + msg.protocol + ")" : "desconectado";
+      }
+
+      function drawTags(msg) {
+        const canvas = document.getElementById("overlay");
+        const ctx = canvas.getContext("2d");
+        if (msg.width) {
+          canvas.width = msg.width;
+          canvas.height = msg.height;
+        }
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+        document.getElementById("tag-status").textContent = msg.tags.length
+          ? msg.tags.map(t => t.id).join(", ") + " (" + msg.age_ms + " ms)"
+          : "-";
+        ctx.strokeStyle = "#00ff66";
+        ctx.fillStyle = "#00ff66";
+        ctx.lineWidth = 3;
+        ctx.font = "24px Arial";
+        msg.tags.forEach(t => {
+          ctx.beginPath();
+          t.corners.forEach(([x, y], i) => i ? ctx.lineTo(x, y) : ctx.moveTo(x, y));
+          ctx.closePath();
+          ctx.stroke();
+          ctx.fillText(String(t.id), t.center[0], t.center[1]);
+        });
+      }
+
+      const ALIGN_STATUS = {
+        idle: "parado", aligning: "alinhando", waiting: "esperando a tag",
+        aligned: "alinhado", aborted: "interrompido", cancelled: "cancelado",
+      };
+
+      function updateAlign(msg) {
+        let text = ALIGN_STATUS[msg.status] || msg.status;
+        if (msg.tag_id !== null) text += " (tag " + msg.tag_id + ")";
+        if (msg.reason) text += ": " + msg.reason;
+        document.getElementById("align-status").textContent = text;
+      }
+
+      async function sendAlign(tagId) {
+        const tag_id = tagId === null ? null : parseInt(tagId, 10);
+        if (wsSend({ type: "align", tag_id })) return;
+        try {
+          const resp = await fetch("align", {
+            method: "POST",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({ tag_id })
+          });
+          updateAlign(await resp.json());
+        } catch (e) {
+          console.error("Erro no alinhamento:", e);
+        }
+      }
+
+      // a malha só é tão boa quanto o pipeline é rápido: frequência e latências
+      function showAlignStats(data) {
+        const fmt = (v) => v === null || v === undefined ? "-" : v.toFixed(0);
+        document.getElementById("align-stats").textContent =
+          "malha " + fmt(data.loop_hz) + " Hz · detecção " + fmt(data.detection_age_ms) + " ms"
+          + " · captura → motor p50 " + fmt(data.actuation_ms.p50) + " ms";
+      }
+
+      async function updateAlignStats() {
+        if (wsReady()) return;  // com o /ui/ws as medidas chegam por push
+        try {
+          showAlignStats(await (await fetch("align")).json());
+        } catch (e) {
+          console.error("Erro ao ler o alinhamento:", e);
+        }
+      }
+      setInterval(updateAlignStats, 2000);
+
+      function setVideoRung(rung) {
+        document.getElementById("video").src = "video?rung=" + encodeURIComponent(rung);
+      }
+
+      function streamMode() {
+        const box = document.getElementById("stream-mode");
+        return box && box.checked;
+      }
+
+      function postDrive(v, w) {
+        if (wsSend({ type: "drive", v, w })) return;
+        fetch("drive", {
+          method: "POST",
+          headers: {"Content-Type": "application/json"},
+          body: JSON.stringify({ v, w })
+        }).catch(e => console.error("Erro no setpoint:", e));
+      }
+
+      function driveStart(action) {
+        if (!streamMode()) return;
+        const [v, w] = DRIVE_VECTORS[action];
+        driveStop();
+        postDrive(v, w);
+        const period = wsReady() ? DRIVE_REFRESH_WS_MS : DRIVE_REFRESH_MS;
+        driveTimer = setInterval(() => postDrive(v, w), period);
+      }
+
+      function driveStop() {
+        if (driveTimer === null) return;
+        clearInterval(driveTimer);
+        driveTimer = null;
+        postDrive(0, 0);
+      }
+
+      document.querySelectorAll(".ctrl-btn[data-drive]").forEach(btn => {
+        btn.addEventListener("pointerdown", () => driveStart(btn.dataset.drive));
+        btn.addEventListener("pointerup", driveStop);
+        btn.addEventListener("pointerleave", driveStop);
+      });
+
       async function sendAction(action) {
+        if (streamMode() && DRIVE_VECTORS[action]) return;
+        // pelo websocket o log volta como evento, para todos os navegadores
+        if (wsSend({ type: "action", action })) return;
         try {
-          const resp = await fetch("/action", {
+          const resp = await fetch("action", {
             method: "POST",
             headers: {"Content-Type": "application/json"},
             body: JSON.stringify({ action })
@@ -366,8 +2869,9 @@ INDEX_HTML = """
       }
 
       async function clearLog() {
+        if (wsSend({ type: "clear_log" })) return;
         try {
-          const resp = await fetch("/clear_log", {
+          const resp = await fetch("clear_log", {
             method: "POST"
           });
           const data = await resp.json();
@@ -392,16 +2896,255 @@ INDEX_HTML = """
         });
         logDiv.innerHTML = html;
       }
+
+      connectUi();
     </script>
   </body>
 </html>
 """
 
 
+# === AÇÕES E ESTATÍSTICAS (compartilhadas pelo Flask e pelo async_server) ===
+def action_command(action):
+    """Mapeia a string de um botão para o comando WebSocket (None se desconhecida)."""
+    if action == "STOP":
+        return {"type": "button", "subtype": "move", "dir": "STOP"}
+    if action in ["UP", "DOWN", "LEFT", "RIGHT"]:
+        return {"type": "button", "subtype": "move", "dir": action}
+    if action == "FORK_UP":
+        return {"type": "button", "subtype": "fork", "action": "UP"}
+    if action == "FORK_DOWN":
+        return {"type": "button", "subtype": "fork", "action": "DOWN"}
+    if action == "ROT_CW":
+        return {"type": "button", "subtype": "rotate", "dir": "CW"}
+    if action == "ROT_CCW":
+        return {"type": "button", "subtype": "rotate", "dir": "CCW"}
+    return None
+
+
+def parse_drive_setpoint(data: dict):
+    """(linear, angular) limitados a [-1, 1]; ValueError se não forem números."""
+    try:
+        linear = max(-1.0, min(1.0, float(data.get("v", 0.0))))
+        angular = max(-1.0, min(1.0, float(data.get("w", 0.0))))
+    except (TypeError, ValueError):
+        raise ValueError("setpoint inválido")
+    return linear, angular
+
+
+def parse_time_range(args) -> tuple:
+    """
+    (início, fim, tipos, limite) dos parâmetros ?start=&end=&kinds=&limit=.
+    start/end em segundos epoch (padrão: último minuto); ValueError se inválidos.
+    """
+    try:
+        end = float(args.get("end") or time.time())
+        start = float(args.get("start") or end - 60.0)
+        limit = min(int(args.get("limit") or JOURNAL_QUERY_LIMIT), JOURNAL_QUERY_LIMIT)
+    except (TypeError, ValueError):
+        raise ValueError("start/end/limit inválidos")
+    if start > end:
+        raise ValueError("start maior que end")
+
+    kinds = None
+    if args.get("kinds"):
+        by_name = {name: kind for kind, name in journal_mod.KIND_NAMES.items()}
+        try:
+            kinds = {by_name[k.strip()] for k in args.get("kinds").split(",")}
+        except KeyError as e:
+            raise ValueError(f"tipo desconhecido: {e.args[0]}")
+    return start, end, kinds, limit
+
+
+def journal_query_data(start: float, end: float, kinds=None, limit: int = JOURNAL_QUERY_LIMIT,
+                       source: journal_mod.Journal = None) -> dict:
+    if source is None:
+        source = journal
+    events = []
+    for kind, mono, wall, payload in source.query(start, end, kinds, limit):
+        if kind == journal_mod.KIND_DETECTION:
+            data = tag_protocol.decode_batch(payload)
+        else:
+            data = json.loads(payload)
+        events.append({
+            "t": wall,
+            "mono": mono,
+            "kind": journal_mod.KIND_NAMES.get(kind, kind),
+            "data": data,
+        })
+    return {"start": start, "end": end, "count": len(events),
+            "truncated": len(events) >= limit, "events": events}
+
+
+def ws_stats_data(robot_link: RobotLink = None) -> dict:
+    robot_link = robot_link or link
+    return dict(robot_link.commands.stats(), connected=robot_link.connected)
+
+
+def capture_stats_data() -> dict:
+    if cap is None:
+        return {"backend": None}
+    return dict(cap.stats.as_dict(), backend=cap.name)
+
+
+# === MÉTRICAS (Prometheus) ===
+metrics_registry = metrics.Registry(prefix="forklift_")
+
+stage_seconds = {
+    stage: metrics_registry.histogram(
+        "stage_seconds", "Tempo gasto em cada etapa do pipeline", {"stage": stage})
+    for stage in ("capture_read", "resize", "grayscale", "detect", "jpeg_encode", "ws_send")
+}
+command_latency = {
+    phase: metrics_registry.histogram(
+        "command_latency_seconds",
+        "Comandos: ida, ida e volta, espera até o atuador começar, execução "
+        "e da captura do frame até o atuador (auto-alinhamento)",
+        {"phase": phase})
+    for phase in CommandLatencyTracker.PHASES
+}
+frames_captured = metrics_registry.counter(
+    "frames_captured_total", "Frames entregues pela captura")
+frames_skipped = metrics_registry.counter(
+    "frames_skipped_total", "Frames que o escalonador mandou pular na detecção")
+tags_detected = metrics_registry.counter(
+    "tags_detected_total", "Tags encontradas (soma de todos os frames)")
+metrics_registry.counter_func(
+    "ws_reconnects_total", "Conexões com o Raspberry perdidas ou recusadas",
+    lambda: link.reconnects)
+
+metrics_registry.counter_func(
+    "frames_dropped_total", "Frames descartados antes de serem usados",
+    lambda: cap.stats.frames_dropped if cap is not None else None, {"where": "decoder"})
+metrics_registry.counter_func(
+    "frames_dropped_total", "Frames descartados antes de serem usados",
+    lambda: detection_mailbox.dropped, {"where": "detection_mailbox"})
+metrics_registry.counter_func(
+    "frames_dropped_total", "Frames descartados antes de serem usados",
+    lambda: detection_pool.dropped if detection_pool is not None else None,
+    {"where": "detection_pool"})
+metrics_registry.counter_func(
+    "commands_queued_total", "Comandos colocados na fila do websocket",
+    lambda: link.commands.enqueued)
+metrics_registry.counter_func(
+    "commands_sent_total", "Comandos tirados da fila para envio",
+    lambda: link.commands.delivered)
+for _reason in ("expired", "overflow", "coalesced", "preempted"):
+    metrics_registry.counter_func(
+        "commands_dropped_total", "Comandos descartados pela fila, por motivo",
+        lambda r=_reason: link.commands.dropped[r],
+        {"reason": _reason})
+metrics_registry.gauge_func(
+    "command_queue_depth", "Comandos esperando na fila do websocket",
+    lambda: link.commands.depth())
+for _rung in MJPEG_RUNGS:
+    metrics_registry.gauge_func(
+        "mjpeg_viewers", "Clientes conectados no /video, por degrau",
+        lambda r=_rung: mjpeg_broadcaster.rung_stats()[r]["viewers"], {"rung": _rung})
+    metrics_registry.counter_func(
+        "mjpeg_frames_encoded_total", "Frames codificados em JPEG, por degrau",
+        lambda r=_rung: mjpeg_broadcaster.rung_stats()[r]["encoded"], {"rung": _rung})
+metrics_registry.gauge_func(
+    "capture_buffer_lag_seconds", "Atraso acumulado no buffer da captura (EWMA)",
+    lambda: cap.stats.buffer_lag if cap is not None else None)
+metrics_registry.gauge_func(
+    "video_level", "Degrau de VIDEO_LADDER em uso no Raspberry (0 = melhor)",
+    lambda: video_controller.level)
+metrics_registry.counter_func(
+    "video_reconfigurations_total", "Vezes que o rpicam-vid foi reiniciado com outra configuração",
+    lambda: video_controller.reconfigurations)
+metrics_registry.counter_func(
+    "capture_stalls_total", "Intervalos entre frames acima de VIDEO_STALL_GAP_S",
+    lambda: cap.stats.stalls if cap is not None else None)
+metrics_registry.gauge_func(
+    "align_loop_hz", "Frequência medida da malha de auto-alinhamento",
+    lambda: auto_aligner.loop_hz if auto_aligner.active else None)
+metrics_registry.gauge_func(
+    "align_detection_age_seconds", "Idade da detecção ao virar setpoint do auto-alinhamento (EWMA)",
+    lambda: auto_aligner.detection_age)
+metrics_registry.gauge_func(
+    "ws_connected", "1 se o websocket com o Raspberry está conectado", lambda: int(link.connected))
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    """Métricas no formato texto do Prometheus."""
+    return Response(metrics_registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/commands/latency", methods=["GET"])
+def commands_latency():
+    """Percentis de latência dos comandos (pelos acks do Raspberry) e offset dos relógios."""
+    return jsonify(command_tracker.stats())
+
+
+@app.route("/ws/stats", methods=["GET"])
+def ws_stats():
+    """Profundidade da fila de comandos e quantos foram descartados (e por quê)."""
+    return jsonify(ws_stats_data())
+
+
+@app.route("/capture/stats", methods=["GET"])
+def capture_stats():
+    """Frames decodificados/entregues/descartados e atraso medido da captura."""
+    return jsonify(capture_stats_data())
+
+
+@app.route("/align", methods=["GET", "POST"])
+def align():
+    """
+    Auto-alinhamento: POST {"tag_id": 3} começa, {"tag_id": null} cancela.
+    GET devolve o estado, a frequência real da malha e a latência captura -> atuador.
+    """
+    if request.method == "POST":
+        try:
+            handle_align(parse_align_request(request.get_json(silent=True) or {}))
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify(auto_align_state())
+
+
+@app.route("/video/control", methods=["GET"])
+def video_control_state():
+    """Configuração atual do rpicam-vid, degrau da escada e motivo da última troca."""
+    return jsonify(video_controller.state())
+
+
+@app.route("/frame_pool/stats", methods=["GET"])
+def frame_pool_stats():
+    """Buffers do pool em uso e memória de pico."""
+    return jsonify(frame_pool.stats())
+
+
+@app.route("/detection/scheduler", methods=["GET"])
+def detection_scheduler_state():
+    """Decisões atuais do escalonador de detecção e o motivo da última mudança."""
+    return jsonify(detection_scheduler.state())
+
+
+@app.route("/journal", methods=["GET"])
+def journal_query():
+    """
+    Eventos do diário num intervalo: /journal?start=<epoch>&end=<epoch>&kinds=action,command
+    (detecções vêm decodificadas). Sem start/end devolve o último minuto.
+    """
+    try:
+        start, end, kinds, limit = parse_time_range(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify(journal_query_data(start, end, kinds, limit))
+
+
+@app.route("/journal/stats", methods=["GET"])
+def journal_stats():
+    """Segmentos, registros gravados e descartados pelo diário."""
+    return jsonify(journal.stats())
+
+
 @app.route("/", methods=["GET"])
 def index():
     # manda o log já em ordem reversa para aparecer mais recente em cima
-    return render_template_string(INDEX_HTML, log=list(reversed(actions_log)))
+    return render_template_string(INDEX_HTML, log=list(reversed(actions_log)), rungs=list(MJPEG_RUNGS))
 
 
 @app.route("/action", methods=["POST"])
@@ -410,49 +3153,147 @@ def action():
     Quando o usuário clica nos botões, em vez de só dar print,
     mandamos um comando via WebSocket para o Raspberry.
     """
-    global actions_log
     data = request.get_json(silent=True) or {}
-    action = data.get("action")
+    log = link.handle_action(data.get("action"))
+    return jsonify({"ok": True, "log": log})
 
-    if action:
-        actions_log.append(action)
-        actions_log = actions_log[-10:]
-
-        # mapeia strings dos botões para comandos WebSocket
-        if action in ["UP", "DOWN", "LEFT", "RIGHT"]:
-            cmd = {"type": "button", "subtype": "move", "dir": action}
-            send_ws_command(cmd)
-        elif action == "FORK_UP":
-            cmd = {"type": "button", "subtype": "fork", "action": "UP"}
-            send_ws_command(cmd)
-        elif action == "FORK_DOWN":
-            cmd = {"type": "button", "subtype": "fork", "action": "DOWN"}
-            send_ws_command(cmd)
-        elif action == "ROT_CW":
-            cmd = {"type": "button", "subtype": "rotate", "dir": "CW"}
-            send_ws_command(cmd)
-        elif action == "ROT_CCW":
-            cmd = {"type": "button", "subtype": "rotate", "dir": "CCW"}
-            send_ws_command(cmd)
 
+@app.route("/drive", methods=["POST"])
+def drive():
+    """
+    Modo contínuo: {"v": linear, "w": angular} em [-1, 1].
+    O navegador reenvia enquanto o botão está pressionado e manda zero ao soltar.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        linear, angular = parse_drive_setpoint(data)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
 
-    return jsonify({"ok": True, "log": list(reversed(actions_log))})
+    link.set_drive_setpoint(linear, angular)
+    return jsonify({"ok": True})
 
 
 @app.route("/clear_log", methods=["POST"])
 def clear_log():
-    global actions_log
-    actions_log = []
+    link.clear_log()
     return jsonify({"ok": True, "log": []})
 
 
+if sock is not None:
+    @sock.route("/ui/ws")
+    def ui_ws(ws):
+        """
+        Websocket persistente do navegador: botões sobem, log/estado/tags descem.
+        Uma thread por navegador (e não uma requisição por clique).
+        """
+        events = queue.Queue(maxsize=UI_CLIENT_QUEUE_MAX)
+        send_lock = threading.Lock()
+
+        def push(event):
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                pass  # navegador lento: perde eventos, o próximo traz o estado atual
+
+        def send(event):
+            with send_lock:
+                ws.send(json.dumps(event))
+
+        def reader():
+            # bloqueia no receive(); a thread principal bloqueia na fila
+            try:
+                while True:
+                    message = ws.receive()
+                    try:
+                        data = json.loads(message)
+                    except (TypeError, ValueError):
+                        data = {}
+                    reply = link.handle_ui_message(data if isinstance(data, dict) else {})
+                    if reply is not None:
+                        send(reply)
+            except Exception:
+                pass  # conexão fechada
+            finally:
+                # acorda a thread principal mesmo com a fila cheia
+                while True:
+                    try:
+                        events.put_nowait(None)
+                        break
+                    except queue.Full:
+                        try:
+                            events.get_nowait()
+                        except queue.Empty:
+                            pass
+
+        for event in ui_snapshot():
+            send(event)
+        ui_events.subscribe(push)
+        threading.Thread(target=reader, daemon=True).start()
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    break
+                send(event)
+        finally:
+            ui_events.unsubscribe(push)
+
+
+def start_vision():
+    """Sobe detecção e captura."""
+    global cap, capture_thread, roi_tracker
+
+    if DETECTION_MODE == "process":
+        start_detection_pool()
+
+    # inicia thread de detecção de AprilTags
+    if detection_pool is None:
+        if TRACKING_ENABLED:
+            roi_tracker = make_roi_tracker()
+        t_det = threading.Thread(target=detection_loop, daemon=True)
+        t_det.start()
+
+    # inicia thread de captura de vídeo
+    cap = open_capture(CAPTURE_BACKEND, REPLAY_PATH if CAPTURE_BACKEND == "replay" else UDP_URL)
+    capture_thread = threading.Thread(target=capture_loop, daemon=True)
+    capture_thread.start()
+
+    if VIDEO_CONTROL_ENABLED:
+        threading.Thread(target=video_control_loop, daemon=True).start()
+    threading.Thread(target=auto_align_loop, daemon=True).start()
+
+
+def stop_vision():
+    """
+    Para a captura e fecha o stream (a gravação do RECORD_PATH só fecha
+    aqui); no modo "process" encerra os processos e solta a memória
+    compartilhada do pool.
+    """
+    vision_stop.set()
+    if capture_thread is not None:
+        capture_thread.join(timeout=2)
+    if cap is not None:
+        cap.release()
+    if detection_pool is not None:
+        detection_pool.stop()
+
+
 if __name__ == "__main__":
+    # captura e detecção
+    start_vision()
+
+    # diário em disco
+    if JOURNAL_ENABLED:
+        journal.start()
+
     # inicia o websocket para comandos
     start_ws_thread()
 
-    # inicia thread de captura de vídeo
-    t = threading.Thread(target=capture_loop, daemon=True)
-    t.start()
-
     # inicia o Flask
-    app.run(host="0.0.0.0", port=8000, debug=False, threaded=True)
+    try:
+        app.run(host="0.0.0.0", port=8000, debug=False, threaded=True)
+    finally:
+        stop_vision()
+        if JOURNAL_ENABLED:
+            journal.stop()
@@ -0,0 +1,305 @@
+"""
+Modo asyncio do servidor, com aiohttp no lugar do Flask com threaded=True.
+
+As rotas do app_server (/, /video, /action, /drive, /clear_log, /align e as de
+estatísticas) e o websocket para o Raspberry rodam todos no mesmo event
+loop: cada viewer do MJPEG é uma corrotina, não uma thread. A captura e a
+detecção continuam nas suas threads e entregam frames/comandos ao loop
+com call_soon_threadsafe.
+
+Uso: python async_server.py
+"""
+import asyncio
+import time
+
+import jinja2
+from aiohttp import web
+
+import app_server as core
+
+HOST = "0.0.0.0"
+PORT = 8000
+
+# mesmo comportamento do render_template_string do Flask (autoescape ligado)
+INDEX_TEMPLATE = jinja2.Environment(autoescape=True).from_string(core.INDEX_HTML)
+
+
+class MjpegHub:
+    """
+    Ponte entre o MjpegBroadcaster (threads) e os viewers (corrotinas).
+
+    A captura avisa o loop a cada frame novo; para cada degrau com alguém
+    assistindo (e dentro do max_fps dele) o frame é codificado uma vez num
+    executor e os viewers daquele degrau acordam numa asyncio.Condition para
+    mandar a mesma parte multipart.
+    """
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.viewers = {rung: 0 for rung in broadcaster.rungs}
+        self.parts = {rung: (0, None) for rung in broadcaster.rungs}
+        self._due = {rung: 0.0 for rung in broadcaster.rungs}
+        self._loop = None
+        self._new_frame = None
+        self._cond = None
+
+    def attach(self, loop):
+        self._loop = loop
+        self._new_frame = asyncio.Event()
+        self._cond = asyncio.Condition()
+        self.broadcaster.add_listener(self._on_frame)
+
+    def _on_frame(self):
+        # roda na thread da captura
+        try:
+            self._loop.call_soon_threadsafe(self._new_frame.set)
+        except RuntimeError:
+            pass  # loop já encerrado
+
+    def add_viewer(self, rung: str):
+        self.viewers[rung] += 1
+        self.broadcaster.add_viewer(rung)
+
+    def remove_viewer(self, rung: str):
+        self.viewers[rung] -= 1
+        self.broadcaster.remove_viewer(rung)
+
+    async def _encode(self, rung: str):
+        seq, part = await self._loop.run_in_executor(
+            None, self.broadcaster.wait_jpeg, self.parts[rung][0], 0, rung)
+        if part is None:
+            return
+        async with self._cond:
+            self.parts[rung] = (seq, part)
+            self._cond.notify_all()
+
+    async def run(self):
+        while True:
+            await self._new_frame.wait()
+            self._new_frame.clear()
+
+            now = time.monotonic()
+            rungs = []
+            for rung, viewers in self.viewers.items():
+                if viewers == 0 or now < self._due[rung]:
+                    continue
+                interval = 1.0 / self.broadcaster.rungs[rung]["max_fps"]
+                self._due[rung] = max(self._due[rung] + interval, now - interval)
+                rungs.append(rung)
+            if rungs:
+                # degraus diferentes codificam em paralelo (o OpenCV solta o GIL)
+                await asyncio.gather(*(self._encode(rung) for rung in rungs))
+
+    async def next_part(self, last_seq: int, rung: str):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.parts[rung][0] > last_seq)
+            return self.parts[rung]
+
+
+hub = MjpegHub(core.mjpeg_broadcaster)
+
+
+async def index(request):
+    html = INDEX_TEMPLATE.render(log=list(reversed(core.actions_log)), rungs=list(core.MJPEG_RUNGS))
+    return web.Response(text=html, content_type="text/html")
+
+
+async def video(request):
+    try:
+        rung = core.parse_rung(request.query.get("rung"))
+    except ValueError as e:
+        return web.json_response({"ok": False, "error": str(e)}, status=400)
+    resp = web.StreamResponse(
+        headers={"Content-Type": "multipart/x-mixed-replace; boundary=frame"})
+    await resp.prepare(request)
+
+    selector = core.RungSelector(core.MJPEG_RUNGS) if rung == "auto" else None
+    if selector is not None:
+        rung = selector.rung
+    hub.add_viewer(rung)
+    try:
+        last_seq = 0
+        while True:
+            # cliente lento só perde frames: sempre recebe o mais novo
+            last_seq, part = await hub.next_part(last_seq, rung)
+            t0 = time.monotonic()
+            await resp.write(part)  # espera o socket escoar quando o buffer enche
+            if selector is not None:
+                interval = 1.0 / core.MJPEG_RUNGS[rung]["max_fps"]
+                new_rung = selector.observe(time.monotonic() - t0, interval)
+                if new_rung != rung:
+                    hub.remove_viewer(rung)
+                    hub.add_viewer(new_rung)
+                    rung = new_rung
+    except ConnectionResetError:
+        # cliente saiu; o CancelledError (desconexão, shutdown) segue para o aiohttp
+        pass
+    finally:
+        hub.remove_viewer(rung)
+    return resp
+
+
+async def json_body(request) -> dict:
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+async def action(request):
+    data = await json_body(request)
+    log = core.link.handle_action(data.get("action"))
+    return web.json_response({"ok": True, "log": log})
+
+
+async def drive(request):
+    data = await json_body(request)
+    try:
+        linear, angular = core.parse_drive_setpoint(data)
+    except ValueError as e:
+        return web.json_response({"ok": False, "error": str(e)}, status=400)
+    core.link.set_drive_setpoint(linear, angular)
+    return web.json_response({"ok": True})
+
+
+async def align(request):
+    if request.method == "POST":
+        try:
+            core.handle_align(core.parse_align_request(await json_body(request)))
+        except ValueError as e:
+            return web.json_response({"ok": False, "error": str(e)}, status=400)
+    return web.json_response(core.auto_align_state())
+
+
+async def clear_log(request):
+    core.link.clear_log()
+    return web.json_response({"ok": True, "log": []})
+
+
+def make_ui_ws(snapshot, bus, on_message):
+    """
+    Handler do websocket persistente do navegador (mesmas mensagens do /ui/ws
+    do Flask): snapshot() dá o estado inicial, bus é o UiEventBus e
+    on_message(dict) trata o que o navegador manda. O fleet.py usa um por robô.
+    """
+    async def ui_ws(request):
+        ws = web.WebSocketResponse(heartbeat=20)
+        await ws.prepare(request)
+
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue(maxsize=core.UI_CLIENT_QUEUE_MAX)
+
+        def enqueue(event):
+            if events.full():
+                return  # navegador lento: perde eventos, o próximo traz o estado atual
+            events.put_nowait(event)
+
+        def push(event):
+            # publish() pode vir da captura/detecção, então passa pelo loop
+            try:
+                loop.call_soon_threadsafe(enqueue, event)
+            except RuntimeError:
+                pass  # loop já encerrado
+
+        async def sender():
+            while True:
+                await ws.send_json(await events.get())
+
+        for event in snapshot():
+            await ws.send_json(event)
+        bus.subscribe(push)
+        sender_task = loop.create_task(sender())
+        try:
+            async for msg in ws:
+                if msg.type != web.WSMsgType.TEXT:
+                    continue
+                try:
+                    data = msg.json()
+                except ValueError:
+                    data = {}
+                reply = on_message(data if isinstance(data, dict) else {})
+                if reply is not None:
+                    await ws.send_json(reply)
+        finally:
+            bus.unsubscribe(push)
+            sender_task.cancel()
+        return ws
+    return ui_ws
+
+
+async def journal_query(request):
+    try:
+        start, end, kinds, limit = core.parse_time_range(request.query)
+    except ValueError as e:
+        return web.json_response({"ok": False, "error": str(e)}, status=400)
+    # leitura dos segmentos (mmap) fora do loop
+    data = await asyncio.get_running_loop().run_in_executor(
+        None, core.journal_query_data, start, end, kinds, limit)
+    return web.json_response(data)
+
+
+async def metrics_route(request):
+    return web.Response(body=core.metrics_registry.render().encode(),
+                        headers={"Content-Type": core.metrics.CONTENT_TYPE})
+
+
+def stats_route(provider):
+    async def handler(request):
+        return web.json_response(provider())
+    return handler
+
+
+async def on_startup(app):
+    loop = asyncio.get_running_loop()
+    # o link roda neste loop; send_ws_command() das threads de detecção agenda aqui
+    hub.attach(loop)
+    app["tasks"] = [
+        loop.create_task(core.link.run(core.RASPBERRY_WS_URL)),
+        loop.create_task(core.link.drive_streamer()),
+        loop.create_task(hub.run()),
+    ]
+
+
+async def on_cleanup(app):
+    for task in app["tasks"]:
+        task.cancel()
+    await asyncio.gather(*app["tasks"], return_exceptions=True)
+
+
+def make_app() -> web.Application:
+    app = web.Application()
+    app.add_routes([
+        web.get("/", index),
+        web.get("/video", video),
+        web.post("/action", action),
+        web.post("/drive", drive),
+        web.post("/clear_log", clear_log),
+        web.get("/align", align),
+        web.post("/align", align),
+        web.get("/ui/ws", make_ui_ws(core.ui_snapshot, core.ui_events, core.link.handle_ui_message)),
+        web.get("/ws/stats", stats_route(core.ws_stats_data)),
+        web.get("/capture/stats", stats_route(core.capture_stats_data)),
+        web.get("/frame_pool/stats", stats_route(core.frame_pool.stats)),
+        web.get("/detection/scheduler", stats_route(lambda: core.detection_scheduler.state())),
+        web.get("/video/control", stats_route(core.video_controller.state)),
+        web.get("/metrics", metrics_route),
+        web.get("/commands/latency", stats_route(core.command_tracker.stats)),
+        web.get("/journal", journal_query),
+        web.get("/journal/stats", stats_route(core.journal.stats)),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    core.start_vision()
+    if core.JOURNAL_ENABLED:
+        core.journal.start()
+    try:
+        web.run_app(make_app(), host=HOST, port=PORT)
+    finally:
+        core.stop_vision()
+        if core.JOURNAL_ENABLED:
+            core.journal.stop()
@@ -0,0 +1,505 @@
+"""
+Benchmarks do servidor sem robô nem câmera.
+
+Gera cenas sintéticas 1280x720 com tags tag36h11 (tamanho, quantidade,
+rotação, desfoque e movimento controlados) e sobe um Raspberry falso que
+fala o protocolo do raspberry_control.py. Mede:
+
+  detect   detecções/s e recall do detector configurado, por cenário
+  latency  captura -> comando chegando no Raspberry (percentis), com o
+           pipeline real (capture_loop, detecção, link.run)
+  queue    rajadas de comandos na fila do link: entregues, descartados
+           (e por quê) e atraso até o Raspberry
+  video    vazão do /video com 1, 5 e 20 clientes simultâneos
+
+Os resultados vão em JSON para bench_output.txt (ou --output), junto com
+o commit e a configuração, para comparar versões.
+
+Uso: python bench.py [--quick] [--only detect,latency,queue,video] [--output arquivo]
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+import websockets
+
+import app_server as core
+import tag_protocol
+
+_DICT = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+
+
+# === CENAS SINTÉTICAS ===
+def render_tag(tag_id: int, size: int, angle: float = 0.0):
+    """Tag com borda branca (quiet zone), girada; devolve (imagem, máscara)."""
+    marker = cv2.aruco.generateImageMarker(_DICT, tag_id, size)
+    pad = max(2, size // 8)
+    marker = cv2.copyMakeBorder(marker, pad, pad, pad, pad, cv2.BORDER_CONSTANT, value=255)
+    side = marker.shape[0]
+    if not angle:
+        return marker, np.full_like(marker, 255)
+
+    # cabe girada em qualquer ângulo
+    out = int(np.ceil(side * 1.5))
+    m = cv2.getRotationMatrix2D((side / 2, side / 2), angle, 1.0)
+    m[:, 2] += (out - side) / 2
+    img = cv2.warpAffine(marker, m, (out, out), flags=cv2.INTER_LINEAR, borderValue=255)
+    mask = cv2.warpAffine(np.full_like(marker, 255), m, (out, out), flags=cv2.INTER_NEAREST)
+    return img, mask
+
+
+def render_scene(tags, width: int = 1280, height: int = 720, blur: float = 0.0,
+                 motion: int = 0, noise: float = 0.0, seed: int = 0):
+    """
+    tags: lista de dicts {"id", "x", "y", "size", "angle"} (x, y = centro).
+    blur: sigma do desfoque gaussiano; motion: comprimento (px) do borrão
+    horizontal de movimento; noise: desvio do ruído. Devolve BGR.
+    """
+    rng = np.random.default_rng(seed)
+    gray = np.full((height, width), 170, np.uint8)
+    for t in tags:
+        img, mask = render_tag(t["id"], t["size"], t.get("angle", 0.0))
+        h, w = img.shape
+        x0, y0 = int(t["x"] - w / 2), int(t["y"] - h / 2)
+        if x0 < 0 or y0 < 0 or x0 + w > width or y0 + h > height:
+            continue
+        roi = gray[y0:y0 + h, x0:x0 + w]
+        np.copyto(roi, img, where=mask > 0)
+
+    if motion > 1:
+        kernel = np.zeros((motion, motion), np.float32)
+        kernel[motion // 2, :] = 1.0 / motion
+        gray = cv2.filter2D(gray, -1, kernel)
+    if blur > 0:
+        gray = cv2.GaussianBlur(gray, (0, 0), blur)
+    if noise > 0:
+        gray = np.clip(gray + rng.normal(0, noise, gray.shape), 0, 255).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def scenario_frames(count: int, frames: int, size: int, angle: float = 0.0,
+                    speed: float = 0.0, seed: int = 0, **effects):
+    """
+    Sequência determinística: 'count' tags em grade, andando 'speed' px por
+    frame na horizontal. Devolve [(frame BGR, ids esperados)].
+    """
+    rng = np.random.default_rng(seed)
+    cols = int(np.ceil(np.sqrt(count * 16 / 9)))
+    rows = int(np.ceil(count / cols))
+    cell_w, cell_h = 1280 / cols, 720 / rows
+    base = [
+        {"id": int(i), "x": (i % cols + 0.5) * cell_w, "y": (i // cols + 0.5) * cell_h,
+         "size": size, "angle": angle}
+        for i in range(count)
+    ]
+    out = []
+    for f in range(frames):
+        jitter = rng.uniform(-2, 2, size=(count, 2))
+        tags = [dict(t, x=t["x"] + ((speed * f) % (cell_w / 2)) + j[0], y=t["y"] + j[1])
+                for t, j in zip(base, jitter)]
+        out.append((render_scene(tags, seed=seed + f, **effects), {t["id"] for t in tags}))
+    return out
+
+
+DETECT_SCENARIOS = [
+    ("1 tag 160px", dict(count=1, size=160)),
+    ("4 tags 100px", dict(count=4, size=100)),
+    ("12 tags 60px", dict(count=12, size=60)),
+    ("4 tags 32px (longe)", dict(count=4, size=32)),
+    ("4 tags 100px girados 30°", dict(count=4, size=100, angle=30.0)),
+    ("4 tags 100px desfoque 1.5", dict(count=4, size=100, blur=1.5)),
+    ("4 tags 100px movimento 9px", dict(count=4, size=100, motion=9, speed=12.0)),
+    ("4 tags 100px ruído 12", dict(count=4, size=100, noise=12.0)),
+]
+
+
+class SyntheticCapture:
+    """Backend de captura que repete frames sintéticos pré-renderizados no ritmo fps."""
+
+    name = "synthetic"
+
+    def __init__(self, frames, fps: float = 30.0):
+        self.frames = frames
+        self.period = 1.0 / fps
+        self.stats = core.CaptureStats()
+        self._i = 0
+        self._next = time.monotonic()
+
+    def read(self, out=None):
+        delay = self._next - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next = max(self._next + self.period, time.monotonic() - self.period)
+
+        frame = self.frames[self._i % len(self.frames)]
+        info = core.FrameInfo(pts=self._i * self.period, arrival_time=time.monotonic())
+        self._i += 1
+        if out is not None and out.shape == frame.shape:
+            np.copyto(out, frame)
+            frame = out
+        self.stats.on_decoded(info)
+        self.stats.on_delivered(info)
+        return True, frame, info
+
+    def release(self):
+        pass
+
+
+# === RASPBERRY FALSO ===
+class FakeRaspberry:
+    """
+    Servidor websocket que responde como o raspberry_control.py: negocia o
+    protocolo no hello e aceita comandos JSON e lotes binários, guardando
+    cada mensagem com o instante (time.time()) em que chegou.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 protocol: int = tag_protocol.PROTOCOL_BINARY):
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.messages = []   # (chegada, dict)
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    async def _handler(self, websocket):
+        self.connections += 1
+        async for message in websocket:
+            now = time.time()
+            if isinstance(message, bytes):
+                data = tag_protocol.decode_batch(message)
+            else:
+                data = json.loads(message)
+                if data.get("type") == "hello":
+                    version = min(self.protocol, tag_protocol.choose_protocol(data.get("protocols")))
+                    await websocket.send(json.dumps({"type": "hello", "protocol": version}))
+                    continue
+            with self._lock:
+                self.messages.append((now, data))
+
+    def start(self):
+        def runner():
+            async def main():
+                async with websockets.serve(self._handler, self.host, self.port) as server:
+                    self.port = server.sockets[0].getsockname()[1]
+                    self._ready.set()
+                    await asyncio.Future()
+            asyncio.run(main())
+
+        threading.Thread(target=runner, daemon=True).start()
+        self._ready.wait(5)
+
+    def take(self):
+        with self._lock:
+            messages, self.messages = self.messages, []
+        return messages
+
+
+# === MEDIÇÕES ===
+def percentiles(values, ps=(50, 90, 95, 99)) -> dict:
+    if not values:
+        return {f"p{p}": None for p in ps}
+    arr = np.asarray(values, dtype=np.float64)
+    return {f"p{p}": float(np.percentile(arr, p)) for p in ps}
+
+
+def bench_detect(frames_per_scenario: int) -> list:
+    detector = core.at_detector
+    gray = np.empty((720, 1280), np.uint8)
+    results = []
+    for name, params in DETECT_SCENARIOS:
+        frames = scenario_frames(frames=frames_per_scenario, seed=1, **params)
+        found = expected = 0
+        times = []
+        for frame, ids in frames:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+            t0 = time.perf_counter()
+            dets = detector.detect(gray, estimate_tag_pose=False)
+            times.append(time.perf_counter() - t0)
+            found += len(ids & {int(d.tag_id) for d in dets})
+            expected += len(ids)
+        total = sum(times)
+        results.append({
+            "scenario": name,
+            "frames": len(frames),
+            "detections_per_s": len(frames) / total if total else None,
+            "tags_per_s": found / total if total else None,
+            "recall": found / expected if expected else None,
+            "detect_ms": {k: v * 1000 for k, v in percentiles(times).items()},
+        })
+        print(f"[BENCH] detect {name}: {results[-1]['detections_per_s']:.1f} frames/s, "
+              f"recall {results[-1]['recall']:.2f}", flush=True)
+    return results
+
+
+def start_pipeline(fake: FakeRaspberry, frames) -> None:
+    """Sobe captura sintética, detecção e o link apontando para o Raspberry falso."""
+    core.RASPBERRY_WS_URL = fake.url
+    core.journal.directory = tempfile.mkdtemp(prefix="bench-journal-")
+    core.journal.start()
+    core.cap = SyntheticCapture(frames)
+    threading.Thread(target=core.detection_loop, daemon=True).start()
+    threading.Thread(target=core.capture_loop, daemon=True).start()
+    core.start_ws_thread()
+
+    deadline = time.monotonic() + 10
+    while not core.link.connected and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if not core.link.connected:
+        raise RuntimeError("o link não conectou no Raspberry falso")
+
+
+def bench_latency(fake: FakeRaspberry, duration: float) -> dict:
+    fake.take()
+    t0 = time.monotonic()
+    det0 = core.capture_stats_data()["frames_delivered"]
+    time.sleep(duration)
+    elapsed = time.monotonic() - t0
+    messages = fake.take()
+
+    latencies = [now - data["timestamp"] for now, data in messages
+                 if data.get("type") == "apriltag_batch"]
+    state = core.detection_scheduler.state()
+    result = {
+        "duration_s": elapsed,
+        "protocol": core.link.protocol,
+        "capture_fps": (core.capture_stats_data()["frames_delivered"] - det0) / elapsed,
+        "batches_received": len(latencies),
+        "capture_to_command_ms": {k: (v * 1000 if v is not None else None)
+                                  for k, v in percentiles(latencies).items()},
+        "scheduler": state,
+    }
+    print(f"[BENCH] latency: {len(latencies)} lotes, p50 "
+          f"{result['capture_to_command_ms']['p50']} ms", flush=True)
+    return result
+
+
+def _collect(fake: FakeRaspberry, until=None, quiet_s: float = 0.3, timeout: float = 10.0):
+    """Junta as mensagens de benchmark até 'until' ser visto ou ficar quiet_s sem nada."""
+    received = []
+    deadline = time.monotonic() + timeout
+    last = time.monotonic()
+    while time.monotonic() < deadline:
+        new = [(now, d) for now, d in fake.take() if "bench_seq" in d]
+        if new:
+            received += new
+            last = time.monotonic()
+            if until is not None and any(until(d) for _, d in new):
+                break
+        elif time.monotonic() - last > quiet_s:
+            break
+        time.sleep(0.01)
+    return received
+
+
+def bench_queue(fake: FakeRaspberry, bursts=(10, 100, 1000)) -> list:
+    """
+    Rajadas misturando movimento, garfo, rotação e drive. Cada tamanho roda
+    duas vezes: sem STOP, para ver o que a fila entrega e descarta, e com um
+    STOP no fim, para medir quanto ele demora com a fila cheia.
+    """
+    results = []
+    kinds = [
+        {"type": "button", "subtype": "move", "dir": "UP"},
+        {"type": "button", "subtype": "fork", "action": "UP"},
+        {"type": "drive", "v": 0.5, "w": 0.0},
+        {"type": "button", "subtype": "rotate", "dir": "CW"},
+    ]
+
+    def burst(size):
+        for i in range(size):
+            core.send_ws_command(dict(kinds[i % len(kinds)], bench_seq=i, bench_t=time.time()))
+
+    for size in bursts:
+        time.sleep(0.3)
+        fake.take()
+        before = core.ws_stats_data()
+        t0 = time.time()
+        burst(size)
+        received = _collect(fake)
+        after = core.ws_stats_data()
+
+        delays = [now - d["bench_t"] for now, d in received]
+        dropped = {k: after["dropped"][k] - before["dropped"].get(k, 0) for k in after["dropped"]}
+
+        time.sleep(0.3)
+        fake.take()
+        burst(size)
+        core.send_ws_command({"type": "button", "subtype": "move", "dir": "STOP",
+                              "bench_seq": size, "bench_t": time.time()})
+        stopped = _collect(fake, until=lambda d: d.get("dir") == "STOP")
+
+        results.append({
+            "burst": size,
+            "delivered": len(received),
+            "dropped": dropped,
+            "drain_s": max((now for now, _ in received), default=t0) - t0,
+            "queue_delay_ms": {k: (v * 1000 if v is not None else None)
+                               for k, v in percentiles(delays).items()},
+            "stop_ms": next((1000 * (now - d["bench_t"]) for now, d in stopped
+                             if d.get("dir") == "STOP"), None),
+        })
+        print(f"[BENCH] queue burst {size}: {len(received)} entregues, "
+              f"descartes {dropped}, STOP {results[-1]['stop_ms']} ms", flush=True)
+    return results
+
+
+def _viewer(port: int, duration: float, out: dict, rung: str):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", "/video?rung=" + rung)
+    resp = conn.getresponse()
+    frames = nbytes = 0
+    deadline = time.monotonic() + duration
+    try:
+        while time.monotonic() < deadline:
+            chunk = resp.read1(65536)
+            if not chunk:
+                break
+            nbytes += len(chunk)
+            frames += chunk.count(b"--frame\r\n")
+    finally:
+        conn.close()
+    out["frames"], out["bytes"] = frames, nbytes
+
+
+def bench_video(duration: float, viewer_counts=(1, 5, 20)) -> list:
+    import logging
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, core.app, threaded=True)
+    port = server.socket.getsockname()[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def run(rungs, label):
+        encoded0 = core.mjpeg_broadcaster.rung_stats()
+        delivered0 = core.capture_stats_data()["frames_delivered"]
+        stats = [{} for _ in rungs]
+        threads = [threading.Thread(target=_viewer, args=(port, duration, s, r))
+                   for s, r in zip(stats, rungs)]
+        t0 = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - t0
+        encoded1 = core.mjpeg_broadcaster.rung_stats()
+
+        by_rung = {}
+        for s, r in zip(stats, rungs):
+            entry = by_rung.setdefault(r, {"viewers": 0, "fps": [], "bytes": 0})
+            entry["viewers"] += 1
+            entry["fps"].append(s.get("frames", 0) / elapsed)
+            entry["bytes"] += s.get("bytes", 0)
+        result = {
+            "scenario": label,
+            "viewers": len(rungs),
+            "duration_s": elapsed,
+            "capture_fps": (core.capture_stats_data()["frames_delivered"] - delivered0) / elapsed,
+            "rungs": {
+                r: {
+                    "viewers": e["viewers"],
+                    "viewer_fps_min": min(e["fps"]),
+                    "viewer_fps_mean": sum(e["fps"]) / len(e["fps"]),
+                    "mbit_s": 8 * e["bytes"] / elapsed / 1e6,
+                }
+                for r, e in by_rung.items()
+            },
+            # por degrau: no máximo um encode por frame, só nos que têm viewers
+            "jpeg_encodes_per_s": {
+                r: (encoded1[r]["encoded"] - encoded0[r]["encoded"]) / elapsed for r in encoded1
+            },
+        }
+        summary = ", ".join(f"{r} {e['viewer_fps_mean']:.1f} fps" for r, e in result["rungs"].items())
+        print(f"[BENCH] video {label}: {summary}", flush=True)
+        time.sleep(0.5)
+        return result
+
+    results = []
+    try:
+        top = next(iter(core.MJPEG_RUNGS))
+        for n in viewer_counts:
+            results.append(run([top] * n, f"{n} viewers"))
+        # clientes espalhados por todos os degraus (e um no automático) ao mesmo tempo
+        mixed = list(core.MJPEG_RUNGS) * max(1, max(viewer_counts) // len(core.MJPEG_RUNGS))
+        results.append(run(mixed + ["auto"], "mixed"))
+    finally:
+        server.shutdown()
+    return results
+
+
+def run_metadata() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.time(),
+        "commit": commit or None,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "detector": core.AT_DETECTOR_PARAMS,
+            "detection_mode": core.DETECTION_MODE,
+            "tracking": core.TRACKING_ENABLED,
+            "journal": core.JOURNAL_ENABLED,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks do servidor (ver docstring).")
+    parser.add_argument("--quick", action="store_true", help="rodadas curtas (fumaça)")
+    parser.add_argument("--only", default="detect,latency,queue,video")
+    parser.add_argument("--output", default="bench_output.txt")
+    args = parser.parse_args()
+
+    only = set(args.only.split(","))
+    frames = 10 if args.quick else 60
+    duration = 2.0 if args.quick else 10.0
+    report = {"meta": run_metadata()}
+
+    if "detect" in only:
+        report["detect"] = bench_detect(frames)
+
+    if only & {"latency", "queue", "video"}:
+        fake = FakeRaspberry()
+        fake.start()
+        # tags andando, senão o filtro de mudanças não manda quase nada
+        start_pipeline(fake, [f for f, _ in scenario_frames(count=4, frames=60, size=100,
+                                                            speed=6.0, seed=2)])
+        if "latency" in only:
+            report["latency"] = bench_latency(fake, duration)
+        if "queue" in only:
+            report["queue"] = bench_queue(fake)
+        if "video" in only:
+            report["video"] = bench_video(duration / 2)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"[BENCH] Resultados em {args.output}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
+    # o destrutor do Detector do pupil_apriltags às vezes dá segfault na saída
+    # (ver recording.py) e as threads do pipeline não terminam sozinhas
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,174 @@
+"""
+Pool de processos para detecção de AprilTags.
+
+Os frames BGR são copiados para um anel de memória compartilhada
+(multiprocessing.shared_memory), então só um tuplo pequeno com o índice
+do slot passa pela fila; nada de serializar arrays 1280x720. Cada
+processo faz sua própria conversão para cinza e seu próprio detect(),
+e os resultados voltam reordenados pela ordem de envio dos frames.
+O código dos processos fica no detection_worker.py.
+"""
+import multiprocessing as mp
+import queue
+import sys
+import threading
+import time
+import types
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from detection_worker import worker_main
+
+# quanto tempo esperar por um resultado atrasado antes de pular a vez dele
+REORDER_TIMEOUT_S = 1.0
+
+
+class DetectionPool:
+    """
+    N processos de detecção lendo de um anel de frames em memória compartilhada.
+
+    submit() copia o frame para um slot livre (ou descarta o frame se todos
+    estiverem ocupados) e on_result(frame_seq, capture_time, tags, detect_time)
+    é chamado numa thread coletora, sempre na ordem em que os frames entraram.
+    """
+
+    def __init__(self, workers: int, frame_shape, on_result, detector_kwargs: dict,
+                 slots: int = None):
+        self.workers = max(1, int(workers))
+        self.frame_shape = tuple(frame_shape)
+        self.slots = slots or 2 * self.workers
+        self.on_result = on_result
+        self.detector_kwargs = dict(detector_kwargs)
+
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.skipped = 0  # resultados que não chegaram a tempo na reordenação
+
+        # spawn: os filhos começam limpos, sem copiar threads, locks nem o
+        # Detector já criado no processo principal
+        self._ctx = mp.get_context("spawn")
+        self._shm = None
+        self._frames = None
+        self._free_slots = []
+        self._slot_lock = threading.Lock()
+        self._next_order = 0
+        self._procs = []
+        self._task_q = None
+        self._result_q = None
+        self._collector = None
+        self._running = False
+
+    def start(self):
+        """Sobe os processos (spawn: cada um importa o detection_worker e cria o próprio Detector)."""
+        slot_bytes = int(np.prod(self.frame_shape))
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_bytes * self.slots)
+        self._frames = np.ndarray((self.slots,) + self.frame_shape, dtype=np.uint8,
+                                  buffer=self._shm.buf)
+        self._free_slots = list(range(self.slots))
+        self._task_q = self._ctx.Queue()
+        self._result_q = self._ctx.Queue()
+
+        # o spawn roda de novo o script principal (como __mp_main__) em cada
+        # filho antes do alvo: o app_server inteiro só para um detect(). Sem
+        # o __main__ durante o start() o filho importa só o detection_worker.
+        main = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            for _ in range(self.workers):
+                p = self._ctx.Process(
+                    target=worker_main,
+                    args=(self._shm.name, self.slots, self.frame_shape,
+                          self._task_q, self._result_q, self.detector_kwargs),
+                    daemon=True,
+                )
+                p.start()
+                self._procs.append(p)
+        finally:
+            sys.modules["__main__"] = main
+
+        self._running = True
+        self._collector = threading.Thread(target=self._collect_loop, daemon=True)
+        self._collector.start()
+        print(f"[POOL] {self.workers} processos de detecção, {self.slots} slots", flush=True)
+
+    def submit(self, frame_seq: int, frame, capture_time: float) -> bool:
+        """Copia o frame para o anel. Devolve False se o frame foi descartado."""
+        with self._slot_lock:
+            if not self._free_slots:
+                self.dropped += 1
+                return False
+            slot = self._free_slots.pop()
+            order = self._next_order
+            self._next_order += 1
+
+        np.copyto(self._frames[slot], frame)
+        self.submitted += 1
+        self._task_q.put((order, frame_seq, slot, capture_time))
+        return True
+
+    def _collect_loop(self):
+        pending = {}
+        next_emit = 0
+        waiting_since = None
+
+        while self._running:
+            try:
+                order, frame_seq, slot, capture_time, tags, detect_time = \
+                    self._result_q.get(timeout=0.1)
+                with self._slot_lock:
+                    self._free_slots.append(slot)
+                if order >= next_emit:
+                    pending[order] = (frame_seq, capture_time, tags, detect_time)
+            except queue.Empty:
+                pass
+
+            # se o próximo da fila sumiu (processo morreu), não trava o resto
+            if pending and next_emit not in pending:
+                if waiting_since is None:
+                    waiting_since = time.monotonic()
+                elif time.monotonic() - waiting_since > REORDER_TIMEOUT_S:
+                    # conta todos os resultados pulados, não só o buraco da vez
+                    self.skipped += min(pending) - next_emit
+                    next_emit = min(pending)
+
+            while next_emit in pending:
+                waiting_since = None
+                frame_seq, capture_time, tags, detect_time = pending.pop(next_emit)
+                next_emit += 1
+                self.completed += 1
+                try:
+                    self.on_result(frame_seq, capture_time, tags, detect_time)
+                except Exception as e:
+                    print("[POOL] Erro ao tratar resultado:", e, flush=True)
+
+    def stats(self) -> dict:
+        with self._slot_lock:
+            busy = self.slots - len(self._free_slots)
+        return {
+            "workers": self.workers,
+            "slots": self.slots,
+            "busy_slots": busy,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+        }
+
+    def stop(self):
+        self._running = False
+        for _ in self._procs:
+            self._task_q.put(None)
+        for p in self._procs:
+            p.join(timeout=2)
+            if p.is_alive():
+                p.terminate()
+        self._procs = []
+        if self._collector is not None:
+            self._collector.join(timeout=1)
+        if self._shm is not None:
+            self._frames = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
@@ -0,0 +1,53 @@
+"""
+Processo de detecção do DetectionPool (spawn).
+
+Fica separado do detection_pool.py e do app_server.py de propósito: o
+filho só importa este módulo, então sobe com cv2, numpy e
+pupil_apriltags e nada mais (sem Flask, FramePool, Journal ou métricas).
+Os parâmetros do Detector chegam prontos do processo principal.
+"""
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+from pupil_apriltags import Detector
+
+# versão "leve" do Detection do pupil_apriltags, barata de serializar
+TagDetection = namedtuple("TagDetection", ["tag_id", "tag_family", "center", "corners"])
+
+
+def worker_main(shm_name, slots, shape, task_q, result_q, detector_kwargs):
+    """Loop de cada processo: pega um slot, detecta e devolve as tags."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray((slots,) + shape, dtype=np.uint8, buffer=shm.buf)
+    gray = np.empty(shape[:2], dtype=np.uint8)
+    detector = Detector(**detector_kwargs)
+
+    try:
+        while True:
+            task = task_q.get()
+            if task is None:
+                break
+            order, frame_seq, slot, capture_time = task
+
+            t0 = time.monotonic()
+            tags = []
+            try:
+                cv2.cvtColor(frames[slot], cv2.COLOR_BGR2GRAY, dst=gray)
+                for r in detector.detect(gray, estimate_tag_pose=False):
+                    tags.append(TagDetection(
+                        int(r.tag_id),
+                        getattr(r, "tag_family", "unknown"),
+                        r.center.copy(),
+                        r.corners.copy(),
+                    ))
+            except Exception as e:
+                print("[POOL] Erro na detecção:", e, flush=True)
+            detect_time = time.monotonic() - t0
+
+            result_q.put((order, frame_seq, slot, capture_time, tags, detect_time))
+    finally:
+        del frames
+        shm.close()
@@ -0,0 +1,710 @@
+"""
+Modo frota: várias empilhadeiras num servidor só.
+
+Os robôs vêm de um registro em JSON (FLEET_REGISTRY), por exemplo:
+
+  {"robots": [
+    {"id": "emp1", "ws_url": "ws://192.168.14.223:6789",
+     "udp_url": "udp://0.0.0.0:5000?overrun_nonfatal=1&fifo_size=50000"},
+    {"id": "emp2", "name": "Empilhadeira 2", "ws_url": "ws://192.168.14.224:6789",
+     "udp_url": "udp://0.0.0.0:5001?overrun_nonfatal=1&fifo_size=50000",
+     "capture_backend": "pyav"}
+  ]}
+
+Opcionais por robô: "name", "capture_backend", "replay_path", "replay_loop",
+"record_path".
+
+Cada robô ganha um processo com a captura e a detecção do app_server, então
+o decode de um não disputa o GIL com o dos outros. O processo devolve pelo
+Pipe os comandos da visão, os registros do diário, as tags do overlay e o
+JPEG (só enquanto alguém assiste). O processo principal roda um event loop
+só (aiohttp) com as rotas de todos os robôs e todos os websockets com os
+Raspberries.
+
+Rotas: / (lista), /robots, /robots/<id>/ (a interface do app_server),
+/robots/<id>/video, /robots/<id>/action, /robots/<id>/drive, .../clear_log, .../align,
+.../ui/ws, .../commands/latency, .../ws/stats, .../stats, .../video/control,
+.../journal e /metrics.
+
+Uso: python fleet.py [robots.json]
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+import app_server as core
+import async_server
+import journal as journal_mod
+import metrics
+
+HOST = "0.0.0.0"
+PORT = 8000
+FLEET_REGISTRY = "robots.json"
+FLEET_STATS_INTERVAL_S = 1.0   # estatísticas do processo de cada robô
+FLEET_RESTART_DELAY_S = 2.0    # espera antes de subir de novo um processo que caiu
+FLEET_WORKER_STOP_S = 3.0      # espera o processo fechar a captura antes do terminate
+
+_ROBOT_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+_IDLE_ALIGN = {"type": "align", "status": "idle", "tag_id": None, "reason": ""}
+
+
+def load_registry(path: str) -> list:
+    """Lista de robôs do registro; ValueError se faltar campo ou repetir id."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    robots = data.get("robots") if isinstance(data, dict) else data
+    if not isinstance(robots, list) or not robots:
+        raise ValueError(f"{path}: nenhum robô no registro")
+
+    seen = set()
+    for i, spec in enumerate(robots):
+        robot_id = spec.get("id") if isinstance(spec, dict) else None
+        if not robot_id or not _ROBOT_ID.match(str(robot_id)):
+            raise ValueError(f"{path}: robô {i} sem id válido (letras, números, _ e -)")
+        if robot_id in seen:
+            raise ValueError(f"{path}: id repetido: {robot_id}")
+        if not spec.get("ws_url"):
+            raise ValueError(f"{path}: robô {robot_id} sem ws_url")
+        seen.add(robot_id)
+    return robots
+
+
+# === PROCESSO DE CADA ROBÔ ===
+class _PipeJournal:
+    """No processo do robô, o diário só repassa os registros ao principal."""
+
+    def __init__(self, send):
+        self._send = send
+
+    def append(self, kind: int, payload: bytes):
+        self._send(("journal", kind, payload))
+
+
+def _jpeg_forwarder(rung: str, watching: threading.Event, send):
+    """Codifica e manda o JPEG do degrau, até o max_fps, enquanto houver viewers nele."""
+    interval = 1.0 / core.MJPEG_RUNGS[rung]["max_fps"]
+    last_seq = 0
+    due = time.monotonic()
+    while True:
+        watching.wait()
+        now = time.monotonic()
+        if due > now:
+            time.sleep(due - now)
+        due = max(due + interval, now - interval)
+        seq, part = core.mjpeg_broadcaster.wait_jpeg(last_seq, 0.5, rung)
+        if part is None:
+            continue
+        last_seq = seq
+        # se o principal atrasar, send() segura aqui e o próximo já é o mais novo
+        send(("jpeg", rung, seq, part))
+
+
+def robot_worker(spec: dict, conn, detect_threads: int):
+    """Roda a captura e a detecção do app_server para um robô (processo filho)."""
+    # Ctrl+C chega ao grupo todo; quem encerra o processo é o principal (Robot.stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    send_lock = threading.Lock()
+
+    def send(msg):
+        try:
+            with send_lock:
+                conn.send(msg)
+        except (OSError, ValueError):
+            pass  # o principal saiu
+
+    core.CAPTURE_BACKEND = spec.get("capture_backend", core.CAPTURE_BACKEND)
+    core.UDP_URL = spec.get("udp_url", core.UDP_URL)
+    core.REPLAY_PATH = spec.get("replay_path")
+    core.REPLAY_LOOP = bool(spec.get("replay_loop", core.REPLAY_LOOP))
+    core.RECORD_PATH = spec.get("record_path")
+    # um processo por robô já espalha a detecção pelos núcleos
+    core.DETECTION_MODE = "thread"
+    core.DETECTION_MAX_THREADS = detect_threads
+    core.detection_scheduler = core.make_detection_scheduler()
+    core.command_sink = lambda cmd: send(("cmd", cmd))
+    core.journal = _PipeJournal(send)
+    core.ui_events.subscribe(lambda event: send(("ui", event)))
+    core.start_vision()
+
+    watching = {rung: threading.Event() for rung in core.MJPEG_RUNGS}
+    for rung, event in watching.items():
+        threading.Thread(target=_jpeg_forwarder, args=(rung, event, send), daemon=True).start()
+
+    last_frames, last_t = 0, time.monotonic()
+    while True:
+        try:
+            if conn.poll(FLEET_STATS_INTERVAL_S):
+                kind, value = conn.recv()
+                if kind == "viewers":
+                    for rung, event in watching.items():
+                        if value.get(rung, 0) > 0:
+                            event.set()
+                        else:
+                            event.clear()
+                elif kind == "video_config":
+                    core.handle_video_config_reply(value)
+                elif kind == "align":
+                    if value.get("tag_id") is None:
+                        core.auto_aligner.cancel(value.get("reason", "cancelado pelo operador"),
+                                                 stop=value.get("stop", True))
+                    else:
+                        core.auto_aligner.start(value["tag_id"])
+        except (EOFError, OSError):
+            core.stop_vision()  # o principal saiu: fecha o stream e a gravação
+            return
+
+        now = time.monotonic()
+        if now - last_t >= FLEET_STATS_INTERVAL_S:
+            frames = core.frames_captured.value
+            send(("stats", {
+                "fps": (frames - last_frames) / (now - last_t),
+                "frames_captured": frames,
+                "frames_skipped": core.frames_skipped.value,
+                "tags_detected": core.tags_detected.value,
+                "mjpeg": core.mjpeg_broadcaster.rung_stats(),
+                "capture": core.capture_stats_data(),
+                "frame_pool": core.frame_pool.stats(),
+                "scheduler": core.detection_scheduler.state(),
+                "video": core.video_controller.state(),
+                "align": core.auto_aligner.state(),
+            }))
+            last_frames, last_t = frames, now
+
+
+# === PROCESSO PRINCIPAL: um Robot por empilhadeira, todos no mesmo loop ===
+class Robot:
+    """
+    Estado de um robô no processo principal: o RobotLink (websocket com o
+    Raspberry, fila de comandos, log, diário e eventos da interface), o
+    processo de captura/detecção e o último JPEG. Todos os métodos rodam
+    no event loop (menos os callbacks do UiEventBus).
+    """
+
+    def __init__(self, spec: dict, detect_threads: int):
+        self.spec = spec
+        self.id = spec["id"]
+        self.name = spec.get("name", self.id)
+        self.ws_url = spec["ws_url"]
+        self.detect_threads = detect_threads
+
+        self.video_config = None   # última resposta do video_config, para um processo novo
+        self.journal = journal_mod.Journal(
+            os.path.join(core.JOURNAL_DIR, self.id),
+            core.JOURNAL_SEGMENT_BYTES, core.JOURNAL_FLUSH_INTERVAL_S,
+            max_bytes=core.JOURNAL_MAX_BYTES, max_age_s=core.JOURNAL_MAX_AGE_S)
+        latency, send = robot_histograms(self.id)
+        self.link = core.RobotLink(
+            self.journal, core.UiEventBus(), label=f"[FROTA] {self.id}:",
+            cancel_align=self.cancel_align, on_align=self.handle_align,
+            on_video_config=self.on_video_config,
+            latency_histograms=latency, send_histogram=send)
+        self.latest_tags = {"type": "tags", "tags": []}
+        self.latest_align = _IDLE_ALIGN
+        self.latest_align_stats = None
+        # pedido de alinhamento mandado e ainda não cancelado: o latest_align
+        # só muda quando o processo do robô responde
+        self.align_requested = False
+
+        self.process = None
+        self.worker_stats = {}
+        self.worker_restarts = 0
+        self._conn = None
+        self._fd = None
+        self._loop = None
+
+        self.viewers = {rung: 0 for rung in core.MJPEG_RUNGS}
+        # (seq, JPEG) de cada degrau; o seq é daqui e não do processo do robô,
+        # que recomeça do zero quando é reiniciado
+        self.parts = {rung: (0, None) for rung in core.MJPEG_RUNGS}
+        self._jpeg_seq = 0
+        self._jpeg_event = None
+
+    def attach(self, loop):
+        self._loop = loop
+        self._jpeg_event = asyncio.Event()
+
+    # --- processo do robô ---
+    def start_worker(self):
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=robot_worker, args=(self.spec, child_conn, self.detect_threads),
+            name=f"robot-{self.id}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self._conn, self._fd = parent_conn, parent_conn.fileno()
+        self._loop.add_reader(self._fd, self._on_worker_readable)
+        if any(self.viewers.values()):
+            self._send_worker(("viewers", dict(self.viewers)))
+        if self.video_config is not None:
+            self._send_worker(("video_config", dict(self.video_config, restarted=False)))
+        print(f"[FROTA] {self.id}: processo {self.process.pid} iniciado", flush=True)
+
+    def _close_worker_pipe(self):
+        if self._conn is not None:
+            self._loop.remove_reader(self._fd)
+            self._conn.close()
+            self._conn = None
+
+    def _send_worker(self, msg):
+        if self._conn is None:
+            return
+        try:
+            self._conn.send(msg)
+        except OSError:
+            self._close_worker_pipe()
+
+    def _on_worker_readable(self):
+        try:
+            while self._conn is not None and self._conn.poll():
+                self._on_worker_message(self._conn.recv())
+        except (EOFError, OSError):
+            self._close_worker_pipe()
+
+    def _on_worker_message(self, msg):
+        kind = msg[0]
+        if kind == "jpeg":
+            self._jpeg_seq += 1
+            self.parts[msg[1]] = (self._jpeg_seq, msg[3])
+            event, self._jpeg_event = self._jpeg_event, asyncio.Event()
+            event.set()
+        elif kind == "cmd":
+            self.link.commands.put_nowait(msg[1])
+        elif kind == "journal":
+            if core.JOURNAL_ENABLED:
+                self.journal.append(msg[1], msg[2])
+        elif kind == "ui":
+            if msg[1].get("type") == "tags":
+                self.latest_tags = msg[1]
+            elif msg[1].get("type") == "align":
+                self.latest_align = msg[1]
+            elif msg[1].get("type") == "align_stats":
+                # o tracker do processo do robô não vê os acks: a latência é a daqui
+                msg = ("ui", dict(msg[1], actuation_ms=self.link.tracker.stats()["actuation_ms"]))
+                self.latest_align_stats = msg[1]
+            self.link.events.publish(msg[1])
+        elif kind == "stats":
+            self.worker_stats = msg[1]
+
+    async def supervise(self):
+        """Sobe o processo do robô e o reinicia se ele morrer."""
+        self.start_worker()
+        while True:
+            await asyncio.sleep(1.0)
+            if self.process.is_alive():
+                continue
+            print(f"[FROTA] {self.id}: processo saiu (código {self.process.exitcode}), "
+                  f"reiniciando em {FLEET_RESTART_DELAY_S}s", flush=True)
+            self._close_worker_pipe()
+            self.worker_stats = {}
+            # o processo novo começa parado: sem alinhamento em curso
+            self.latest_align = _IDLE_ALIGN
+            self.latest_align_stats = None
+            self.align_requested = False
+            self.link.events.publish(_IDLE_ALIGN)
+            # o último JPEG do processo morto não vale mais para quem chegar agora
+            self.parts = {rung: (0, None) for rung in core.MJPEG_RUNGS}
+            self.worker_restarts += 1
+            await asyncio.sleep(FLEET_RESTART_DELAY_S)
+            self.start_worker()
+
+    def stop(self):
+        # sem o pipe o processo fecha a captura sozinho; terminate só se travar
+        self._close_worker_pipe()
+        if self.process is not None:
+            self.process.join(FLEET_WORKER_STOP_S)
+            if self.process.is_alive():
+                self.process.terminate()
+        if core.JOURNAL_ENABLED:
+            self.journal.stop()
+
+    def on_video_config(self, data: dict):
+        # o controle do vídeo roda no processo do robô, junto das medidas da captura
+        self.video_config = data
+        self._send_worker(("video_config", data))
+
+    # --- interface ---
+    # a malha do auto-alinhamento roda no processo do robô, junto das detecções
+    def handle_align(self, tag_id):
+        if tag_id is None:
+            self.cancel_align("cancelado pelo operador")
+        else:
+            self.align_requested = True
+            self._send_worker(("align", {"tag_id": tag_id}))
+
+    def cancel_align(self, reason: str, stop: bool = True):
+        # chamado a cada setpoint do modo contínuo: só passa pelo pipe se houver o que cancelar
+        if self.align_requested or self.latest_align.get("status") in core.AutoAligner.ACTIVE:
+            self.align_requested = False
+            self._send_worker(("align", {"tag_id": None, "reason": reason, "stop": stop}))
+
+    def align_state(self) -> dict:
+        return dict(self.worker_stats.get("align") or {},
+                    actuation_ms=self.link.tracker.stats()["actuation_ms"])
+
+    def ui_snapshot(self):
+        snapshot = self.link.ui_snapshot() + [self.latest_tags, self.latest_align]
+        if self.latest_align_stats is not None:
+            snapshot.append(self.latest_align_stats)
+        return snapshot
+
+    # --- MJPEG ---
+    def add_viewer(self, rung: str):
+        # o processo do robô só codifica os degraus que têm alguém assistindo
+        self.viewers[rung] += 1
+        if self.viewers[rung] == 1:
+            self._send_worker(("viewers", dict(self.viewers)))
+
+    def remove_viewer(self, rung: str):
+        self.viewers[rung] -= 1
+        if self.viewers[rung] == 0:
+            self._send_worker(("viewers", dict(self.viewers)))
+
+    async def next_jpeg(self, last_seq: int, rung: str):
+        while self.parts[rung][0] <= last_seq:
+            await self._jpeg_event.wait()
+        return self.parts[rung]
+
+    def status(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "connected": self.link.connected,
+            "protocol": self.link.protocol,
+            "reconnects": self.link.reconnects,
+            "worker_alive": self.process is not None and self.process.is_alive(),
+            "worker_restarts": self.worker_restarts,
+            "fps": self.worker_stats.get("fps"),
+            "viewers": sum(self.viewers.values()),
+            "command_queue_depth": self.link.commands.depth(),
+        }
+
+
+robots = {}
+
+FLEET_HTML = """
+<!doctype html>
+<html lang="pt-br">
+  <head>
+    <meta charset="utf-8">
+    <title>Frota de empilhadeiras</title>
+    <style>
+      body { font-family: sans-serif; margin: 24px; }
+      table { border-collapse: collapse; }
+      td, th { padding: 6px 12px; border-bottom: 1px solid #ddd; text-align: left; }
+    </style>
+  </head>
+  <body>
+    <h1>Frota</h1>
+    <table>
+      <thead>
+        <tr><th>Robô</th><th>Raspberry</th><th>Vídeo</th><th>Viewers</th></tr>
+      </thead>
+      <tbody id="robots">
+        {% for robot in robots %}
+        <tr id="robot-{{ robot.id }}">
+          <td><a href="/robots/{{ robot.id }}/">{{ robot.name }}</a></td>
+          <td class="pi">-</td><td class="fps">-</td><td class="viewers">-</td>
+        </tr>
+        {% endfor %}
+      </tbody>
+    </table>
+    <script>
+      async function refresh() {
+        try {
+          const data = await (await fetch("/robots")).json();
+          for (const r of data.robots) {
+            const row = document.getElementById("robot-" + r.id);
+            if (!row) continue;
+            row.querySelector(".pi").textContent = r.connected ? "conectado" : "desconectado";
+            row.querySelector(".fps").textContent = !r.worker_alive ? "processo parado"
+              : r.fps === null ? "-" : r.fps.toFixed(1) + " fps";
+            row.querySelector(".viewers").textContent = r.viewers;
+          }
+        } catch (e) {
+          console.error("Erro ao ler a frota:", e);
+        }
+      }
+      refresh();
+      setInterval(refresh, 2000);
+    </script>
+  </body>
+</html>
+"""
+
+FLEET_TEMPLATE = async_server.INDEX_TEMPLATE.environment.from_string(FLEET_HTML)
+
+
+def robot_route(handler):
+    """Resolve o {id} da URL; robô desconhecido vira 404."""
+    async def wrapper(request):
+        robot = robots.get(request.match_info["id"])
+        if robot is None:
+            raise web.HTTPNotFound(text="robô desconhecido")
+        return await handler(request, robot)
+    return wrapper
+
+
+async def fleet_index(request):
+    html = FLEET_TEMPLATE.render(robots=list(robots.values()))
+    return web.Response(text=html, content_type="text/html")
+
+
+async def robots_list(request):
+    return web.json_response({"robots": [r.status() for r in robots.values()]})
+
+
+@robot_route
+async def robot_redirect(request, robot):
+    # a interface usa URLs relativas, então precisa da barra no fim
+    raise web.HTTPFound(f"/robots/{robot.id}/")
+
+
+@robot_route
+async def robot_index(request, robot):
+    html = async_server.INDEX_TEMPLATE.render(log=list(reversed(robot.link.actions_log)),
+                                              rungs=list(core.MJPEG_RUNGS))
+    return web.Response(text=html, content_type="text/html")
+
+
+@robot_route
+async def robot_video(request, robot):
+    try:
+        rung = core.parse_rung(request.query.get("rung"))
+    except ValueError as e:
+        return web.json_response({"ok": False, "error": str(e)}, status=400)
+    resp = web.StreamResponse(
+        headers={"Content-Type": "multipart/x-mixed-replace; boundary=frame"})
+    await resp.prepare(request)
+
+    selector = core.RungSelector(core.MJPEG_RUNGS) if rung == "auto" else None
+    if selector is not None:
+        rung = selector.rung
+    robot.add_viewer(rung)
+    try:
+        last_seq = 0
+        while True:
+            last_seq, part = await robot.next_jpeg(last_seq, rung)
+            t0 = time.monotonic()
+            await resp.write(part)
+            if selector is not None:
+                interval = 1.0 / core.MJPEG_RUNGS[rung]["max_fps"]
+                new_rung = selector.observe(time.monotonic() - t0, interval)
+                if new_rung != rung:
+                    robot.remove_viewer(rung)
+                    robot.add_viewer(new_rung)
+                    rung = new_rung
+    except ConnectionResetError:
+        # cliente saiu; o CancelledError (desconexão, shutdown) segue para o aiohttp
+        pass
+    finally:
+        robot.remove_viewer(rung)
+    return resp
+
+
+@robot_route
+async def robot_action(request, robot):
+    data = await async_server.json_body(request)
+    return web.json_response({"ok": True, "log": robot.link.handle_action(data.get("action"))})
+
+
+@robot_route
+async def robot_drive(request, robot):
+    data = await async_server.json_body(request)
+    try:
+        linear, angular = core.parse_drive_setpoint(data)
+    except ValueError as e:
+        return web.json_response({"ok": False, "error": str(e)}, status=400)
+    robot.link.set_drive_setpoint(linear, angular)
+    return web.json_response({"ok": True})
+
+
+@robot_route
+async def robot_clear_log(request, robot):
+    robot.link.clear_log()
+    return web.json_response({"ok": True, "log": []})
+
+
+@robot_route
+async def robot_ui_ws(request, robot):
+    handler = async_server.make_ui_ws(robot.ui_snapshot, robot.link.events,
+                                      robot.link.handle_ui_message)
+    return await handler(request)
+
+
+@robot_route
+async def robot_latency(request, robot):
+    return web.json_response(robot.link.tracker.stats())
+
+
+@robot_route
+async def robot_ws_stats(request, robot):
+    return web.json_response(core.ws_stats_data(robot.link))
+
+
+@robot_route
+async def robot_stats(request, robot):
+    """Estatísticas do processo do robô (captura, pool de frames, escalonador)."""
+    return web.json_response(dict(robot.status(), worker=robot.worker_stats))
+
+
+@robot_route
+async def robot_align(request, robot):
+    if request.method == "POST":
+        try:
+            robot.handle_align(core.parse_align_request(await async_server.json_body(request)))
+        except ValueError as e:
+            return web.json_response({"ok": False, "error": str(e)}, status=400)
+    return web.json_response(robot.align_state())
+
+
+@robot_route
+async def robot_video_control(request, robot):
+    return web.json_response(robot.worker_stats.get("video") or {})
+
+
+@robot_route
+async def robot_journal(request, robot):
+    try:
+        start, end, kinds, limit = core.parse_time_range(request.query)
+    except ValueError as e:
+        return web.json_response({"ok": False, "error": str(e)}, status=400)
+    data = await asyncio.get_running_loop().run_in_executor(
+        None, core.journal_query_data, start, end, kinds, limit, robot.journal)
+    return web.json_response(data)
+
+
+# === MÉTRICAS (Prometheus), uma série por robô ===
+fleet_registry = metrics.Registry(prefix="forklift_")
+
+
+def robot_histograms(robot_id: str):
+    """Histogramas do link de um robô: latência dos comandos por fase e envio no websocket."""
+    labels = {"robot": robot_id}
+    latency = {
+        phase: fleet_registry.histogram(
+            "command_latency_seconds",
+            "Comandos: ida, ida e volta, espera até o atuador começar, execução "
+            "e da captura do frame até o atuador (auto-alinhamento)",
+            dict(labels, phase=phase))
+        for phase in core.CommandLatencyTracker.PHASES
+    }
+    send = fleet_registry.histogram(
+        "stage_seconds", "Tempo gasto em cada etapa do pipeline", dict(labels, stage="ws_send"))
+    return latency, send
+
+
+def register_robot_metrics(robot: Robot):
+    labels = {"robot": robot.id}
+
+    def worker(key):
+        return lambda: robot.worker_stats.get(key)
+
+    fleet_registry.gauge_func(
+        "ws_connected", "1 se o websocket com o Raspberry está conectado",
+        lambda: int(robot.link.connected), labels)
+    fleet_registry.gauge_func(
+        "worker_alive", "1 se o processo de captura/detecção do robô está rodando",
+        lambda: int(robot.process is not None and robot.process.is_alive()), labels)
+    fleet_registry.counter_func(
+        "worker_restarts_total", "Vezes que o processo do robô foi reiniciado",
+        lambda: robot.worker_restarts, labels)
+    fleet_registry.gauge_func(
+        "capture_fps", "Frames capturados por segundo", worker("fps"), labels)
+    fleet_registry.counter_func(
+        "frames_captured_total", "Frames lidos da captura", worker("frames_captured"), labels)
+    fleet_registry.counter_func(
+        "tags_detected_total", "AprilTags detectadas", worker("tags_detected"), labels)
+    fleet_registry.counter_func(
+        "ws_reconnects_total", "Conexões com o Raspberry perdidas ou recusadas",
+        lambda: robot.link.reconnects, labels)
+    fleet_registry.gauge_func(
+        "command_queue_depth", "Comandos esperando na fila do websocket",
+        robot.link.commands.depth, labels)
+    fleet_registry.counter_func(
+        "commands_sent_total", "Comandos enviados ao Raspberry (sem lotes de tags)",
+        lambda: robot.link.tracker.sent, labels)
+    for reason in ("expired", "overflow", "coalesced", "preempted"):
+        fleet_registry.counter_func(
+            "commands_dropped_total", "Comandos descartados pela fila, por motivo",
+            lambda r=reason: robot.link.commands.dropped[r], dict(labels, reason=reason))
+    fleet_registry.gauge_func(
+        "video_level", "Degrau de VIDEO_LADDER em uso no Raspberry (0 = melhor)",
+        lambda: (robot.worker_stats.get("video") or {}).get("level"), labels)
+    fleet_registry.gauge_func(
+        "mjpeg_viewers", "Clientes assistindo o /video", lambda: sum(robot.viewers.values()), labels)
+
+
+async def metrics_route(request):
+    return web.Response(body=fleet_registry.render().encode(),
+                        headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def on_startup(app):
+    loop = asyncio.get_running_loop()
+    app["tasks"] = []
+    for robot in robots.values():
+        robot.attach(loop)
+        if core.JOURNAL_ENABLED:
+            robot.journal.start()
+        app["tasks"] += [
+            loop.create_task(robot.supervise()),
+            loop.create_task(robot.link.run(robot.ws_url)),
+            loop.create_task(robot.link.drive_streamer()),
+        ]
+
+
+async def on_cleanup(app):
+    for task in app["tasks"]:
+        task.cancel()
+    await asyncio.gather(*app["tasks"], return_exceptions=True)
+    for robot in robots.values():
+        robot.stop()
+
+
+def make_app(specs: list) -> web.Application:
+    # divide as threads do detector entre os processos dos robôs
+    detect_threads = max(1, (os.cpu_count() or 2) // len(specs))
+    for spec in specs:
+        robot = Robot(spec, detect_threads)
+        robots[robot.id] = robot
+        register_robot_metrics(robot)
+
+    app = web.Application()
+    app.add_routes([
+        web.get("/", fleet_index),
+        web.get("/robots", robots_list),
+        web.get("/metrics", metrics_route),
+        web.get("/robots/{id}", robot_redirect),
+        web.get("/robots/{id}/", robot_index),
+        web.get("/robots/{id}/video", robot_video),
+        web.post("/robots/{id}/action", robot_action),
+        web.post("/robots/{id}/drive", robot_drive),
+        web.post("/robots/{id}/clear_log", robot_clear_log),
+        web.get("/robots/{id}/align", robot_align),
+        web.post("/robots/{id}/align", robot_align),
+        web.get("/robots/{id}/ui/ws", robot_ui_ws),
+        web.get("/robots/{id}/commands/latency", robot_latency),
+        web.get("/robots/{id}/ws/stats", robot_ws_stats),
+        web.get("/robots/{id}/stats", robot_stats),
+        web.get("/robots/{id}/video/control", robot_video_control),
+        web.get("/robots/{id}/journal", robot_journal),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    registry = sys.argv[1] if len(sys.argv) > 1 else FLEET_REGISTRY
+    specs = load_registry(registry)
+    print(f"[FROTA] {len(specs)} robôs em {registry}", flush=True)
+    web.run_app(make_app(specs), host=HOST, port=PORT)
@@ -0,0 +1,354 @@
+"""
+Camada de hardware do raspberry_control.py: as mesmas chamadas com o
+pigpio de verdade ou com um Raspberry simulado.
+
+  PigpioBackend  repassa tudo ao pigpiod (precisa do `sudo pigpiod`)
+  SimulatedPi    guarda cada transição de pino com time.perf_counter_ns(),
+                 toca as ondas do motor de passo numa thread (medindo o
+                 atraso de cada borda), mede do comando recebido até o
+                 primeiro pino mexer e modela os motores DC e o garfo
+
+Os nomes seguem o pigpio (set_bank_1, hardware_PWM, wave_*), então o
+MotorDriver e o ForkStepper não sabem qual backend estão usando. Pulsos
+de onda são tuplas (pinos_ligar, pinos_desligar, duração_us), como o
+pigpio.pulse.
+
+Uso sem Raspberry: python raspberry_control.py --sim
+"""
+import threading
+import time
+from collections import deque
+
+# ida e volta típica de uma chamada ao pigpiod pelo socket local
+SIM_CALL_LATENCY_S = 0.0001
+SIM_MAX_TRANSITIONS = 1000000
+# transição que vem mais tarde do que isso não é atribuída ao último comando
+SIM_COMMAND_WINDOW_S = 1.0
+
+
+class PigpioBackend:
+    """pigpio.pi() com os pulsos de onda em tuplas."""
+
+    name = "pigpio"
+
+    def __init__(self):
+        import pigpio  # só existe no Raspberry
+
+        self._pigpio = pigpio
+        self._pi = pigpio.pi()
+        if not self._pi.connected:
+            raise SystemExit("Erro: rode 'sudo pigpiod' primeiro.")
+
+    def set_output(self, pin: int):
+        self._pi.set_mode(pin, self._pigpio.OUTPUT)
+
+    def write(self, pin: int, level: int):
+        self._pi.write(pin, level)
+
+    def set_bank_1(self, bits: int):
+        self._pi.set_bank_1(bits)
+
+    def clear_bank_1(self, bits: int):
+        self._pi.clear_bank_1(bits)
+
+    def hardware_PWM(self, pin: int, freq: int, duty: int):
+        self._pi.hardware_PWM(pin, freq, duty)
+
+    def wave_clear(self):
+        self._pi.wave_clear()
+
+    def wave_add_generic(self, pulses):
+        self._pi.wave_add_generic([self._pigpio.pulse(on, off, us) for on, off, us in pulses])
+
+    def wave_create(self) -> int:
+        return self._pi.wave_create()
+
+    def wave_chain(self, chain):
+        self._pi.wave_chain(chain)
+
+    def wave_tx_busy(self) -> bool:
+        return bool(self._pi.wave_tx_busy())
+
+    def wave_tx_stop(self):
+        self._pi.wave_tx_stop()
+
+    def mark_command(self):
+        pass  # no Raspberry de verdade o pino não é observável daqui
+
+    def wave_delete(self, wave_id: int):
+        self._pi.wave_delete(wave_id)
+
+    def stop(self):
+        self._pi.stop()
+
+
+def expand_chain(chain, waves: dict):
+    """
+    Gera os pulsos de uma cadeia do wave_chain: ids de onda e os laços
+    255 0 ... 255 1 x y (repete x + 256*y vezes), que podem ser aninhados.
+    """
+    def run(start: int):
+        # devolve (pulsos, índice depois do bloco) de chain[start:] até o fim do laço
+        items = []
+        i = start
+        while i < len(chain):
+            c = chain[i]
+            if c == 255 and chain[i + 1] == 0:
+                body, i = run(i + 2)
+                items.append(body)
+            elif c == 255 and chain[i + 1] == 1:
+                count = chain[i + 2] + 256 * chain[i + 3]
+                return ("loop", items, count), i + 4
+            else:
+                items.append(("wave", c))
+                i += 1
+        return ("loop", items, 1), i
+
+    def play(block):
+        _, items, count = block
+        for _ in range(count):
+            for item in items:
+                if item[0] == "wave":
+                    yield from waves[item[1]]
+                else:
+                    yield from play(item)
+
+    block, _ = run(0)
+    return play(block)
+
+
+class SimulatedPi:
+    """
+    Raspberry falso para rodar o raspberry_control.py em qualquer Linux.
+
+    Cada mudança de nível (pino de direção, STEP/DIR do motor de passo) vai
+    para transitions como (perf_counter_ns, pino, nível); mudanças de PWM
+    vão para pwm_changes. clock_anchor liga o perf_counter_ns ao
+    time.time() dos acks (wall_time() converte). mark_command() marca a
+    chegada de um comando, e a primeira transição depois dela vai para
+    command_latency. As ondas tocam numa thread que dorme até cada borda e
+    guarda o atraso em relação ao programado (jitter do host, não do DMA
+    do Raspberry). Cada chamada espera call_latency_s, como a ida ao
+    pigpiod, então o bloqueio do event loop aparece do mesmo jeito.
+    """
+
+    name = "sim"
+
+    def __init__(self, motors, step_pin: int, dir_pin: int,
+                 call_latency_s: float = SIM_CALL_LATENCY_S,
+                 max_transitions: int = SIM_MAX_TRANSITIONS):
+        # motors: ((in_a, in_b, pwm), ...) de cada lado; in_a=1 e in_b=0 é para frente
+        self.motors = tuple(motors)
+        self.step_pin = step_pin
+        self.dir_pin = dir_pin
+        self.call_latency_s = call_latency_s
+
+        self.outputs = set()
+        self.levels = {}
+        self.pwm = {}   # pino -> (freq, duty)
+        self.transitions = deque(maxlen=max_transitions)
+        self.pwm_changes = deque(maxlen=max_transitions)
+        self.step_lateness = deque(maxlen=max_transitions)  # atraso de cada borda do STEP (s)
+        self.command_latency = deque(maxlen=max_transitions)  # comando -> primeiro pino (s)
+        self.clock_anchor = (time.time(), time.perf_counter_ns())
+        self.calls = 0
+        self.fork_steps = 0      # passos contados nas bordas de subida do STEP
+
+        self._lock = threading.Lock()
+        self._waves = {}
+        self._pending = []
+        self._next_wave = 0
+        self._tx_thread = None
+        self._tx_stop = threading.Event()
+        self._command_ns = None
+
+    # chamadas do pigpio
+    def _call(self):
+        self.calls += 1
+        if self.call_latency_s:
+            time.sleep(self.call_latency_s)
+
+    def wall_time(self, t_ns: int) -> float:
+        """perf_counter_ns de uma transição no relógio dos acks (time.time())."""
+        wall, anchor_ns = self.clock_anchor
+        return wall + (t_ns - anchor_ns) / 1e9
+
+    def mark_command(self):
+        """Um comando chegou: a próxima transição mede quanto ele levou até o pino."""
+        with self._lock:
+            self._command_ns = time.perf_counter_ns()
+
+    def _actuated(self, t_ns: int):
+        # com o lock
+        if self._command_ns is None:
+            return
+        latency = (t_ns - self._command_ns) / 1e9
+        self._command_ns = None
+        if latency <= SIM_COMMAND_WINDOW_S:
+            self.command_latency.append(latency)
+
+    def _set(self, pin: int, level: int, t_ns: int):
+        # com o lock
+        if self.levels.get(pin) == level:
+            return
+        self.levels[pin] = level
+        self.transitions.append((t_ns, pin, level))
+        self._actuated(t_ns)
+        if pin == self.step_pin and level:
+            self.fork_steps += 1 if self.levels.get(self.dir_pin) else -1
+
+    def set_output(self, pin: int):
+        self._call()
+        self.outputs.add(pin)
+
+    def write(self, pin: int, level: int):
+        self._call()
+        with self._lock:
+            self._set(pin, 1 if level else 0, time.perf_counter_ns())
+
+    def _bank(self, bits: int, level: int):
+        self._call()
+        t_ns = time.perf_counter_ns()
+        with self._lock:
+            for pin in range(32):
+                if bits >> pin & 1:
+                    self._set(pin, level, t_ns)
+
+    def set_bank_1(self, bits: int):
+        self._bank(bits, 1)
+
+    def clear_bank_1(self, bits: int):
+        self._bank(bits, 0)
+
+    def hardware_PWM(self, pin: int, freq: int, duty: int):
+        self._call()
+        t_ns = time.perf_counter_ns()
+        with self._lock:
+            if self.pwm.get(pin) != (freq, duty):
+                self._actuated(t_ns)
+            self.pwm[pin] = (freq, duty)
+            self.pwm_changes.append((t_ns, pin, freq, duty))
+
+    def wave_clear(self):
+        self._call()
+        self._stop_tx()
+        self._waves.clear()
+        self._pending = []
+
+    def wave_add_generic(self, pulses):
+        self._call()
+        self._pending += list(pulses)
+
+    def wave_create(self) -> int:
+        self._call()
+        wave_id = self._next_wave
+        self._next_wave += 1
+        self._waves[wave_id], self._pending = self._pending, []
+        return wave_id
+
+    def wave_delete(self, wave_id: int):
+        self._call()
+        self._waves.pop(wave_id, None)
+
+    def wave_chain(self, chain):
+        self._call()
+        self._stop_tx()
+        self._tx_stop.clear()
+        pulses = expand_chain(list(chain), dict(self._waves))
+        self._tx_thread = threading.Thread(target=self._play, args=(pulses,), daemon=True)
+        self._tx_thread.start()
+
+    def wave_tx_busy(self) -> bool:
+        self._call()
+        return self._tx_thread is not None and self._tx_thread.is_alive()
+
+    def wave_tx_stop(self):
+        self._call()
+        self._stop_tx()
+
+    def _stop_tx(self):
+        thread = self._tx_thread
+        if thread is not None:
+            self._tx_stop.set()
+            thread.join()
+            self._tx_thread = None
+
+    def stop(self):
+        self._stop_tx()
+
+    def _play(self, pulses):
+        """Thread da onda: aplica cada pulso no instante programado."""
+        due = time.perf_counter_ns()
+        for on, off, us in pulses:
+            delay = (due - time.perf_counter_ns()) / 1e9
+            if delay > 0:
+                # espera interrompível: wave_tx_stop() corta a onda no meio
+                if self._tx_stop.wait(delay):
+                    return
+            elif self._tx_stop.is_set():
+                return
+            t_ns = time.perf_counter_ns()
+            with self._lock:
+                for pin in range(32):
+                    if off >> pin & 1:
+                        self._set(pin, 0, t_ns)
+                for pin in range(32):
+                    if on >> pin & 1:
+                        self._set(pin, 1, t_ns)
+                if (on | off) >> self.step_pin & 1:
+                    self.step_lateness.append((t_ns - due) / 1e9)
+            due += us * 1000
+
+    # modelo
+    def motor_state(self) -> list:
+        """Velocidade de cada motor em [-1, 1] pelos pinos de direção e o duty."""
+        with self._lock:
+            state = []
+            for in_a, in_b, pwm_pin in self.motors:
+                a, b = self.levels.get(in_a, 0), self.levels.get(in_b, 0)
+                freq, duty = self.pwm.get(pwm_pin, (0, 0))
+                speed = duty / 1e6 if freq else 0.0
+                state.append(speed if a and not b else -speed if b and not a else 0.0)
+            return state
+
+    def fork_state(self) -> dict:
+        with self._lock:
+            return {"steps": self.fork_steps, "dir": self.levels.get(self.dir_pin, 0),
+                    "moving": self._tx_thread is not None and self._tx_thread.is_alive()}
+
+    def report(self) -> dict:
+        with self._lock:
+            lateness = sorted(self.step_lateness)
+            command_latency = sorted(self.command_latency)
+            transitions, pwm_changes = len(self.transitions), len(self.pwm_changes)
+
+        def pct(p, values=lateness):
+            if not values:
+                return None
+            return 1e6 * values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+        return {
+            "calls": self.calls,
+            "transitions": transitions,
+            "pwm_changes": pwm_changes,
+            "motors": self.motor_state(),
+            "fork": self.fork_state(),
+            "step_edges": len(lateness),
+            "step_lateness_us": {"p50": pct(50), "p99": pct(99),
+                                 "max": 1e6 * lateness[-1] if lateness else None},
+            "commands_actuated": len(command_latency),
+            "command_to_pin_us": {"p50": pct(50, command_latency), "p99": pct(99, command_latency),
+                                  "max": 1e6 * command_latency[-1] if command_latency else None},
+        }
+
+    def dump(self, path: str):
+        """
+        Transições em CSV (t_ns,t_wall,pino,nível) para análise fora daqui;
+        t_wall é o time.time() equivalente, para cruzar com os acks.
+        """
+        with self._lock:
+            rows = list(self.transitions)
+        with open(path, "w") as f:
+            f.write("t_ns,t_wall,pin,level\n")
+            for t_ns, pin, level in rows:
+                f.write(f"{t_ns},{self.wall_time(t_ns):.6f},{pin},{level}\n")
@@ -0,0 +1,293 @@
+"""
+Diário persistente de ações, comandos e detecções.
+
+Cada evento vira um registro binário (cabeçalho struct + payload) anexado
+a arquivos de segmento em JOURNAL_DIR. Quem grava só coloca o registro numa
+fila; uma thread escritora junta o que houver e faz um write() por lote,
+fora do caminho das requisições. Os segmentos são trocados ao passar de
+segment_bytes, e a consulta por intervalo de tempo lê os segmentos por mmap
+pulando de cabeçalho em cabeçalho, sem carregar o arquivo inteiro.
+
+Retenção: a cada troca de segmento a thread escritora apaga os segmentos
+mais antigos que passarem de max_segments, max_bytes ou max_age_s (o
+segmento atual nunca é apagado).
+"""
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from bisect import bisect_right
+
+KIND_ACTION = 1      # botão da interface (payload JSON)
+KIND_COMMAND = 2     # comando mandado ao Raspberry (payload JSON)
+KIND_DETECTION = 3   # lote de tags de um frame (payload tag_protocol v2)
+KIND_NAMES = {KIND_ACTION: "action", KIND_COMMAND: "command", KIND_DETECTION: "detection"}
+
+_FILE_MAGIC = b"JRNL\x01"
+# tamanho do payload, tipo, time.monotonic(), time.time()
+_RECORD = struct.Struct("<IBdd")
+_SUFFIX = ".jrn"
+# threads diferentes podem enfileirar fora de ordem por alguns microssegundos
+_ORDER_SLACK_S = 1.0
+
+
+def _segment_name(index: int, start_wall: float) -> str:
+    return f"{index:06d}-{int(start_wall * 1000)}{_SUFFIX}"
+
+
+def _parse_segment_name(name: str):
+    """(índice, início em segundos) a partir do nome, ou None se não for segmento."""
+    if not name.endswith(_SUFFIX):
+        return None
+    try:
+        index, start_ms = name[:-len(_SUFFIX)].split("-")
+        return int(index), int(start_ms) / 1000.0
+    except ValueError:
+        return None
+
+
+def iter_segment(path: str, start: float = None, end: float = None):
+    """
+    Gera (tipo, monotonic, wall, payload) de um segmento, lido por mmap.
+    Um registro cortado no fim (queda no meio da escrita) encerra a leitura.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= len(_FILE_MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(_FILE_MAGIC)] != _FILE_MAGIC:
+                return
+            pos = len(_FILE_MAGIC)
+            while pos + _RECORD.size <= size:
+                length, kind, mono, wall = _RECORD.unpack_from(mm, pos)
+                body = pos + _RECORD.size
+                if body + length > size:
+                    break
+                pos = body + length
+                if start is not None and wall < start:
+                    continue
+                if end is not None and wall > end:
+                    if wall > end + _ORDER_SLACK_S:
+                        break  # dentro de um segmento os registros estão em ordem
+                    continue
+                yield kind, mono, wall, mm[body:body + length]
+
+
+class Journal:
+    """
+    Diário em segmentos binários com escrita em lote numa thread própria.
+
+    append() nunca bloqueia: se a fila encher (disco travado), o registro é
+    descartado e contado em stats()["dropped"]. Limites de retenção em None
+    ficam desligados.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024,
+                 flush_interval: float = 0.5, batch_max: int = 1024,
+                 queue_max: int = 20000, fsync_interval: float = 5.0,
+                 max_segments: int = None, max_bytes: int = None, max_age_s: float = None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.batch_max = batch_max
+        self.fsync_interval = fsync_interval
+        self.max_segments = max_segments
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+
+        self.appended = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.deleted_segments = 0
+
+        self._queue = queue.Queue(maxsize=queue_max)
+        self._lock = threading.Lock()   # protege a lista de segmentos
+        # appended/dropped vêm de várias threads produtoras e da gravadora;
+        # lock à parte para o append() não esperar o I/O feito com o _lock
+        self._count_lock = threading.Lock()
+        self._segments = []             # [(início wall, caminho)] em ordem
+        self._file = None
+        self._file_size = 0
+        self._next_index = 0
+        self._last_fsync = 0.0
+        self._thread = None
+        self._running = False
+
+    # --- escrita ---
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            parsed = _parse_segment_name(name)
+            if parsed is not None:
+                found.append((parsed[0], parsed[1], os.path.join(self.directory, name)))
+        found.sort()
+        with self._lock:
+            self._segments = [(start, path) for _, start, path in found]
+        self._next_index = found[-1][0] + 1 if found else 0
+
+        self._running = True
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+        print(f"[JOURNAL] Gravando em {self.directory} ({len(found)} segmentos anteriores)",
+              flush=True)
+
+    def append(self, kind: int, payload: bytes):
+        record = _RECORD.pack(len(payload), kind, time.monotonic(), time.time()) + payload
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._count_lock:
+                self.dropped += 1
+            return
+        with self._count_lock:
+            self.appended += 1
+
+    def _open_segment(self, start_wall: float):
+        self._close_segment()
+        path = os.path.join(self.directory, _segment_name(self._next_index, start_wall))
+        self._next_index += 1
+        self._file = open(path, "ab")
+        self._file.write(_FILE_MAGIC)
+        self._file_size = len(_FILE_MAGIC)
+        with self._lock:
+            self._segments.append((start_wall, path))
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        """Apaga os segmentos mais antigos além dos limites (thread escritora)."""
+        with self._lock:
+            segments = list(self._segments)
+        old = segments[:-1]  # o último é o que está aberto
+        sizes = []
+        for _, path in old:
+            try:
+                sizes.append(os.path.getsize(path))
+            except OSError:
+                sizes.append(0)
+        total = sum(sizes) + self._file_size
+        now = time.time()
+
+        expired = 0
+        for i in range(len(old)):
+            too_many = self.max_segments is not None and len(segments) - i > self.max_segments
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            # o segmento termina quando o próximo começa
+            too_old = self.max_age_s is not None and segments[i + 1][0] < now - self.max_age_s
+            if not (too_many or too_big or too_old):
+                break
+            total -= sizes[i]
+            expired += 1
+        if not expired:
+            return
+
+        with self._lock:
+            del self._segments[:expired]
+        for _, path in old[:expired]:
+            try:
+                os.remove(path)
+                self.deleted_segments += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"[JOURNAL] Erro ao apagar {path}:", e, flush=True)
+        print(f"[JOURNAL] Retenção: {expired} segmento(s) antigo(s) apagado(s)", flush=True)
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def _writer_loop(self):
+        while self._running or not self._queue.empty():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_max:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                with self._count_lock:
+                    self.dropped += len(batch)
+                print("[JOURNAL] Erro ao gravar:", e, flush=True)
+
+    def _write_batch(self, batch):
+        if self._file is None or self._file_size >= self.segment_bytes:
+            # o nome do segmento leva o relógio de parede do primeiro registro
+            _, _, _, first_wall = _RECORD.unpack_from(batch[0])
+            self._open_segment(first_wall)
+
+        data = b"".join(batch)
+        self._file.write(data)
+        self._file.flush()
+        self._file_size += len(data)
+        self.written += len(batch)
+        self.batches += 1
+
+        now = time.monotonic()
+        if now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self._close_segment()
+
+    # --- leitura ---
+    def query(self, start: float, end: float, kinds=None, limit: int = None):
+        """
+        Registros com time.time() em [start, end], como (tipo, monotonic, wall, payload).
+        Só abre os segmentos cujo intervalo cruza o pedido.
+        """
+        with self._lock:
+            segments = list(self._segments)
+        starts = [s for s, _ in segments]
+        # último segmento que começa antes de 'start' pode ter registros no intervalo
+        first = max(0, bisect_right(starts, start) - 1)
+
+        count = 0
+        for seg_start, path in segments[first:]:
+            if seg_start > end:
+                break
+            try:
+                for record in iter_segment(path, start, end):
+                    if kinds is not None and record[0] not in kinds:
+                        continue
+                    yield record
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+            except FileNotFoundError:
+                pass  # apagado pela retenção durante a consulta
+            except (OSError, ValueError) as e:
+                print(f"[JOURNAL] Segmento ilegível {path}:", e, flush=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            segments = len(self._segments)
+        return {
+            "directory": self.directory,
+            "segments": segments,
+            "current_segment_bytes": self._file_size if self._file is not None else 0,
+            "queued": self._queue.qsize(),
+            "appended": self.appended,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "deleted_segments": self.deleted_segments,
+        }
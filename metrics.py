@@ -0,0 +1,135 @@
+"""
+Métricas no formato texto do Prometheus (exposition format 0.0.4), sem
+depender do prometheus_client.
+
+Contadores e histogramas são atualizados no caminho quente (um lock e um
+bisect por observação), então podem ficar ligados em produção. Valores que
+já existem em outros objetos (fila de comandos, viewers do MJPEG) entram
+como *_func: a função só é chamada quando alguém lê o /metrics.
+"""
+import threading
+from bisect import bisect_left
+
+# de 0,5 ms a 1 s: cobre de uma conversão para cinza até um detect lento
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: dict = None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n: int = 1):
+        with self._lock:
+            self.value += n
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: dict = None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)   # o último é o +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield self.name + "_bucket", dict(self.labels, le=_format_value(bound)), cumulative
+        yield self.name + "_sum", self.labels, total
+        yield self.name + "_count", self.labels, cumulative
+
+
+class _FuncMetric:
+    """Valor lido na hora da coleta: fn() devolve um número ou None (omitido)."""
+
+    def __init__(self, kind: str, name: str, help: str, fn, labels: dict = None):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.fn = fn
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            value = None
+        if value is not None:
+            yield self.name, self.labels, value
+
+
+class Registry:
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=None) -> Counter:
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, labels=None, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def counter_func(self, name, help, fn, labels=None):
+        return self._add(_FuncMetric("counter", self.prefix + name, help, fn, labels))
+
+    def gauge_func(self, name, help, fn, labels=None):
+        return self._add(_FuncMetric("gauge", self.prefix + name, help, fn, labels))
+
+    def render(self) -> str:
+        # HELP/TYPE uma vez por nome, com as amostras de todas as séries juntas
+        families = {}
+        for m in self._metrics:
+            families.setdefault(m.name, []).append(m)
+
+        lines = []
+        for name, members in families.items():
+            lines.append(f"# HELP {name} {members[0].help}")
+            lines.append(f"# TYPE {name} {members[0].kind}")
+            for m in members:
+                for sample, labels, value in m.samples():
+                    lines.append(f"{sample}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
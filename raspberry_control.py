@@ -4,13 +4,24 @@ import json
 import websockets
 import subprocess
 import signal
+import sys
 import time
-import pigpio
-import RPi.GPIO as GPIO
+import bisect
+from collections import OrderedDict, deque
+import hardware
+import tag_protocol
 
 HOST = "0.0.0.0"
 PORT = 6789
 
+# "pigpio" no Raspberry; "sim" (ou --sim) roda em qualquer Linux com os pinos simulados
+HARDWARE_BACKEND = "pigpio"
+SIM_LOG_PATH = None        # ex.: "sim_pins.csv": transições de pino gravadas na saída
+
+# Event loop: um asyncio.sleep que acorda atrasado mostra chamada bloqueante
+LOOP_MONITOR_INTERVAL_S = 0.05
+LOOP_LAG_WARN_S = 0.02
+
 # CONFIG DO STREAM DE VÍDEO
 PC_IP = "192.168.14.38"
 UDP_PORT = 5000
@@ -18,8 +29,31 @@ UDP_PORT = 5000
 VIDEO_WIDTH = 1280
 VIDEO_HEIGHT = 720
 VIDEO_FPS = 30
+VIDEO_BITRATE = None   # bps; None = padrão do rpicam-vid
+VIDEO_INTRA = None     # frames entre keyframes; None = padrão do rpicam-vid
+VIDEO_STOP_TIMEOUT_S = 2.0
+
+# faixas aceitas na mensagem {"type": "video_config"}
+VIDEO_LIMITS = {
+    "width": (320, 1920),
+    "height": (180, 1080),
+    "fps": (5, 60),
+    "bitrate": (100000, 20000000),
+    "intra": (1, 300),
+}
 
 video_proc = None
+video_wanted = False    # start_video_stream() já rodou: o rpicam-vid deve estar de pé
+video_config = {
+    "width": VIDEO_WIDTH,
+    "height": VIDEO_HEIGHT,
+    "fps": VIDEO_FPS,
+    "bitrate": VIDEO_BITRATE,
+    "intra": VIDEO_INTRA,
+}
+# uma reconfiguração por vez (o rpicam-vid é reiniciado fora do event loop)
+video_lock = asyncio.Lock()
+video_tasks = set()   # reconfigurações em curso (o loop só guarda referência fraca)
 
 # CONFIG DOS MOTORES DC (pigpio)
 PWM_PIN = 19
@@ -34,94 +68,543 @@ FREQ = 1000
 DUTY_80 = 800000
 MOVE_TIME_S = 0.5
 
+# MODO CONTÍNUO: setpoints (linear, angular) em [-1, 1] chegando em ritmo fixo
+DRIVE_MAX_DUTY = DUTY_80
+DRIVE_MIN_DUTY = 250000     # abaixo disso o motor não vence o atrito
+DRIVE_DEADBAND = 0.05       # |velocidade| menor que isso = parado
+DRIVE_WATCHDOG_S = 0.3      # sem setpoint novo nesse tempo -> para os motores
+
 # CONFIG DO MOTOR DE PASSO
 DIR_PIN = 22
 STEP_PIN = 27
 STEPS_PER_REV = 400
-STEP_DELAY = 0.0025  # 2.5 ms
-
-# Inicializa pigpio
-pi = pigpio.pi()
-if not pi.connected:
-    raise SystemExit("Erro: rode 'sudo pigpiod' primeiro.")
-
-pi.set_mode(PWM_PIN, pigpio.OUTPUT)
-pi.set_mode(IN1, pigpio.OUTPUT)
-pi.set_mode(IN2, pigpio.OUTPUT)
-pi.set_mode(PWM_PIN2, pigpio.OUTPUT)
-pi.set_mode(IN3, pigpio.OUTPUT)
-pi.set_mode(IN4, pigpio.OUTPUT)
+STEP_DELAY = 0.0025  # 2.5 ms (meio período na velocidade de cruzeiro)
+STEP_START_DELAY = 0.006  # meio período no início/fim da rampa
+STEP_ACCEL_STEPS = 60     # passos de aceleração (e de desaceleração)
+STEPPER_WAVE_CACHE = 8    # perfis de movimento guardados no pigpiod
+FORK_MAX_STEPS = 10 * STEPS_PER_REV  # maior movimento aceito num comando
+
+# Hardware: criado pelo init_hardware(), não no import (o módulo pode ser
+# importado sem pigpiod, por exemplo para rodar com o backend simulado)
+pi = None
+motor_driver = None
+fork_stepper = None
+
+
+def init_hardware(backend: str = None):
+    """Abre o backend, configura os pinos e cria os drivers dos motores."""
+    global pi, motor_driver, fork_stepper
+    backend = backend or HARDWARE_BACKEND
+    if backend == "pigpio":
+        pi = hardware.PigpioBackend()
+    elif backend == "sim":
+        pi = hardware.SimulatedPi(
+            motors=((IN1, IN2, PWM_PIN), (IN3, IN4, PWM_PIN2)),
+            step_pin=STEP_PIN, dir_pin=DIR_PIN)
+    else:
+        raise ValueError(f"Backend de hardware desconhecido: {backend}")
+
+    for pin in (PWM_PIN, IN1, IN2, PWM_PIN2, IN3, IN4):
+        pi.set_output(pin)
+    # motor de passo também pelo pigpio (pulsos gerados por DMA)
+    pi.set_output(DIR_PIN)
+    pi.set_output(STEP_PIN)
+    pi.wave_clear()
+
+    motor_driver = MotorDriver(pi, (IN1, IN2, IN3, IN4), (PWM_PIN, PWM_PIN2), FREQ)
+    fork_stepper = ForkStepper(pi, STEPPER_WAVE_CACHE)
+    print(f"[HW] Backend: {pi.name}")
+
+
+# DRIVER DOS MOTORES DC
+class MotorDriver:
+    """
+    Ponte H dos dois motores DC.
+
+    Os quatro pinos de direção mudam juntos com clear_bank_1/set_bank_1
+    (uma ida ao pigpiod cada) em vez de quatro pi.write(); primeiro os
+    pinos que vão para 0, depois os que vão para 1, então um motor passa
+    no máximo por "solto" e nunca por uma combinação misturada.
+    Pinos e PWMs que já estão no valor pedido não são reescritos.
+    """
+
+    def __init__(self, pi, in_pins, pwm_pins, freq: int):
+        self.pi = pi
+        self.in_pins = tuple(in_pins)
+        self.pwm_pins = tuple(pwm_pins)
+        self.freq = freq
+        self._mask = 0
+        for pin in self.in_pins:
+            self._mask |= 1 << pin
+        self._levels = None  # bits atuais dos pinos de direção (None = desconhecido)
+        self._duties = {pin: None for pin in self.pwm_pins}
+        self.calls = 0       # chamadas ao pigpiod (cada uma é uma ida e volta)
+
+    def apply(self, levels, duties, pwm_first: bool = False):
+        """
+        levels: 0/1 de cada pino em in_pins; duties: duty de cada pino em pwm_pins.
+        pwm_first=True atualiza o PWM antes da direção (usado para parar).
+        """
+        bits = 0
+        for pin, level in zip(self.in_pins, levels):
+            if level:
+                bits |= 1 << pin
+
+        if pwm_first:
+            self._apply_pwm(duties)
+        self._apply_dir(bits)
+        if not pwm_first:
+            self._apply_pwm(duties)
+
+    def _apply_dir(self, bits: int):
+        current = self._levels
+        if current == bits:
+            return
+        to_clear = self._mask & ~bits if current is None else current & ~bits
+        to_set = bits if current is None else bits & ~current
+        if to_clear:
+            self.pi.clear_bank_1(to_clear)
+            self.calls += 1
+        if to_set:
+            self.pi.set_bank_1(to_set)
+            self.calls += 1
+        self._levels = bits
+
+    def _apply_pwm(self, duties):
+        for pin, duty in zip(self.pwm_pins, duties):
+            if self._duties[pin] == duty:
+                continue
+            self.pi.hardware_PWM(pin, self.freq if duty else 0, duty)
+            self.calls += 1
+            self._duties[pin] = duty
+
+
+# níveis de (IN1, IN2, IN3, IN4) de cada movimento
+DIR_FORWARD = (1, 0, 1, 0)
+DIR_REVERSE = (0, 1, 0, 1)
+DIR_CW = (1, 0, 0, 1)
+DIR_CCW = (0, 1, 1, 0)
+DIR_STOP = (0, 0, 0, 0)
 
-# Inicializa GPIO para o motor de passo
-GPIO.setmode(GPIO.BCM)
-GPIO.setup(DIR_PIN, GPIO.OUT)
-GPIO.setup(STEP_PIN, GPIO.OUT)
 
 # FUNÇÕES MOTOR DC
 def motor_forward(duty=DUTY_80):
-    pi.write(IN1, 1)
-    pi.write(IN2, 0)
-    pi.write(IN3, 1)
-    pi.write(IN4, 0)
-    pi.hardware_PWM(PWM_PIN, FREQ, duty)
-    pi.hardware_PWM(PWM_PIN2, FREQ, duty)
+    motor_driver.apply(DIR_FORWARD, (duty, duty))
     print("[MOTOR] Frente (DC)")
 
 def motor_reverse(duty=DUTY_80):
-    pi.write(IN1, 0)
-    pi.write(IN2, 1)
-    pi.write(IN3, 0)
-    pi.write(IN4, 1)
-    pi.hardware_PWM(PWM_PIN, FREQ, duty)
-    pi.hardware_PWM(PWM_PIN2, FREQ, duty)
+    motor_driver.apply(DIR_REVERSE, (duty, duty))
     print("[MOTOR] Ré (DC)")
 
 def motor_cw(duty=DUTY_80):
-    pi.write(IN1, 1)
-    pi.write(IN2, 0)
-    pi.write(IN3, 0)
-    pi.write(IN4, 1)
-    pi.hardware_PWM(PWM_PIN, FREQ, duty)
-    pi.hardware_PWM(PWM_PIN2, FREQ, duty)
+    motor_driver.apply(DIR_CW, (duty, duty))
     print("[MOTOR] ROTATE CW (DC)")
 
 def motor_ccw(duty=DUTY_80):
-    pi.write(IN1, 0)
-    pi.write(IN2, 1)
-    pi.write(IN3, 1)
-    pi.write(IN4, 0)
-    pi.hardware_PWM(PWM_PIN, FREQ, duty)
-    pi.hardware_PWM(PWM_PIN2, FREQ, duty)
+    motor_driver.apply(DIR_CCW, (duty, duty))
     print("[MOTOR] ROTATE CCW (DC)")
 
 def motor_stop():
-    pi.hardware_PWM(PWM_PIN, 0, 0)
-    pi.hardware_PWM(PWM_PIN2, 0, 0)
-    pi.write(IN1, 0)
-    pi.write(IN2, 0)
-    pi.write(IN3, 0)
-    pi.write(IN4, 0)
+    motor_driver.apply(DIR_STOP, (0, 0), pwm_first=True)
     print("[MOTOR] Parado (DC)")
 
 
-# FUNÇÃO MOTOR DE PASSO (NOVO)
-def girar_stepper(sentido_horario: bool):
-    """Gira 1 volta completa do motor de passo."""
-    GPIO.output(DIR_PIN, GPIO.HIGH if sentido_horario else GPIO.LOW)
+def _wheel_duty(x: float) -> int:
+    x = abs(x)
+    if x < DRIVE_DEADBAND:
+        return 0
+    return int(DRIVE_MIN_DUTY + min(1.0, x) * (DRIVE_MAX_DUTY - DRIVE_MIN_DUTY))
+
+
+def motor_set(left: float, right: float):
+    """
+    Velocidade de cada lado em [-1, 1] (motor A = esquerda, B = direita).
+    Usado pelo modo contínuo; não imprime nada porque roda a cada setpoint.
+    """
+    duty_l, duty_r = _wheel_duty(left), _wheel_duty(right)
+    motor_driver.apply(
+        (
+            1 if duty_l and left > 0 else 0,
+            1 if duty_l and left < 0 else 0,
+            1 if duty_r and right > 0 else 0,
+            1 if duty_r and right < 0 else 0,
+        ),
+        (duty_l, duty_r),
+    )
+
+
+def velocity_to_wheels(linear: float, angular: float):
+    """Cinemática diferencial: angular > 0 gira anti-horário."""
+    left, right = linear - angular, linear + angular
+    scale = max(1.0, abs(left), abs(right))
+    return left / scale, right / scale
+
+
+# FUNÇÕES MOTOR DE PASSO (ondas DMA do pigpio)
+def step_profile(steps: int, cruise_delay: float, start_delay: float, accel_steps: int):
+    """
+    Meio período (em µs) de cada passo de um perfil trapezoidal:
+    a velocidade sobe linearmente de 1/start_delay até 1/cruise_delay,
+    fica constante e desce do mesmo jeito no fim.
+    """
+    ramp = min(accel_steps, steps // 2)
+    v0, v1 = 1.0 / start_delay, 1.0 / cruise_delay
+    accel = []
+    for i in range(ramp):
+        v = v0 + (v1 - v0) * i / max(1, ramp)
+        accel.append(int(1e6 / v))
+    cruise = int(cruise_delay * 1e6)
+    return accel, cruise, steps - 2 * ramp
+
+
+class StepperPlan:
+    """Ondas criadas no pigpiod para um (nº de passos, velocidade)."""
+
+    def __init__(self, pi, steps: int, cruise_delay: float):
+        accel, cruise, cruise_steps = step_profile(
+            steps, cruise_delay, STEP_START_DELAY, STEP_ACCEL_STEPS)
+        self.pi = pi
+        self.steps = steps
+        self.wave_ids = []
+
+        self.accel_wid = self._wave(accel)
+        self.decel_wid = self._wave(list(reversed(accel)))
+        self.cruise_wid = self._wave([cruise]) if cruise_steps > 0 else None
+
+        # cadeia: rampa de subida, cruzeiro repetido N vezes, rampa de descida
+        chain = []
+        if self.accel_wid is not None:
+            chain.append(self.accel_wid)
+        remaining = cruise_steps
+        while remaining > 0:
+            n = min(remaining, 65535)
+            chain += [255, 0, self.cruise_wid, 255, 1, n & 0xFF, n >> 8]
+            remaining -= n
+        if self.decel_wid is not None:
+            chain.append(self.decel_wid)
+        self.chain = chain
+
+        # instante (s) em que cada passo termina, para saber onde parou
+        periods = accel + [cruise] * cruise_steps + list(reversed(accel))
+        self.step_end_times = []
+        t = 0.0
+        for half in periods:
+            t += 2 * half / 1e6
+            self.step_end_times.append(t)
+        self.duration = t
+
+    def _wave(self, half_periods):
+        if not half_periods:
+            return None
+        mask = 1 << STEP_PIN
+        pulses = []
+        for half in half_periods:
+            pulses.append((mask, 0, half))
+            pulses.append((0, mask, half))
+        self.pi.wave_add_generic(pulses)
+        wid = self.pi.wave_create()
+        self.wave_ids.append(wid)
+        return wid
+
+    def steps_done(self, elapsed: float) -> int:
+        return bisect.bisect_right(self.step_end_times, elapsed)
+
+    def delete(self):
+        for wid in self.wave_ids:
+            self.pi.wave_delete(wid)
+        self.wave_ids = []
+
+
+class ForkStepper:
+    """
+    Move o garfo com ondas DMA do pigpio em vez de time.sleep: os pulsos
+    saem com tempo de hardware e move() só espera com asyncio.sleep,
+    sem travar o loop. As ondas ficam em cache por (passos, velocidade).
+    """
+
+    POLL_S = 0.01
+
+    def __init__(self, pi, cache_size: int):
+        self.pi = pi
+        self.cache_size = cache_size
+        self._plans = OrderedDict()
+        self._cancel = False
+        self.busy = False
+        self.position = 0        # passos acumulados (positivo = subiu)
+        self.last_completed = 0  # passos efetivamente dados no último movimento
+
+    def _plan(self, steps: int, cruise_delay: float) -> StepperPlan:
+        key = (steps, cruise_delay)
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+            return plan
+        if len(self._plans) >= self.cache_size:
+            _, old = self._plans.popitem(last=False)
+            old.delete()
+        plan = StepperPlan(self.pi, steps, cruise_delay)
+        self._plans[key] = plan
+        return plan
+
+    async def move(self, steps: int, sentido_horario: bool, cruise_delay: float = STEP_DELAY) -> int:
+        """Executa o movimento e devolve quantos passos foram realmente dados."""
+        if steps <= 0:
+            return 0
+        plan = self._plan(steps, cruise_delay)
+        pi = self.pi
+        pi.write(DIR_PIN, 1 if sentido_horario else 0)
+        self._cancel = False
+        self.busy = True
+        print(f"[STEPPER] Girando {'horário' if sentido_horario else 'anti-horário'} ({steps} passos)")
+
+        t0 = time.monotonic()
+        pi.wave_chain(plan.chain)
+        try:
+            while pi.wave_tx_busy() and not self._cancel:
+                await asyncio.sleep(self.POLL_S)
+        finally:
+            # cancelado (pelo cancel() ou pela task): para a onda e estima
+            # pelo tempo decorrido quantos passos já tinham saído
+            if pi.wave_tx_busy():
+                pi.wave_tx_stop()
+                done = min(steps, plan.steps_done(time.monotonic() - t0))
+            else:
+                done = steps
+            self.last_completed = done
+            self.position += done if sentido_horario else -done
+            self.busy = False
+            if done < steps:
+                print(f"[STEPPER] Interrompido: {done}/{steps} passos.")
+            else:
+                print(f"[STEPPER] {done} passos concluídos.")
+
+        return done
+
+    def cancel(self):
+        """Pede para parar o movimento atual (move() devolve os passos dados)."""
+        self._cancel = True
+
+    def shutdown(self):
+        self.pi.wave_tx_stop()
+        for plan in self._plans.values():
+            plan.delete()
+        self._plans.clear()
+
+
+# ACKS DOS COMANDOS
+# acks ainda sendo enviados
+_ack_tasks = set()
+
+
+class CommandTrace:
+    """
+    Acks assíncronos de um comando que veio com "id": received (chegou),
+    started (o atuador começou) e finished (terminou, com status). Os
+    horários são time.time() deste relógio; o servidor estima o offset.
+    Comandos sem id (servidor antigo) não geram ack nenhum.
+    """
+
+    def __init__(self, websocket, cmd_id, received_at: float = None):
+        self.websocket = websocket
+        self.cmd_id = cmd_id
+        self._started = False
+        self._finished = False
+        if received_at is not None:
+            self._ack("received", received_at)
+
+    def _ack(self, stage: str, t: float = None, **extra):
+        if self.cmd_id is None or self.websocket is None:
+            return
+        msg = {"type": "ack", "id": self.cmd_id, "stage": stage,
+               "t": time.time() if t is None else t}
+        msg.update(extra)
+        # não segura quem chamou (nem o motor) esperando a rede; o loop só
+        # guarda referência fraca da task, então ela fica em _ack_tasks
+        task = asyncio.create_task(_send_ack(self.websocket, msg))
+        _ack_tasks.add(task)
+        task.add_done_callback(_ack_tasks.discard)
+
+    def started(self):
+        if not self._started:
+            self._started = True
+            self._ack("started")
+
+    def finished(self, status: str = "done", **extra):
+        if not self._finished:
+            self._finished = True
+            self._ack("finished", status=status, **extra)
+
+
+async def _send_ack(websocket, msg: dict):
+    msg["tx"] = time.time()  # instante de saída, para o cálculo do offset
+    try:
+        await websocket.send(json.dumps(msg))
+    except websockets.ConnectionClosed:
+        pass
+
+
+NO_TRACE = CommandTrace(None, None)
+
+
+# EXECUTOR DOS ATUADORES
+DRIVE_FUNCS = {
+    "UP": motor_forward,
+    "DOWN": motor_reverse,
+    "ROT_CW": motor_cw,
+    "ROT_CCW": motor_ccw,
+}
+
+
+class ActuatorExecutor:
+    """
+    Uma task por atuador (tração e garfo), para que um movimento nunca
+    fique esperando outro terminar nem segure as mensagens seguintes.
+
+    - tração: um comando novo na mesma direção só estende o prazo do
+      movimento atual; numa direção diferente, cancela e troca na hora;
+    - tração em modo contínuo: cada setpoint atualiza os PWMs na hora e um
+      watchdog para os motores se os setpoints pararem de chegar;
+    - garfo: um comando novo interrompe o movimento atual e começa o novo;
+    - só um cliente controla o robô por vez (o primeiro que mandar um
+      movimento); STOP é aceito de qualquer cliente.
+    """
+
+    def __init__(self):
+        self._drive_task = None
+        self._drive_dir = None
+        self._drive_traces = []
+        self._drive_deadline = 0.0
+        self._stream_last = 0.0
+        self._fork_task = None
+        self.controller = None
+        self.rejected = 0
+
+    # controle exclusivo
+    def claim(self, websocket) -> bool:
+        if self.controller is None or self.controller is websocket:
+            if self.controller is None:
+                print("[EXEC] Cliente no controle:", websocket.remote_address)
+            self.controller = websocket
+            return True
+        self.rejected += 1
+        return False
+
+    def release(self, websocket):
+        if self.controller is websocket:
+            print("[EXEC] Cliente liberou o controle:", websocket.remote_address)
+            self.controller = None
+            self.stop_all()
+
+    # tração
+    def drive(self, direction: str, duration: float = MOVE_TIME_S, trace=NO_TRACE):
+        task = self._drive_task
+        self._drive_deadline = time.monotonic() + duration
+        if task is not None and not task.done() and self._drive_dir == direction:
+            # mesma direção: só estendeu o prazo; termina junto com o movimento
+            self._drive_traces.append(trace)
+            trace.started()
+            return
+
+        if task is not None and not task.done():
+            task.cancel()
+        self._drive_dir = direction
+        self._drive_traces = [trace]
+        self._drive_task = asyncio.create_task(self._run_drive(direction, self._drive_traces))
+
+    async def _run_drive(self, direction: str, traces: list):
+        status = "done"
+        try:
+            DRIVE_FUNCS[direction](DUTY_80)
+            for trace in traces:
+                trace.started()
+            while True:
+                remaining = self._drive_deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            # se foi substituído por outra direção, quem para é a task nova
+            if self._drive_task is asyncio.current_task():
+                motor_stop()
+                self._drive_dir = None
+            for trace in traces:
+                trace.finished(status)
+
+    def stream(self, linear: float, angular: float, trace=NO_TRACE):
+        """Aplica um setpoint do modo contínuo e mantém o watchdog vivo."""
+        self._stream_last = time.monotonic()
+        task = self._drive_task
+        if self._drive_dir != "STREAM":
+            if task is not None and not task.done():
+                task.cancel()
+            self._drive_dir = "STREAM"
+            self._drive_task = asyncio.create_task(self._stream_watchdog())
+            print("[EXEC] Modo contínuo ativo")
+        motor_set(*velocity_to_wheels(linear, angular))
+        trace.started()
+        trace.finished()
+
+    async def _stream_watchdog(self):
+        try:
+            while True:
+                remaining = self._stream_last + DRIVE_WATCHDOG_S - time.monotonic()
+                if remaining <= 0:
+                    print("[EXEC] Watchdog: setpoints pararam de chegar")
+                    break
+                await asyncio.sleep(remaining)
+        finally:
+            if self._drive_task is asyncio.current_task():
+                motor_stop()
+                self._drive_dir = None
+
+    def stop_drive(self, trace=NO_TRACE):
+        trace.started()
+        task = self._drive_task
+        if task is not None and not task.done():
+            task.cancel()
+        self._drive_task = None
+        self._drive_dir = None
+        motor_stop()
+        trace.finished()
+
+    # garfo
+    def fork(self, sentido_horario: bool, steps: int, trace=NO_TRACE):
+        self.stop_fork()
+        self._fork_task = asyncio.create_task(self._run_fork(sentido_horario, steps, trace))
+
+    async def _run_fork(self, sentido_horario: bool, steps: int, trace):
+        status = "done"
+        trace.started()
+        try:
+            await fork_stepper.move(steps, sentido_horario)
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            trace.finished(status, steps=fork_stepper.last_completed)
+
+    def stop_fork(self, trace=NO_TRACE):
+        trace.started()
+        task = self._fork_task
+        if task is not None and not task.done():
+            fork_stepper.cancel()
+            task.cancel()
+        self._fork_task = None
+        trace.finished()
 
-    print(f"[STEPPER] Girando {'horário' if sentido_horario else 'anti-horário'}")
+    def stop_all(self):
+        self.stop_drive()
+        self.stop_fork()
 
-    for _ in range(STEPS_PER_REV):
-        GPIO.output(STEP_PIN, GPIO.HIGH)
-        time.sleep(STEP_DELAY)
-        GPIO.output(STEP_PIN, GPIO.LOW)
-        time.sleep(STEP_DELAY)
 
-    print("[STEPPER] 1 volta completa concluída.")
+executor = ActuatorExecutor()
 
 
 #HANDLERS
-async def handle_button(cmd: dict):
+async def handle_button(cmd: dict, websocket, trace=NO_TRACE):
     subtype = cmd.get("subtype")
 
     if subtype == "move":
@@ -133,32 +616,20 @@ async def handle_button(cmd: dict):
         else:
             d = ""
 
-        if d == "UP":
-            motor_forward(DUTY_80)
-            await asyncio.sleep(MOVE_TIME_S)
-            motor_stop()
+        if d in ("STOP", "PARAR"):
+            # parada de segurança: vale para qualquer cliente
+            executor.stop_drive(trace)
 
-        elif d == "DOWN":
-            motor_reverse(DUTY_80)
-            await asyncio.sleep(MOVE_TIME_S)
-            motor_stop()
-
-        elif d == "ROT_CW":
-            motor_cw(DUTY_80)
-            await asyncio.sleep(MOVE_TIME_S)
-            motor_stop()
-
-        elif d == "ROT_CCW":
-            motor_ccw(DUTY_80)
-            await asyncio.sleep(MOVE_TIME_S)
-            motor_stop()
-
-
-        elif d in ("STOP", "PARAR"):
-            motor_stop()
+        elif d in DRIVE_FUNCS:
+            if executor.claim(websocket):
+                executor.drive(d, trace=trace)
+            else:
+                print("[EXEC] Ignorado: outro cliente está no controle.")
+                trace.finished("rejected")
 
         else:
             print("[MOTOR] Direção desconhecida:", direction)
+            trace.finished("invalid")
 
     elif subtype == "fork":
         action = cmd.get("action")
@@ -169,33 +640,147 @@ async def handle_button(cmd: dict):
         else:
             a = ""
 
+        try:
+            steps = min(FORK_MAX_STEPS, int(cmd.get("steps", STEPS_PER_REV)))
+        except (TypeError, ValueError, OverflowError):
+            steps = 0
+
         # CONTROLE DO MOTOR DE PASSO
-        if a == "UP":
-            girar_stepper(sentido_horario=True)   # sentido horário
-        elif a == "DOWN":
-            girar_stepper(sentido_horario=False)  # sentido anti-horário
-        else:
+        if a == "STOP":
+            executor.stop_fork(trace)
+        elif a not in ("UP", "DOWN"):
             print("[STEPPER] Ação desconhecida:", action)
+            trace.finished("invalid")
+        elif steps <= 0:
+            print("[STEPPER] Número de passos inválido:", cmd.get("steps"))
+            trace.finished("invalid")
+        elif not executor.claim(websocket):
+            print("[EXEC] Ignorado: outro cliente está no controle.")
+            trace.finished("rejected")
+        elif a == "UP":
+            executor.fork(True, steps, trace)    # sentido horário
+        else:
+            executor.fork(False, steps, trace)   # sentido anti-horário
 
     else:
         print("[BUTTON] Subtipo desconhecido:", cmd)
+        trace.finished("invalid")
+
+
+async def handle_drive(cmd: dict, websocket, trace=NO_TRACE):
+    """Setpoint do modo contínuo: {"type": "drive", "v": linear, "w": angular}."""
+    try:
+        linear = max(-1.0, min(1.0, float(cmd.get("v", 0.0))))
+        angular = max(-1.0, min(1.0, float(cmd.get("w", 0.0))))
+    except (TypeError, ValueError):
+        print("[DRIVE] Setpoint inválido:", cmd)
+        trace.finished("invalid")
+        return
+
+    if not executor.claim(websocket):
+        trace.finished("rejected")
+        return
+    executor.stream(linear, angular, trace)
 
 
 async def handle_apriltag(cmd: dict):
     print("\n[APRILTAG]", cmd)
 
 
-async def handle_message(message: str, websocket):
+async def handle_apriltag_batch(batch: dict):
+    """Lote do protocolo v2: todas as tags (que mudaram) de um frame."""
+    age = time.time() - batch["timestamp"]
+    ids = [t["id"] for t in batch["tags"]]
+    print(f"\n[APRILTAG] frame {batch['frame_id']} tags {ids} (idade {age * 1000:.0f} ms)")
+
+
+async def handle_video_config(data: dict, websocket, trace=NO_TRACE):
+    """
+    {"type": "video_config", "width": 960, "height": 540, "fps": 15,
+     "bitrate": 1500000, "intra": 15}: reinicia o stream com o que mudou.
+    Sem nenhum campo só responde a configuração atual. Se o rpicam-vid
+    morreu, sobe de novo mesmo sem mudança. Roda numa task própria (ver
+    handle_message): a troca leva segundos e a leitura do socket não espera.
+    """
+    reply = {"type": "video_config", "ok": True, "restarted": False}
+    try:
+        requested = parse_video_config(data)
+    except ValueError as e:
+        print("[VIDEO] Configuração inválida:", e)
+        reply.update(ok=False, error=str(e), config=dict(video_config))
+        trace.finished("invalid")
+        await _send_reply(websocket, reply)
+        return
+
+    async with video_lock:
+        changed = any(video_config.get(k) != v for k, v in requested.items())
+        dead = video_wanted and (video_proc is None or video_proc.poll() is not None)
+        if changed or dead:
+            trace.started()
+            # terminate/wait do processo numa thread: o loop segue com os motores
+            respawn = await asyncio.to_thread(restart_video_stream, requested)
+            reply.update(restarted=True, respawn_ms=round(respawn * 1000, 1))
+            print(f"[VIDEO] {'Reconfigurado' if changed else 'rpicam-vid morto, reiniciado'}"
+                  f" (troca do processo em {respawn * 1000:.0f} ms):", video_config)
+        reply["config"] = dict(video_config)
+
+    running = video_proc is not None and video_proc.poll() is None
+    if reply["restarted"] and not running:
+        reply.update(ok=False, error="rpicam-vid não subiu")
+    trace.finished("done" if reply["ok"] else "error")
+    await _send_reply(websocket, reply)
+
+
+async def _send_reply(websocket, reply: dict):
+    # de uma task: o cliente pode ter saído durante a reconfiguração
+    try:
+        await websocket.send(json.dumps(reply))
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def handle_hello(data: dict, websocket):
+    """Responde a negociação de protocolo com a maior versão em comum."""
+    version = tag_protocol.choose_protocol(data.get("protocols"))
+    await websocket.send(json.dumps({"type": "hello", "protocol": version}))
+    print(f"[WS] Protocolo negociado: v{version}")
+
+
+async def handle_message(message, websocket):
+    received_at = time.time()
+
+    # protocolo v2: lotes de AprilTags chegam como mensagem binária
+    if isinstance(message, bytes):
+        try:
+            batch = tag_protocol.decode_batch(message)
+        except ValueError as e:
+            print("[WS] Mensagem binária inválida:", e)
+            return
+        await handle_apriltag_batch(batch)
+        return
+
     try:
         data = json.loads(message)
     except json.JSONDecodeError:
         print("[WS] Mensagem inválida:", message)
         return
 
+    if data.get("type") in ("button", "drive"):
+        pi.mark_command()  # no simulado: mede daqui até o primeiro pino mexer
     if data.get("type") == "button":
-        await handle_button(data)
+        await handle_button(data, websocket, CommandTrace(websocket, data.get("id"), received_at))
+    elif data.get("type") == "drive":
+        await handle_drive(data, websocket, CommandTrace(websocket, data.get("id"), received_at))
+    elif data.get("type") == "video_config":
+        # em paralelo: STOP e setpoints que chegarem durante a troca são atendidos na hora
+        task = asyncio.create_task(
+            handle_video_config(data, websocket, CommandTrace(websocket, data.get("id"), received_at)))
+        video_tasks.add(task)
+        task.add_done_callback(video_tasks.discard)
     elif data.get("type") == "apriltag":
         await handle_apriltag(data)
+    elif data.get("type") == "hello":
+        await handle_hello(data, websocket)
     else:
         print("[WS] Tipo desconhecido:", data)
 
@@ -203,67 +788,225 @@ async def handle_message(message: str, websocket):
 async def client_handler(websocket):
     print("[WS] Cliente conectado:", websocket.remote_address)
     try:
+        # os movimentos rodam nas tasks do executor e a troca do vídeo numa
+        # task própria, então cada mensagem é tratada na hora, sem esperar
+        # o movimento ou a reconfiguração anterior terminar
         async for message in websocket:
             await handle_message(message, websocket)
     except websockets.ConnectionClosed:
         print("[WS] Cliente desconectado:", websocket.remote_address)
+    finally:
+        executor.release(websocket)
 
 
 # CONTROLE DO VÍDEO
-def start_video_stream():
-    global video_proc
-    if video_proc is not None and video_proc.poll() is None:
-        print("[VIDEO] Já rodando.")
-        return
-
-    udp_url = f"udp://{PC_IP}:{UDP_PORT}"
+def video_command(config: dict, udp_url: str) -> list:
     cmd = [
         "rpicam-vid", "--inline",
         "--codec", "h264",
-        "--width", str(VIDEO_WIDTH),
-        "--height", str(VIDEO_HEIGHT),
-        "--framerate", str(VIDEO_FPS),
-        "-t", "0",
-        "-o", udp_url,
+        "--width", str(config["width"]),
+        "--height", str(config["height"]),
+        "--framerate", str(config["fps"]),
     ]
+    if config.get("bitrate"):
+        cmd += ["--bitrate", str(config["bitrate"])]
+    if config.get("intra"):
+        cmd += ["--intra", str(config["intra"])]
+    return cmd + ["-t", "0", "-o", udp_url]
+
 
+def _spawn_video() -> bool:
+    global video_proc
+    udp_url = f"udp://{PC_IP}:{UDP_PORT}"
     try:
         video_proc = subprocess.Popen(
-            cmd,
+            video_command(video_config, udp_url),
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL,
             preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_IGN),
         )
-        time.sleep(1)
-        print("[VIDEO] Stream iniciado:", udp_url)
     except Exception as e:
         print("[VIDEO] ERRO:", e)
+        return False
+    print("[VIDEO] Stream iniciado:", udp_url, video_config)
+    return True
+
+
+def start_video_stream():
+    global video_wanted
+    video_wanted = True
+    if video_proc is not None and video_proc.poll() is None:
+        print("[VIDEO] Já rodando.")
+        return
+    if _spawn_video():
+        time.sleep(1)
 
 
 def stop_video_stream():
     global video_proc
     if video_proc and video_proc.poll() is None:
         video_proc.terminate()
-        time.sleep(1)
+        # espera só o quanto o rpicam-vid leva para soltar a câmera
+        try:
+            video_proc.wait(timeout=VIDEO_STOP_TIMEOUT_S)
+        except subprocess.TimeoutExpired:
+            video_proc.kill()
+            video_proc.wait()
     video_proc = None
 
 
+def restart_video_stream(config: dict) -> float:
+    """
+    Troca a configuração do stream. A câmera só abre num processo por vez,
+    então o rpicam-vid velho precisa sair antes; o novo sobe na hora (sem a
+    espera do start_video_stream). Devolve quanto tempo ficou sem processo:
+    o buraco no vídeo é maior, porque o primeiro frame ainda espera a câmera
+    abrir e o próximo keyframe (aparece em capture_stalls_total no servidor).
+    """
+    t0 = time.monotonic()
+    stop_video_stream()
+    video_config.update(config)
+    _spawn_video()
+    return time.monotonic() - t0
+
+
+def parse_video_config(data: dict) -> dict:
+    """Campos pedidos em {"type": "video_config"}, validados; ValueError se inválidos."""
+    config = {}
+    for key, (low, high) in VIDEO_LIMITS.items():
+        if data.get(key) is None:
+            continue
+        try:
+            value = int(data[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"{key} inválido: {data[key]!r}")
+        if not low <= value <= high:
+            raise ValueError(f"{key} fora da faixa [{low}, {high}]: {value}")
+        if key in ("width", "height"):
+            value -= value % 2  # o H.264 do rpicam-vid pede dimensões pares
+        config[key] = value
+    return config
+
+
+# BENCHMARK DO DRIVER
+BENCH_DUTY = 100000  # baixo o bastante para o robô quase não sair do lugar
+
+
+def benchmark_motor_driver(rounds: int = 200, duty: int = BENCH_DUTY):
+    """
+    Mede quanto tempo cada comando leva para ser aplicado (as chamadas do
+    pigpio só retornam depois que o pigpiod aplicou). Compara troca de
+    direção com repetição do mesmo comando. Deixe o robô suspenso.
+    """
+    sequence = [
+        ("troca de direção", [DIR_FORWARD, DIR_REVERSE, DIR_CW, DIR_CCW, DIR_STOP]),
+        ("mesmo comando", [DIR_FORWARD]),
+    ]
+    results = {}
+    for name, levels_seq in sequence:
+        times = []
+        calls0 = motor_driver.calls
+        for i in range(rounds):
+            levels = levels_seq[i % len(levels_seq)]
+            stop = levels == DIR_STOP
+            t0 = time.perf_counter()
+            motor_driver.apply(levels, (0, 0) if stop else (duty, duty), pwm_first=stop)
+            times.append(time.perf_counter() - t0)
+        times.sort()
+        results[name] = {
+            "mean_ms": 1000 * sum(times) / len(times),
+            "p50_ms": 1000 * times[len(times) // 2],
+            "p99_ms": 1000 * times[min(len(times) - 1, int(len(times) * 0.99))],
+            "pigpio_calls_per_cmd": (motor_driver.calls - calls0) / rounds,
+        }
+    motor_stop()
+
+    for name, r in results.items():
+        print(f"[BENCH] {name}: média {r['mean_ms']:.3f} ms, p50 {r['p50_ms']:.3f} ms, "
+              f"p99 {r['p99_ms']:.3f} ms, {r['pigpio_calls_per_cmd']:.1f} chamadas/comando")
+    return results
+
+
+# MONITOR DO EVENT LOOP
+class LoopLagMonitor:
+    """
+    Dorme interval_s em loop e mede quanto acordou atrasado: é o tempo em
+    que alguma chamada bloqueante (pigpio, subprocess, print) segurou o
+    event loop, e com ele os acks e os setpoints seguintes.
+    """
+
+    def __init__(self, interval_s: float, warn_s: float, window: int = 1000):
+        self.interval_s = interval_s
+        self.warn_s = warn_s
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+
+    async def run(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.interval_s)
+            lag = max(0.0, time.perf_counter() - t0 - self.interval_s)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warn_s:
+                print(f"[LOOP] Event loop travado por {lag * 1000:.1f} ms")
+
+    def stats(self) -> dict:
+        lags = sorted(self.samples)
+        if not lags:
+            return {"samples": 0}
+        return {
+            "samples": len(lags),
+            "p50_ms": 1000 * lags[len(lags) // 2],
+            "p99_ms": 1000 * lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+            "max_ms": 1000 * self.max_lag,
+        }
+
+
+loop_monitor = LoopLagMonitor(LOOP_MONITOR_INTERVAL_S, LOOP_LAG_WARN_S)
+
+
 # MAIN
 async def main():
     print(f"[WS] Servidor ativo em ws://{HOST}:{PORT}")
 
-    start_video_stream()
+    # simulado não tem câmera: o vídeo vem de uma gravação no servidor
+    if pi.name != "sim":
+        start_video_stream()
+    monitor = asyncio.create_task(loop_monitor.run())
 
     async with websockets.serve(client_handler, HOST, PORT):
         try:
             await asyncio.Future()
         finally:
+            monitor.cancel()
+            executor.stop_all()
             stop_video_stream()
             motor_stop()
-            GPIO.cleanup()
+            fork_stepper.shutdown()
+
+
+def report_hardware():
+    """Resumo na saída: atrasos do event loop e, no simulado, pinos e motores."""
+    print("[LOOP]", json.dumps(loop_monitor.stats()))
+    if pi.name == "sim":
+        print("[HW]", json.dumps(pi.report()))
+        if SIM_LOG_PATH:
+            pi.dump(SIM_LOG_PATH)
+            print("[HW] Transições gravadas em", SIM_LOG_PATH)
 
 
 if __name__ == "__main__":
+    init_hardware("sim" if "--sim" in sys.argv else HARDWARE_BACKEND)
+
+    if "--bench-motors" in sys.argv:
+        try:
+            benchmark_motor_driver()
+        finally:
+            motor_stop()
+            pi.stop()
+        raise SystemExit(0)
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -271,6 +1014,7 @@ if __name__ == "__main__":
     finally:
         stop_video_stream()
         motor_stop()
-        GPIO.cleanup()
+        fork_stepper.shutdown()
         pi.stop()
+        report_hardware()
         print("[GERAL] Encerrado com segurança.")
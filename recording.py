@@ -0,0 +1,169 @@
+"""
+Gravação e reprodução do stream de vídeo do Raspberry.
+
+Uma gravação é um diretório com:
+  stream.h264  pacotes H.264 (Annex B) como chegaram, tocável com ffplay
+  index.bin    por pacote: offset, tamanho e instante de chegada relativo
+               ao início da gravação (time.monotonic())
+
+O Recorder é alimentado pelo PyAVCapture (CAPTURE_BACKEND = "pyav" com
+RECORD_PATH definido) e o ReplayCapture do app_server lê a gravação como
+se fosse o stream ao vivo, no tempo real ou o mais rápido possível.
+
+Uso offline (sem robô):
+  python recording.py info <dir>
+  python recording.py detect <dir> [--realtime]   # uma linha JSON por frame
+"""
+import json
+import os
+import struct
+import sys
+import time
+
+STREAM_FILE = "stream.h264"
+INDEX_FILE = "index.bin"
+
+_INDEX_MAGIC = b"REC1"
+# offset no stream.h264, tamanho, chegada (s desde o início da gravação)
+_ENTRY = struct.Struct("<QId")
+
+
+class Recorder:
+    """Grava pacotes H.264 com o instante de chegada. Não é thread-safe."""
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.packets = 0
+        self.bytes = 0
+        self._stream = open(os.path.join(path, STREAM_FILE), "wb")
+        self._index = open(os.path.join(path, INDEX_FILE), "wb")
+        self._index.write(_INDEX_MAGIC)
+        self._t0 = None
+        print(f"[GRAVAÇÃO] Gravando stream em {path}", flush=True)
+
+    def write(self, data: bytes, arrival_time: float):
+        if self._t0 is None:
+            self._t0 = arrival_time
+        self._index.write(_ENTRY.pack(self.bytes, len(data), arrival_time - self._t0))
+        self._stream.write(data)
+        self.packets += 1
+        self.bytes += len(data)
+
+    def close(self):
+        self._stream.close()
+        self._index.close()
+        print(f"[GRAVAÇÃO] {self.packets} pacotes, {self.bytes} bytes em {self.path}", flush=True)
+
+
+def read_index(path: str):
+    """Lista de (offset, tamanho, chegada) da gravação."""
+    with open(os.path.join(path, INDEX_FILE), "rb") as f:
+        data = f.read()
+    if data[:len(_INDEX_MAGIC)] != _INDEX_MAGIC:
+        raise ValueError(f"{path}: índice de gravação inválido")
+    body = memoryview(data)[len(_INDEX_MAGIC):]
+    # um registro cortado no fim (gravação interrompida) é ignorado
+    usable = len(body) - len(body) % _ENTRY.size
+    return list(_ENTRY.iter_unpack(body[:usable]))
+
+
+def iter_packets(path: str):
+    """Gera (chegada, bytes) de cada pacote, na ordem gravada."""
+    index = read_index(path)
+    with open(os.path.join(path, STREAM_FILE), "rb") as f:
+        for offset, size, arrival in index:
+            f.seek(offset)
+            data = f.read(size)
+            if len(data) < size:
+                break
+            yield arrival, data
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def run_info(path: str):
+    index = read_index(path)
+    duration = index[-1][2] if index else 0.0
+    total = sum(size for _, size, _ in index)
+    print(json.dumps({
+        "packets": len(index),
+        "bytes": total,
+        "duration_s": duration,
+        "bitrate_kbps": 8 * total / duration / 1000 if duration else None,
+    }))
+
+
+def run_detect(path: str, realtime: bool):
+    """
+    Passa cada frame da gravação pelo detector configurado no app_server,
+    sem descartar nenhum: o resultado é o mesmo a cada execução e pode ser
+    comparado com diff. O resumo de desempenho vai para o stderr.
+    """
+    import cv2
+    import numpy as np
+    import app_server as core
+
+    cap = core.ReplayCapture(path, realtime=realtime)
+    tracker = core.make_roi_tracker() if core.TRACKING_ENABLED else None
+    gray = np.empty((core.HEIGHT, core.WIDTH), dtype=np.uint8)
+    frame = np.empty((core.HEIGHT, core.WIDTH, 3), dtype=np.uint8)
+    detect_times, latencies = [], []
+    frame_idx = 0
+    t_start = time.monotonic()
+
+    while True:
+        ret, image, info = cap.read(frame)
+        if not ret:
+            break
+        frame_idx += 1
+        if image.shape != frame.shape:
+            cv2.resize(image, (core.WIDTH, core.HEIGHT), dst=frame)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+
+        t0 = time.monotonic()
+        if tracker is not None:
+            results = tracker.detect(gray)
+        else:
+            results = core.at_detector.detect(gray, estimate_tag_pose=False)
+        done = time.monotonic()
+        detect_times.append(done - t0)
+        latencies.append(done - info.arrival_time)
+
+        print(json.dumps({
+            "frame": frame_idx,
+            "tags": [[int(r.tag_id), round(float(r.center[0]), 2), round(float(r.center[1]), 2)]
+                     for r in sorted(results, key=lambda r: r.tag_id)],
+        }))
+
+    elapsed = time.monotonic() - t_start
+    cap.release()
+    summary = {
+        "frames": frame_idx,
+        "elapsed_s": elapsed,
+        "fps": frame_idx / elapsed if elapsed else None,
+        "detect_ms_p50": 1000 * (_percentile(detect_times, 50) or 0),
+        "detect_ms_p95": 1000 * (_percentile(detect_times, 95) or 0),
+        "latency_ms_p50": 1000 * (_percentile(latencies, 50) or 0),
+        "latency_ms_p95": 1000 * (_percentile(latencies, 95) or 0),
+    }
+    print(json.dumps(summary), file=sys.stderr, flush=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("info", "detect"):
+        print(__doc__)
+        raise SystemExit(2)
+    if sys.argv[1] == "info":
+        run_info(sys.argv[2])
+    else:
+        run_detect(sys.argv[2], realtime="--realtime" in sys.argv)
+        # o destrutor do Detector do pupil_apriltags às vezes dá segfault na
+        # saída do interpretador; sai direto para o código de saída ser confiável
+        sys.stdout.flush()
+        os._exit(0)
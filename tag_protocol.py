@@ -0,0 +1,86 @@
+"""
+Protocolo das detecções de AprilTag entre o servidor e o Raspberry.
+
+Versão 1 (JSON): uma mensagem {"type": "apriltag", ...} por tag.
+Versão 2 (binária): todas as tags de um frame numa mensagem só,
+empacotada com struct. Coordenadas em quartos de pixel (int16),
+então cada tag ocupa 22 bytes em vez de ~250 de JSON.
+
+Negociação: ao conectar, o servidor manda {"type": "hello", "protocols": [1, 2]}
+e o Raspberry responde {"type": "hello", "protocol": N}. Sem resposta, fica no 1.
+"""
+import struct
+
+PROTOCOL_JSON = 1
+PROTOCOL_BINARY = 2
+SUPPORTED_PROTOCOLS = (PROTOCOL_JSON, PROTOCOL_BINARY)
+
+_MAGIC = b"AT"
+# magic, versão, frame_id, timestamp (time.time() do servidor), nº de tags
+_HEADER = struct.Struct("<2sBIdH")
+# id, centro (x, y) e 4 cantos (x, y), em quartos de pixel
+_TAG = struct.Struct("<H10h")
+_SCALE = 4.0
+
+
+def hello_message() -> dict:
+    return {"type": "hello", "protocols": list(SUPPORTED_PROTOCOLS)}
+
+
+def choose_protocol(offered) -> int:
+    """Maior versão que os dois lados entendem."""
+    common = [v for v in offered or () if v in SUPPORTED_PROTOCOLS]
+    return max(common) if common else PROTOCOL_JSON
+
+
+def _q(v: float) -> int:
+    return max(-32768, min(32767, int(round(v * _SCALE))))
+
+
+def encode_batch(frame_id: int, timestamp: float, tags) -> bytes:
+    """tags: sequência de (tag_id, center, corners) com center 2 e corners 4x2."""
+    parts = [_HEADER.pack(_MAGIC, PROTOCOL_BINARY, frame_id & 0xFFFFFFFF, timestamp, len(tags))]
+    for tag_id, center, corners in tags:
+        parts.append(_TAG.pack(
+            tag_id,
+            _q(center[0]), _q(center[1]),
+            _q(corners[0][0]), _q(corners[0][1]),
+            _q(corners[1][0]), _q(corners[1][1]),
+            _q(corners[2][0]), _q(corners[2][1]),
+            _q(corners[3][0]), _q(corners[3][1]),
+        ))
+    return b"".join(parts)
+
+
+def decode_batch(data: bytes) -> dict:
+    """Inverso de encode_batch. Levanta ValueError se a mensagem não for válida."""
+    if len(data) < _HEADER.size:
+        raise ValueError("mensagem binária curta demais")
+    magic, version, frame_id, timestamp, count = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != PROTOCOL_BINARY:
+        raise ValueError("cabeçalho binário desconhecido")
+    if len(data) != _HEADER.size + count * _TAG.size:
+        raise ValueError("tamanho da mensagem não bate com o nº de tags")
+
+    tags = []
+    for v in _TAG.iter_unpack(memoryview(data)[_HEADER.size:]):
+        tags.append({
+            "id": v[0],
+            "center": (v[1] / _SCALE, v[2] / _SCALE),
+            "corners": [(v[i] / _SCALE, v[i + 1] / _SCALE) for i in (3, 5, 7, 9)],
+        })
+    return {"type": "apriltag_batch", "frame_id": frame_id, "timestamp": timestamp, "tags": tags}
+
+
+def batch_to_json_messages(batch: dict, family: str = "tag36h11"):
+    """Converte um lote para as mensagens da versão 1 (uma por tag)."""
+    return [
+        {
+            "type": "apriltag",
+            "id": int(tag_id),
+            "center": [float(c) for c in center],
+            "corners": [[float(x) for x in pt] for pt in corners],
+            "family": family,
+        }
+        for tag_id, center, corners in batch["tags"]
+    ]
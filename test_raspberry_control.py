@@ -0,0 +1,60 @@
+"""
+Testes do raspberry_control.py com o Raspberry simulado (python -m pytest -q).
+"""
+import asyncio
+import json
+import time
+
+import pytest
+
+import raspberry_control as rc
+
+
+class FakeWebSocket:
+    remote_address = ("127.0.0.1", 12345)
+
+    def __init__(self):
+        self.sent = []   # (instante, mensagem)
+
+    async def send(self, message):
+        self.sent.append((time.monotonic(), json.loads(message)))
+
+    def acks(self, cmd_id, stage):
+        return [t for t, m in self.sent
+                if m.get("type") == "ack" and m.get("id") == cmd_id and m.get("stage") == stage]
+
+
+@pytest.fixture(autouse=True)
+def sim(monkeypatch):
+    rc.init_hardware("sim")
+    monkeypatch.setattr(rc.pi, "call_latency_s", 0)
+    # troca do rpicam-vid lenta, como um processo que demora a soltar a câmera
+    monkeypatch.setattr(rc, "restart_video_stream", lambda config: time.sleep(1.0) or 1.0)
+    yield
+    rc.pi.stop()
+
+
+def test_drive_e_stop_atendidos_durante_reconfiguracao_do_video():
+    ws = FakeWebSocket()
+
+    async def run():
+        t0 = time.monotonic()
+        await rc.handle_message(json.dumps(
+            {"type": "video_config", "fps": rc.video_config["fps"] + 1, "id": 1}), ws)
+        await rc.handle_message(json.dumps({"type": "drive", "v": 0.5, "w": 0.0, "id": 2}), ws)
+        await rc.handle_message(json.dumps(
+            {"type": "button", "subtype": "move", "dir": "STOP", "id": 3}), ws)
+        await asyncio.sleep(0.05)
+        acked = time.monotonic() - t0
+        await asyncio.gather(*rc.video_tasks)
+        rc.executor.release(ws)
+        return acked
+
+    acked = asyncio.run(run())
+
+    assert ws.acks(2, "finished") and ws.acks(3, "finished")
+    assert acked < 0.5
+    # a resposta do vídeo só chega depois da troca, e depois dos comandos
+    reply = next(t for t, m in ws.sent if m.get("type") == "video_config")
+    assert reply > ws.acks(3, "finished")[0]
+    assert ws.acks(1, "finished")
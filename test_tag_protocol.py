@@ -0,0 +1,119 @@
+"""
+Testes do protocolo binário das tags (python -m pytest -q).
+"""
+import asyncio
+import json
+
+import pytest
+
+from tag_protocol import (
+    PROTOCOL_BINARY,
+    PROTOCOL_JSON,
+    _HEADER,
+    _TAG,
+    choose_protocol,
+    decode_batch,
+    encode_batch,
+)
+
+CORNERS = [(10.0, 20.0), (30.0, 20.0), (30.0, 40.0), (10.0, 40.0)]
+
+
+def test_ida_e_volta():
+    tags = [(7, (20.0, 30.0), CORNERS), (1, (640.5, 360.25), CORNERS)]
+    batch = decode_batch(encode_batch(42, 1700000000.125, tags))
+
+    assert batch["type"] == "apriltag_batch"
+    assert batch["frame_id"] == 42
+    assert batch["timestamp"] == 1700000000.125
+    assert [t["id"] for t in batch["tags"]] == [7, 1]
+    assert batch["tags"][1]["center"] == (640.5, 360.25)
+    assert batch["tags"][0]["corners"] == CORNERS
+
+
+def test_lote_vazio():
+    data = encode_batch(0, 0.0, [])
+    assert len(data) == _HEADER.size
+    assert decode_batch(data)["tags"] == []
+
+
+def test_arredonda_para_quarto_de_pixel():
+    corners = [(0.1, 0.12), (0.13, 0.37), (0.38, 0.62), (0.63, 0.87)]
+    tag = decode_batch(encode_batch(1, 0.0, [(3, (100.13, 99.9), corners)]))["tags"][0]
+
+    assert tag["center"] == (100.25, 100.0)
+    assert tag["corners"] == [(0.0, 0.0), (0.25, 0.25), (0.5, 0.5), (0.75, 0.75)]
+
+
+def test_satura_no_limite_do_int16():
+    corners = [(8191.75, -8192.0), (9000.0, -9000.0), (0.0, 0.0), (0.0, 0.0)]
+    tag = decode_batch(encode_batch(1, 0.0, [(3, (1e6, -1e6), corners)]))["tags"][0]
+
+    assert tag["center"] == (8191.75, -8192.0)
+    assert tag["corners"][0] == (8191.75, -8192.0)
+    assert tag["corners"][1] == (8191.75, -8192.0)
+
+
+def test_frame_id_da_volta_em_32_bits():
+    assert decode_batch(encode_batch(2 ** 32 + 5, 0.0, []))["frame_id"] == 5
+
+
+def test_mensagem_curta_demais():
+    data = encode_batch(1, 0.0, [(3, (1.0, 1.0), CORNERS)])
+
+    with pytest.raises(ValueError):
+        decode_batch(b"")
+    with pytest.raises(ValueError):
+        decode_batch(data[:_HEADER.size - 1])
+    # cabeçalho diz 1 tag, mas a tag está cortada
+    with pytest.raises(ValueError):
+        decode_batch(data[:-1])
+    with pytest.raises(ValueError):
+        decode_batch(data + b"\x00" * _TAG.size)
+
+
+def test_cabecalho_desconhecido():
+    data = encode_batch(1, 0.0, [])
+    with pytest.raises(ValueError):
+        decode_batch(b"XX" + data[2:])
+    with pytest.raises(ValueError):
+        decode_batch(data[:2] + bytes([PROTOCOL_JSON]) + data[3:])
+
+
+def test_negociacao():
+    assert choose_protocol([1, 2]) == PROTOCOL_BINARY
+    assert choose_protocol([1]) == PROTOCOL_JSON
+    assert choose_protocol(None) == PROTOCOL_JSON
+    assert choose_protocol([3]) == PROTOCOL_JSON
+
+
+class _HelloWebSocket:
+    """Lado do Raspberry na negociação: responde reply ao hello."""
+
+    def __init__(self, reply: str):
+        self.reply = reply
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+
+    async def recv(self):
+        return self.reply
+
+
+@pytest.mark.parametrize("reply, expected", [
+    (json.dumps({"type": "hello", "protocol": PROTOCOL_BINARY}), PROTOCOL_BINARY),
+    (json.dumps({"type": "hello", "protocol": 99}), PROTOCOL_JSON),
+    (json.dumps({"type": "ack"}), PROTOCOL_JSON),
+    # JSON válido que não é objeto: fica no v1 em vez de derrubar a conexão
+    (json.dumps([1, 2]), PROTOCOL_JSON),
+    (json.dumps(2), PROTOCOL_JSON),
+    (json.dumps("hello"), PROTOCOL_JSON),
+    ("não é json", PROTOCOL_JSON),
+])
+def test_negociacao_com_o_raspberry(reply, expected):
+    from app_server import negotiate_protocol
+
+    ws = _HelloWebSocket(reply)
+    assert asyncio.run(negotiate_protocol(ws)) == expected
+    assert ws.sent[0]["type"] == "hello"